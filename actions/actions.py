@@ -14,9 +14,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import os
+import socket
 import sys
 import subprocess
+import threading
 
 _path = os.path.dirname(os.path.realpath(__file__))
 _root = os.path.abspath(os.path.join(_path, ".."))
@@ -30,30 +33,154 @@ def _add_path(path):
 _add_path(_root)
 
 
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import (
+    action_fail,
+    action_get,
+    action_set,
+    function_log,
+    log,
+)
 
 PID_FILE_DIR = "/var/run"
 RUNNING_FLAG_FILE_NAME = os.path.join(
     PID_FILE_DIR, "glance-simplestreams-sync.pid"
 )
+TRIGGER_SOCKET_NAME = "/run/glance-simplestreams-sync.sock"
+# Seconds to wait for the sync daemon to accept a request and for the
+# result of the sync, and the exit status reported when it is not in yet.
+DAEMON_CONNECT_TIMEOUT = 10
+DAEMON_REPLY_TIMEOUT = 60 * 60
+SYNC_STILL_RUNNING = 3
+PROGRESS_FILE_NAME = os.path.join(
+    PID_FILE_DIR, "glance-simplestreams-sync.progress"
+)
+PROGRESS_POLL_INTERVAL = 10
+SYNC_SCRIPT = ("/usr/share/glance-simplestreams-sync/"
+               "glance-simplestreams-sync.sh")
+
+
+def trigger_daemon_sync(force, wait=True):
+    """Request a sync from the sync daemon and wait for its result.
+
+    Returns 2 right after sending the request if wait is False and
+    SYNC_STILL_RUNNING if no result came in DAEMON_REPLY_TIMEOUT seconds.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(DAEMON_CONNECT_TIMEOUT)
+        sock.connect(TRIGGER_SOCKET_NAME)
+        sock.sendall(json.dumps({"force": force}).encode("utf-8") + b"\n")
+        if not wait:
+            return 2
+        sock.settimeout(DAEMON_REPLY_TIMEOUT)
+        try:
+            reply = sock.makefile("r").readline()
+        except socket.timeout:
+            return SYNC_STILL_RUNNING
+    finally:
+        sock.close()
+    return json.loads(reply)["returncode"]
+
+
+def log_progress(done, interval=PROGRESS_POLL_INTERVAL):
+    """Log the progress written by the running sync until done is set."""
+    last = None
+    while not done.wait(interval):
+        try:
+            with open(PROGRESS_FILE_NAME) as f:
+                message = json.load(f)["message"]
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+        if message != last:
+            function_log(message)
+            last = message
+
+
+def run_sync(force, wait):
+    """Run a sync through the sync daemon if it is running, through the
+    sync script otherwise, and return its exit status
+    """
+    exit_status = None
+    if os.path.exists(TRIGGER_SOCKET_NAME):
+        # Let the sync daemon do the sync if it is running.
+        try:
+            exit_status = trigger_daemon_sync(force, wait)
+        except (socket.error, ValueError, KeyError) as e:
+            exit_status = None
+            log("sync daemon unavailable ({}), running the sync "
+                "script".format(e))
+
+    if exit_status is None:
+        cmd = [SYNC_SCRIPT]
+        if force:
+            cmd.append("--force")
+        if wait:
+            cmd.append("--wait")
+        exit_status = subprocess.call(cmd)
+    return exit_status
 
 
 def sync_images(args):
     """Syncs images on local glance instance with the URL provided in the
-    config's mirror list
+    config's mirror list, logging the progress of the sync while waiting
+    for it
     """
-    exit_status = subprocess.call(
-        [("/usr/share/glance-simplestreams-sync/"
-         "glance-simplestreams-sync.sh")]
-    )
+    force = bool(action_get("force"))
+    wait = bool(action_get("wait"))
+    done = threading.Event()
+    if wait:
+        progress = threading.Thread(target=log_progress, args=(done,))
+        progress.daemon = True
+        progress.start()
+    try:
+        exit_status = run_sync(force, wait)
+    finally:
+        done.set()
     if exit_status == 2:
-        action_fail("{} is locked, exiting".format(RUNNING_FLAG_FILE_NAME))
+        if wait:
+            action_fail("{} is locked, exiting".format(
+                RUNNING_FLAG_FILE_NAME))
+        else:
+            # A running sync follows up with a sync serving the request.
+            action_set({"result": "sync queued"})
+            return 0
+    if exit_status == SYNC_STILL_RUNNING:
+        # The sync goes on in the daemon, its result ends up in the
+        # sync reports.
+        action_set({"result": "sync still running"})
+        return 0
     return exit_status
 
 
+def sync_plan(args):
+    """Computes the images a sync would add, delete and retag without
+    transferring any, and returns the plan as the action result
+    """
+    try:
+        output = subprocess.check_output([SYNC_SCRIPT, "--plan"])
+    except subprocess.CalledProcessError as e:
+        action_fail("could not compute the sync plan, exit status "
+                    "{}".format(e.returncode))
+        return e.returncode
+    plan = json.loads(output.decode("utf-8"))
+    action_set({
+        "plan": json.dumps(plan["mirrors"], indent=2, sort_keys=True),
+        "retag": json.dumps(plan.get("retag", []), indent=2, sort_keys=True),
+        "images-to-add": plan["images_to_add"],
+        "images-to-delete": plan["images_to_delete"],
+        "images-to-retag": plan["images_to_retag"],
+        "bytes-to-download": plan["bytes_to_download"],
+        "bytes-to-transfer": plan["bytes_to_transfer"],
+        "estimated-seconds": (plan["estimated_seconds"]
+                              if plan["estimated_seconds"] is not None
+                              else "unknown"),
+    })
+    return 0
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"sync-images": sync_images}
+ACTIONS = {"sync-images": sync_images, "sync-plan": sync_plan}
 
 
 def main(args):
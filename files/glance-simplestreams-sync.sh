@@ -21,4 +21,4 @@ else
     PYTHON=python
 fi
 
-$PYTHON /usr/share/glance-simplestreams-sync/glance_simplestreams_sync.py
+$PYTHON /usr/share/glance-simplestreams-sync/glance_simplestreams_sync.py "$@"
@@ -23,30 +23,59 @@
 # juju relation to keystone. However, it does not execute in a
 # juju hook context itself.
 
-import atexit
+import argparse
 import base64
+import calendar
+import collections
+import concurrent.futures as futures
+import contextlib
 import copy
+import datetime
+import errno
 import fcntl
+import functools
+import gzip
+import hashlib
 import itertools
+import json
 import logging
 import os
+import random
 import re
+import requests
 import shutil
 import six
+import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import yaml
 
 from keystoneclient import exceptions as keystone_exceptions
 from keystoneclient.v2_0 import client as keystone_client
 from keystoneclient.v3 import client as keystone_v3_client
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+from six.moves import shlex_quote
 if six.PY3:
     from urllib import parse as urlparse
 else:
     import urlparse
 
+try:
+    from simplestreams import objectstores as ss_objectstores
+    from simplestreams import openstack as ss_openstack
+    from simplestreams import util as ss_util
+    from simplestreams.mirrors import glance as ss_glance
+    from simplestreams.objectstores import swift as ss_swift
+except ImportError:
+    # The in-process sync engine is optional: by default images are synced
+    # with sstream-mirror-glance from the simplestreams snap.
+    ss_objectstores = ss_openstack = ss_util = ss_glance = ss_swift = None
+
 
 def setup_file_logging():
     logfilename = '/var/log/glance-simplestreams-sync.log'
@@ -77,6 +106,44 @@ ID_CONF_FILE_NAME = os.path.join(CONF_FILE_DIR, 'identity.yaml')
 
 SYNC_RUNNING_FLAG_FILE_NAME = os.path.join(PID_FILE_DIR,
                                            'glance-simplestreams-sync.pid')
+SYNC_QUEUE_FILE_NAME = os.path.join(PID_FILE_DIR,
+                                    'glance-simplestreams-sync.queue')
+# Progress of the running sync, see SyncProgress. Every status update is
+# a juju-exec round-trip, so the unit status is updated less often than
+# the file polled by the sync-images action.
+PROGRESS_FILE_NAME = os.path.join(PID_FILE_DIR,
+                                  'glance-simplestreams-sync.progress')
+PROGRESS_FILE_INTERVAL = 5
+PROGRESS_STATUS_INTERVAL = 30
+
+# Persistent state kept between runs of the script.
+STATE_DIR = '/var/lib/glance-simplestreams-sync'
+SYNC_STATE_FILE_NAME = os.path.join(STATE_DIR, 'sync-state.json')
+KEYSTONE_CACHE_FILE_NAME = os.path.join(STATE_DIR, 'keystone-cache.json')
+# Signed documents verified by previous runs, see SignatureVerifier.
+SIGNATURE_CACHE_FILE_NAME = os.path.join(STATE_DIR, 'signature-cache.json')
+SIGNATURE_CACHE_SIZE = 1000
+# Per-run reports, see SyncReport.
+SYNC_REPORT_DIR = os.path.join(STATE_DIR, 'reports')
+SYNC_REPORTS_KEPT = 100
+# sync-<start time>[-<counter>].json, see SyncReport.write.
+SYNC_REPORT_RE = re.compile(r'^sync-(\d{8}T\d{6}Z)(?:-(\d+))?\.json$')
+# Totals behind the exported metrics, see SyncMetrics.
+METRICS_STATE_FILE_NAME = os.path.join(STATE_DIR, 'metrics.json')
+METRICS_TEXTFILE_NAME = 'glance_simplestreams_sync.prom'
+
+# Content-addressed cache of downloaded images, see StagingCache.
+STAGING_CACHE_DIR = '/var/cache/glance-simplestreams-sync/blobs'
+# Partial downloads not resumed for this long are removed, in seconds.
+STAGING_PART_MAX_AGE = 7 * 24 * 3600
+# Peer units serve their staging cache to each other, see PeerCacheServer.
+PEER_CACHE_BLOB_RE = re.compile(r'^/([0-9a-f]{64})$')
+# Unreachable peers are given up on quickly, the blob is then downloaded
+# from upstream.
+PEER_CONNECT_TIMEOUT = 5
+
+# Cached keystone tokens are refreshed this many seconds before they expire.
+KEYSTONE_CACHE_EXPIRY_MARGIN = 600
 
 # juju looks in simplestreams/data/* in swift to figure out which
 # images to deploy, so this path isn't really configurable even though
@@ -85,6 +152,11 @@ SWIFT_DATA_DIR = 'simplestreams/data'
 
 # When running local apache for product-streams use path to place indexes.
 APACHE_DATA_DIR = '/var/www/html'
+# Streams metadata published with local_streams, see LocalStreamsPublisher.
+LOCAL_STREAMS_DIR = os.path.join(APACHE_DATA_DIR, SWIFT_DATA_DIR)
+LOCAL_STREAMS_RELEASES_DIR = os.path.join(APACHE_DATA_DIR, 'simplestreams',
+                                          '.releases')
+STREAMS_INDEX_PATH = 'streams/v1/index.json'
 
 PRODUCT_STREAMS_SERVICE_NAME = 'image-stream'
 PRODUCT_STREAMS_SERVICE_TYPE = 'product-streams'
@@ -92,6 +164,29 @@ PRODUCT_STREAMS_SERVICE_DESC = 'Ubuntu Product Streams'
 
 CRON_POLL_FILENAME = '/etc/cron.d/glance_simplestreams_sync_fastpoll'
 
+# Architectures as simplestreams names them in glance, see
+# simplestreams.mirrors.glance.canonicalize_arch.
+GLANCE_ARCHITECTURES = {
+    'amd64': 'x86_64',
+    'arm64': 'aarch64',
+    'armhf': 'armv7l',
+    'i386': 'i686',
+    'powerpc': 'ppc',
+    'ppc64el': 'ppc64le',
+}
+
+# Sync daemon scheduling, see SyncDaemon.
+TRIGGER_SOCKET_NAME = '/run/glance-simplestreams-sync.sock'
+SYNC_INTERVALS = {
+    'hourly': 60 * 60,
+    'daily': 24 * 60 * 60,
+    'weekly': 7 * 24 * 60 * 60,
+}
+DAEMON_POLL_INTERVAL = 60
+DAEMON_JITTER = 0.1
+# Seconds a client of the trigger socket has to send its request in.
+TRIGGER_REQUEST_TIMEOUT = 5
+
 SSTREAM_SNAP_COMMON = '/var/snap/simplestreams/common'
 SSTREAM_LOG_FILE = os.path.join(SSTREAM_SNAP_COMMON,
                                 'sstream-mirror-glance.log')
@@ -99,6 +194,19 @@ SSTREAM_LOG_FILE = os.path.join(SSTREAM_SNAP_COMMON,
 CACERT_FILE = os.path.join(SSTREAM_SNAP_COMMON, 'cacert.pem')
 SYSTEM_CACERT_FILE = '/etc/ssl/certs/ca-certificates.crt'
 
+# Timeout in seconds for connecting to and reading from upstream mirrors.
+HTTP_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Interrupted downloads are resumed this many times within a run.
+DOWNLOAD_RETRIES = 3
+# Images are only downloaded in segments of at least this size.
+DOWNLOAD_SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+# Number of DOWNLOAD_CHUNK_SIZE chunks buffered in memory between the
+# upstream download and the glance upload when streaming images.
+STREAMING_BUFFER_CHUNKS = 64
+# Number of images requested per page when listing glance images.
+GLANCE_PAGE_SIZE = 1000
+
 ENDPOINT_TYPES = [
     'publicURL',
     'adminURL',
@@ -202,6 +310,194 @@ def get_keystone_client(api_version):
     return ksc_class(**ksc_vars)
 
 
+class CatalogIndex(object):
+    """Service catalog parsed once into an endpoint lookup table.
+
+    Provides the url_for() lookup of keystoneclient's ServiceCatalog so it
+    can be used in its place, with every lookup being a dict access.
+
+    :param endpoints: Endpoints as dicts with type, interface (publicURL,
+                      internalURL or adminURL), region and url keys.
+    :type endpoints: list[dict[str, str]]
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self._index = {}
+        for endpoint in endpoints:
+            urls = self._index.setdefault(
+                (endpoint['type'], endpoint['interface']), {})
+            urls.setdefault(endpoint['region'], endpoint['url'])
+
+    @classmethod
+    def from_service_catalog(cls, service_catalog):
+        """Index a keystoneclient v2.0 or v3 service catalog."""
+        endpoints = []
+        for service_type, service_endpoints in (
+                service_catalog.get_endpoints().items()):
+            for endpoint in service_endpoints:
+                if 'interface' in endpoint:
+                    endpoints.append({
+                        'type': service_type,
+                        'interface': '{}URL'.format(endpoint['interface']),
+                        'region': (endpoint.get('region_id') or
+                                   endpoint.get('region')),
+                        'url': endpoint['url'],
+                    })
+                    continue
+                for endpoint_type in ENDPOINT_TYPES:
+                    if endpoint_type in endpoint:
+                        endpoints.append({
+                            'type': service_type,
+                            'interface': endpoint_type,
+                            'region': endpoint.get('region'),
+                            'url': endpoint[endpoint_type],
+                        })
+        return cls(endpoints)
+
+    def url_for(self, service_type, endpoint_type='publicURL',
+                region_name=None):
+        """Look up an endpoint URL.
+
+        :raises: :class: `keystone_exceptions.EndpointNotFound`
+        """
+        urls = self._index.get((service_type, endpoint_type), {})
+        if region_name is None and urls:
+            return urls[sorted(urls, key=str)[0]]
+        try:
+            return urls[region_name]
+        except KeyError:
+            raise keystone_exceptions.EndpointNotFound(
+                "{} endpoint for {} service in {} region not found".format(
+                    endpoint_type, service_type, region_name))
+
+
+class CachedKeystoneClient(object):
+    """Keystone token, service list and catalog kept between runs.
+
+    Stands in for a keystoneclient Client for the lookups this script
+    does: services and service_catalog.url_for().
+
+    :param str auth_token: Keystone token.
+    :param float expires_at: Token expiry as a UNIX timestamp.
+    :param str project_id: Project the token is scoped to.
+    :param list services: Service dicts as listed by keystone.
+    :param catalog: Endpoint index of the token's service catalog.
+    :type catalog: CatalogIndex
+    """
+
+    def __init__(self, auth_token, expires_at, project_id, services,
+                 catalog):
+        self.auth_token = auth_token
+        self.expires_at = expires_at
+        self.project_id = project_id
+        self.services = services
+        self.service_catalog = catalog
+
+    @classmethod
+    def from_client(cls, ksc):
+        auth_ref = ksc.auth_ref
+        return cls(auth_ref.auth_token,
+                   calendar.timegm(auth_ref.expires.utctimetuple()),
+                   auth_ref.project_id,
+                   [s._info for s in ksc.services.list()],
+                   CatalogIndex.from_service_catalog(ksc.service_catalog))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['auth_token'], data['expires_at'],
+                   data['project_id'], data['services'],
+                   CatalogIndex(data['endpoints']))
+
+    def to_dict(self):
+        return {
+            'auth_token': self.auth_token,
+            'expires_at': self.expires_at,
+            'project_id': self.project_id,
+            'services': self.services,
+            'endpoints': self.service_catalog.endpoints,
+        }
+
+    def expires_soon(self):
+        return (self.expires_at - time.time() <
+                KEYSTONE_CACHE_EXPIRY_MARGIN)
+
+
+def get_keystone_cache_key():
+    """Identify the credentials a cached token was issued for."""
+    return ' '.join(os.environ.get(var, '') for var in [
+        'OS_AUTH_URL', 'OS_USERNAME', 'OS_PROJECT_ID', 'OS_TENANT_ID',
+        'OS_REGION_NAME'])
+
+
+def _read_keystone_cache(f, cache_key):
+    f.seek(0)
+    try:
+        data = json.load(f)
+    except ValueError:
+        return None
+    if data.get('key') != cache_key:
+        return None
+    cached = CachedKeystoneClient.from_dict(data['client'])
+    if cached.expires_soon():
+        return None
+    return cached
+
+
+def get_cached_keystone_client(api_version):
+    """Return keystone data, authenticating only if the cache is stale.
+
+    The token, service list and service catalog are cached on disk until
+    shortly before the token expires. Readers take a shared lock on the
+    cache file, a refresh takes an exclusive one so concurrent runs
+    authenticate only once.
+
+    :param api_version: Keystone API version.
+    :rtype: CachedKeystoneClient
+    """
+    cache_key = get_keystone_cache_key()
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    # The cache holds a token, keep it private.
+    fd = os.open(KEYSTONE_CACHE_FILE_NAME, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        cached = _read_keystone_cache(f, cache_key)
+        if cached is not None:
+            log.debug("using cached keystone token and catalog")
+            return cached
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # Another run may have refreshed the cache while we waited.
+        cached = _read_keystone_cache(f, cache_key)
+        if cached is not None:
+            return cached
+        log.info("refreshing keystone token and catalog cache")
+        cached = CachedKeystoneClient.from_client(
+            get_keystone_client(api_version))
+        f.seek(0)
+        f.truncate()
+        json.dump({'key': cache_key, 'client': cached.to_dict()}, f)
+        f.flush()
+        return cached
+
+
+def invalidate_keystone_cache():
+    """Make the next run re-read the service catalog from keystone."""
+    try:
+        os.unlink(KEYSTONE_CACHE_FILE_NAME)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def is_unauthorized(e):
+    """Whether an error reports a rejected, e.g. revoked, token."""
+    if isinstance(e, keystone_exceptions.Unauthorized):
+        return True
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None) == 401
+
+
 def set_openstack_env(id_conf, charm_conf):
     version = 'v3' if str(id_conf['api_version']).startswith('3') else 'v2.0'
     if id_conf.get('interface') == 'internal':
@@ -243,103 +539,2559 @@ def set_openstack_env(id_conf, charm_conf):
         os.environ['OS_TENANT_NAME'] = id_conf['admin_tenant_name']
 
 
-def do_sync(ksc, charm_conf):
+class SyncReport(object):
+    """Timings and counters of a sync run.
+
+    Phases are timed and counters summed for the whole run and for each
+    mirror. Native engine mirrors report the time spent in metadata_fetch,
+    download, upload and metadata_write and the bytes and images they
+    transferred, mirrors synced by sstream-mirror-glance only their total
+    sync time. The report is written as JSON to SYNC_REPORT_DIR at the end
+    of every run. All methods are thread-safe.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.returncode = None
+        self.phases = {}
+        self.counters = {}
+        self.mirrors = {}
+        self._lock = threading.Lock()
+
+    def _get_mirror(self, mirror):
+        return self.mirrors.setdefault(
+            mirror, {'phases': {}, 'counters': {}, 'result': None})
+
+    @contextlib.contextmanager
+    def phase(self, name, mirror=None):
+        """Context manager adding its duration to a phase."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start, mirror)
+
+    def add_time(self, name, seconds, mirror=None):
+        with self._lock:
+            target = self.phases if mirror is None else self._get_mirror(
+                mirror)['phases']
+            target[name] = target.get(name, 0) + seconds
+
+    def count(self, name, value=1, mirror=None):
+        """Add value to a counter of the run and of mirror if given."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if mirror is not None:
+                counters = self._get_mirror(mirror)['counters']
+                counters[name] = counters.get(name, 0) + value
+
+    def set_result(self, mirror, result):
+        """Record the outcome of a mirror: synced, skipped or an error."""
+        with self._lock:
+            self._get_mirror(mirror)['result'] = result
+
+    def to_dict(self):
+        with self._lock:
+            return copy.deepcopy({
+                'started': self.started,
+                'finished': self.finished,
+                'duration': (self.finished or time.time()) - self.started,
+                'returncode': self.returncode,
+                'phases': self.phases,
+                'counters': self.counters,
+                'mirrors': self.mirrors,
+            })
+
+    @staticmethod
+    def sort_key(name):
+        """Order report file names by start time, then counter."""
+        timestamp, counter = SYNC_REPORT_RE.match(name).groups()
+        return timestamp, int(counter or 0)
+
+    def write(self, returncode=None):
+        """Finish the run and write the report.
+
+        :param returncode: Outcome of the run.
+        :type returncode: None | int
+        :returns: Path of the written report.
+        :rtype: str
+        """
+        self.finished = time.time()
+        self.returncode = returncode
+        if not os.path.isdir(SYNC_REPORT_DIR):
+            os.makedirs(SYNC_REPORT_DIR)
+        base_name = os.path.join(SYNC_REPORT_DIR, time.strftime(
+            'sync-%Y%m%dT%H%M%SZ', time.gmtime(self.started)))
+        fd, tmp_file_name = tempfile.mkstemp(dir=SYNC_REPORT_DIR,
+                                             suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            # Runs started within the same second get a counter appended
+            # rather than overwrite each other's report.
+            file_name = base_name + '.json'
+            for counter in itertools.count(1):
+                try:
+                    os.link(tmp_file_name, file_name)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    file_name = '{}-{}.json'.format(base_name, counter)
+        finally:
+            os.unlink(tmp_file_name)
+        reports = sorted((name for name in os.listdir(SYNC_REPORT_DIR)
+                          if SYNC_REPORT_RE.match(name)),
+                         key=self.sort_key)
+        for name in reports[:-SYNC_REPORTS_KEPT]:
+            os.unlink(os.path.join(SYNC_REPORT_DIR, name))
+        return file_name
+
+
+class SyncProgress(object):
+    """Progress of a running sync, reported while it runs.
+
+    Progress is derived from the counters of the run's report: mirrors
+    done, images uploaded out of those planned and bytes downloaded out
+    of those planned, from which the download rate and an ETA follow.
+    Native engine mirrors count planned images and bytes (see
+    NativeSyncEngine.count_planned), mirrors synced by sstream-mirror-glance
+    only report when they are done. A background thread writes the
+    progress to PROGRESS_FILE_NAME every PROGRESS_FILE_INTERVAL seconds
+    and to the unit status at most every PROGRESS_STATUS_INTERVAL seconds.
+
+    :param report: Report of the run.
+    :type report: SyncReport
+    :param int mirrors: Number of mirrors of the run.
+    """
+
+    def __init__(self, report, mirrors):
+        self.report = report
+        self.mirrors = mirrors
+        # First (time, bytes downloaded) seen of every mirror.
+        self.samples = {}
+        self.status_updated = None
+        self.status_message = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def snapshot(self, now=None):
+        """Return the progress of the run and of every mirror.
+
+        :rtype: dict
+        """
+        now = now or time.time()
+        report = self.report.to_dict()
+        mirrors = {}
+        for mirror, data in report['mirrors'].items():
+            counters = data['counters']
+            downloaded = counters.get('bytes_downloaded', 0)
+            first = self.samples.setdefault(mirror, (now, downloaded))
+            done = data['result'] is not None
+            rate = 0.
+            if not done and now > first[0]:
+                rate = (downloaded - first[1]) / (now - first[0])
+            remaining = 0
+            if not done:
+                remaining = max(0, counters.get('bytes_planned', 0) -
+                                downloaded)
+            mirrors[mirror] = {
+                'done': done,
+                'result': data['result'],
+                'images_done': counters.get('images_uploaded', 0),
+                'images_planned': counters.get('images_planned', 0),
+                'bytes_done': downloaded,
+                'bytes_remaining': remaining,
+                'bytes_per_second': rate,
+                'eta_seconds': remaining / rate if rate else None,
+            }
+        rate = sum(m['bytes_per_second'] for m in mirrors.values())
+        remaining = sum(m['bytes_remaining'] for m in mirrors.values())
+        progress = {
+            'updated': now,
+            'mirrors_done': sum(1 for m in mirrors.values() if m['done']),
+            'mirrors': mirrors,
+            'mirror_count': self.mirrors,
+            'images_done': sum(m['images_done'] for m in mirrors.values()),
+            'images_planned': sum(m['images_planned']
+                                  for m in mirrors.values()),
+            'bytes_per_second': rate,
+            'eta_seconds': remaining / rate if rate else None,
+        }
+        progress['message'] = self.format(progress)
+        return progress
+
+    @staticmethod
+    def format(progress):
+        parts = ['{}/{} mirrors done'.format(progress['mirrors_done'],
+                                             progress['mirror_count'])]
+        if progress['images_planned']:
+            parts.append('{}/{} images'.format(progress['images_done'],
+                                               progress['images_planned']))
+        if progress['bytes_per_second']:
+            parts.append('{:.1f} MB/s'.format(
+                progress['bytes_per_second'] / 1e6))
+        if progress['eta_seconds'] is not None:
+            parts.append('ETA {}'.format(datetime.timedelta(
+                seconds=int(progress['eta_seconds']))))
+        return 'Synchronising images: {}'.format(', '.join(parts))
+
+    def tick(self, now=None):
+        """Write the progress file and update the status if due."""
+        now = now or time.time()
+        progress = self.snapshot(now)
+        tmp_file_name = PROGRESS_FILE_NAME + '.tmp'
+        with open(tmp_file_name, 'w') as f:
+            json.dump(progress, f, sort_keys=True)
+        os.rename(tmp_file_name, PROGRESS_FILE_NAME)
+        if progress['message'] == self.status_message:
+            return
+        if (self.status_updated is not None and
+                now - self.status_updated < PROGRESS_STATUS_INTERVAL):
+            return
+        status_set('maintenance', progress['message'])
+        hook_tools.flush()
+        self.status_updated = now
+        self.status_message = progress['message']
+
+    def _run(self):
+        while not self.stopped.wait(PROGRESS_FILE_INTERVAL):
+            try:
+                self.tick()
+            except Exception as e:
+                log.warning("could not report progress: {}".format(e))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop reporting and remove the progress file."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        try:
+            os.unlink(PROGRESS_FILE_NAME)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class SyncMetrics(object):
+    """Sync metrics exported through the node-exporter textfile collector.
+
+    Counters are kept in METRICS_STATE_FILE_NAME so that they keep growing
+    across runs and processes. The textfile is rewritten after every mirror
+    from the persisted totals plus the progress of the running sync, the
+    totals themselves are only updated once the run is finished.
+
+    :param str directory: Directory read by the textfile collector.
+    """
+
+    COUNTERS = {
+        'gss_bytes_downloaded_total': 'Bytes downloaded from upstream.',
+        'gss_images_uploaded_total': 'Images uploaded to glance.',
+        'gss_lock_contention_total': 'Syncs skipped as another was running.',
+        'gss_sync_runs_total': 'Finished sync runs by result.',
+    }
+    GAUGES = {
+        'gss_last_success_timestamp': 'Time of the last successful sync.',
+        'gss_last_run_timestamp': 'Time of the last finished sync.',
+        'gss_mirror_last_success_timestamp':
+            'Time of the last successful sync of a mirror.',
+        'gss_sync_duration_seconds': 'Duration of the last sync of a mirror.',
+    }
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def labels(**labels):
+        """Render a label set, e.g. '{mirror="..."}'."""
+        if not labels:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(name, value.replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in sorted(labels.items())) + '}'
+
+    @contextlib.contextmanager
+    def _state(self, save):
+        """Yield the persisted totals, locked against other processes."""
+        if not os.path.isdir(STATE_DIR):
+            os.makedirs(STATE_DIR)
+        with self._lock, open(METRICS_STATE_FILE_NAME + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(METRICS_STATE_FILE_NAME) as f:
+                    state = json.load(f)
+            except (IOError, OSError, ValueError):
+                state = {}
+            state.setdefault('counters', {})
+            state.setdefault('gauges', {})
+            yield state
+            if save:
+                tmp_file_name = METRICS_STATE_FILE_NAME + '.tmp'
+                with open(tmp_file_name, 'w') as f:
+                    json.dump(state, f, indent=2, sort_keys=True)
+                os.rename(tmp_file_name, METRICS_STATE_FILE_NAME)
+
+    def _merge(self, state, report, returncode=None):
+        """Add the outcome of a (running) sync to the totals."""
+        counters, gauges = state['counters'], state['gauges']
+        now = time.time()
+        for mirror, data in report.to_dict()['mirrors'].items():
+            labels = self.labels(mirror=mirror)
+            for metric, name in (('gss_bytes_downloaded_total',
+                                  'bytes_downloaded'),
+                                 ('gss_images_uploaded_total',
+                                  'images_uploaded')):
+                values = counters.setdefault(metric, {})
+                values[labels] = (values.get(labels, 0) +
+                                  data['counters'].get(name, 0))
+            if 'sync' in data['phases']:
+                gauges.setdefault('gss_sync_duration_seconds', {})[
+                    labels] = data['phases']['sync']
+            if data['result'] in ('synced', 'skipped'):
+                gauges.setdefault('gss_mirror_last_success_timestamp', {})[
+                    labels] = now
+        if returncode is not None:
+            result = 'success' if returncode == 0 else 'failure'
+            runs = counters.setdefault('gss_sync_runs_total', {})
+            labels = self.labels(result=result)
+            runs[labels] = runs.get(labels, 0) + 1
+            gauges['gss_last_run_timestamp'] = {'': now}
+            if returncode == 0:
+                gauges['gss_last_success_timestamp'] = {'': now}
+
+    def _write_textfile(self, state):
+        lines = []
+        for kind, metrics in (('counter', self.COUNTERS),
+                              ('gauge', self.GAUGES)):
+            values = state['counters' if kind == 'counter' else 'gauges']
+            for metric in sorted(metrics):
+                if metric not in values:
+                    continue
+                lines.append('# HELP {} {}'.format(metric, metrics[metric]))
+                lines.append('# TYPE {} {}'.format(metric, kind))
+                for labels, value in sorted(values[metric].items()):
+                    lines.append('{}{} {}'.format(metric, labels, value))
+        file_name = os.path.join(self.directory, METRICS_TEXTFILE_NAME)
+        with open(file_name + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(file_name + '.tmp', file_name)
+
+    def update(self, report, returncode=None):
+        """Export the progress of a sync.
+
+        :param report: Report of the running sync.
+        :type report: SyncReport
+        :param returncode: Outcome of the run once it is finished, the
+                           totals are only updated then.
+        :type returncode: None | int
+        """
+        try:
+            with self._state(save=returncode is not None) as state:
+                self._merge(state, report, returncode)
+                self._write_textfile(state)
+        except (IOError, OSError) as e:
+            log.warning("could not export metrics: {}".format(e))
+
+    def count_lock_contention(self):
+        try:
+            with self._state(save=True) as state:
+                values = state['counters'].setdefault(
+                    'gss_lock_contention_total', {})
+                values[''] = values.get('', 0) + 1
+                self._write_textfile(state)
+        except (IOError, OSError) as e:
+            log.warning("could not export metrics: {}".format(e))
+
+
+def get_sync_metrics(charm_conf):
+    """Return the metrics exporter if the textfile directory exists.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :rtype: None | SyncMetrics
+    """
+    directory = charm_conf.get('metrics_textfile_dir')
+    if directory and os.path.isdir(directory):
+        return SyncMetrics(directory)
+    return None
+
+
+def record_lock_contention():
+    """Count a sync skipped because another one holds the lock."""
+    try:
+        charm_conf = read_conf(CHARM_CONF_FILE_NAME)
+    except Exception as e:
+        log.debug("not counting lock contention: {}".format(e))
+        return
+    metrics = get_sync_metrics(charm_conf or {})
+    if metrics is not None:
+        metrics.count_lock_contention()
+
+
+def instrument(obj, names, report, phase, mirror=None, counter=None):
+    """Time calls to methods of obj as a phase of report.
+
+    :param obj: Object to replace methods of.
+    :param names: Names of the methods to time.
+    :type names: Iterable[str]
+    :param report: Report to add timings to.
+    :type report: SyncReport
+    :param str phase: Name of the phase.
+    :param str mirror: Mirror to account the phase to.
+    :param str counter: Counter to increment for every call.
+    """
+    def wrap(method):
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            with report.phase(phase, mirror):
+                result = method(*args, **kwargs)
+            if counter:
+                report.count(counter, mirror=mirror)
+            return result
+        return timed
+
+    for name in names:
+        method = getattr(obj, name, None)
+        if method is not None:
+            setattr(obj, name, wrap(method))
+    return obj
+
+
+class MirrorSyncError(Exception):
+    """Raised when one or more mirrors failed to synchronise.
+
+    :param failures: Mirrors that failed along with the raised exception.
+    :type failures: list[tuple[dict, Exception]]
+    """
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(MirrorSyncError, self).__init__(
+            'failed to sync mirror(s): {}'.format(
+                ', '.join(m['url'] for m, _ in failures)))
+
+    @property
+    def returncode(self):
+        """Return code of the first failed sstream-mirror-glance run."""
+        for _, e in self.failures:
+            if isinstance(e, subprocess.CalledProcessError):
+                return e.returncode
+        return 1
+
+
+def get_target_regions(charm_conf):
+    """Return the regions to sync images to, the charm's region first.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :rtype: list[str]
+    """
+    regions = [charm_conf['region']]
+    for region_name in (charm_conf.get('additional_regions') or '').split():
+        if region_name not in regions:
+            regions.append(region_name)
+    return regions
+
+
+def get_download_segments(mirror_info):
+    """Number of parallel range requests to download a mirror's images with.
+
+    :param dict mirror_info: An entry of charm_conf['mirror_list'].
+    :rtype: int
+    """
+    return max(int(mirror_info.get('download_segments') or 1), 1)
+
+
+def get_bandwidth_weight(mirror_info):
+    """Share of the bandwidth limit a mirror gets relative to the others.
+
+    :param dict mirror_info: An entry of charm_conf['mirror_list'].
+    :rtype: float
+    """
+    weight = float(mirror_info.get('bandwidth_weight') or 1)
+    if weight <= 0:
+        log.warning("ignoring bandwidth_weight {} of {}".format(
+            weight, mirror_info['url']))
+        return 1.0
+    return weight
+
+
+def get_mirror_options(charm_conf, mirror_info, output_dir,
+                       region_name=None):
+    """Build the set of sync options for a single mirror.
+
+    The option names follow the command line arguments of
+    sstream-mirror-glance so that the same set can either be turned into a
+    command line (see build_sync_command) or handed to NativeSyncEngine.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :param dict mirror_info: An entry of charm_conf['mirror_list'].
+    :param str output_dir: Directory to write metadata to if swift is unused.
+    :param str region_name: Region to sync to, the charm's region if None.
+    :rtype: dict
+    """
+    if region_name is None:
+        region_name = charm_conf['region']
+    options = {
+        'region': region_name,
+        'source_mirror': mirror_info['url'],
+        'path': mirror_info['path'],
+        'item_filters': list(mirror_info['item_filters']),
+        'max_items': mirror_info['max'],
+        'keep_items': True,
+        'content_id': charm_conf['content_id_template'].format(
+            region=region_name),
+        'cloud_name': charm_conf['cloud_name'],
+        'name_prefix': charm_conf['name_prefix'],
+        'keyring': charm_conf.get('keyring_path', DEFAULT_KEYRING),
+        'hypervisor_mapping': charm_conf.get('hypervisor_mapping', False),
+        'custom_properties': (charm_conf.get('custom_properties') or
+                              '').split(),
+        'image_import_conversion': charm_conf.get('image_import_conversion',
+                                                  False),
+        'set_latest_property': charm_conf.get('set_latest_property', False),
+        'visibility': charm_conf['visibility'],
+        'download_segments': get_download_segments(mirror_info),
+        'bandwidth_weight': get_bandwidth_weight(mirror_info),
+        'transfer_priority': charm_conf.get('transfer_priority') or '',
+        'output_swift': None,
+        'output_dir': None,
+    }
+    if charm_conf['use_swift']:
+        options['output_swift'] = "{}/".format(SWIFT_DATA_DIR)
+    else:
+        # Published by LocalStreamsPublisher with local_streams set.
+        options['output_dir'] = output_dir
+    return options
+
+
+def build_sync_command(options):
+    """Turn sync options into an sstream-mirror-glance command line.
+
+    :param dict options: Sync options as returned by get_mirror_options.
+    :rtype: list[str]
+    """
+    sync_command = [
+        "/snap/bin/simplestreams.sstream-mirror-glance",
+        "-vv",
+        "--keep",
+        "--max", str(options['max_items']),
+        "--content-id", options['content_id'],
+        "--cloud-name", options['cloud_name'],
+        "--path", options['path'],
+        "--name-prefix", options['name_prefix'],
+        "--keyring", options['keyring'],
+        "--log-file", SSTREAM_LOG_FILE,
+    ]
+
+    if options['output_swift']:
+        sync_command += [
+            '--output-swift',
+            options['output_swift'],
+        ]
+    else:
+        sync_command += [
+            "--output-dir",
+            options['output_dir'],
+        ]
+
+    if options['hypervisor_mapping']:
+        sync_command += [
+            '--hypervisor-mapping'
+        ]
+
+    for custom_property in options['custom_properties']:
+        sync_command += [
+            '--custom-property',
+            custom_property
+        ]
+
+    if options['image_import_conversion']:
+        sync_command += [
+            '--image-import-conversion'
+        ]
+
+    # options['set_latest_property'] is handled by update_latest_property
+    # once all mirrors are synced.
+
+    # --visibility is relatively new so use it only when the
+    # default value is modified for backward compatibility
+    if options['visibility'] != "public":
+        sync_command += [
+            "--visibility",
+            options['visibility'],
+        ]
+
+    sync_command += [
+        options['source_mirror'],
+    ]
+    sync_command += options['item_filters']
+    return sync_command
+
+
+def get_http_session(user_agent=None, pool_size=10):
+    """Create an HTTP session for talking to upstream mirrors.
+
+    Proxy settings are picked up from the process environment at request
+    time, so the session honours the same HTTP(S)_PROXY and NO_PROXY values
+    that sstream-mirror-glance would be given.
+
+    :param str user_agent: User-Agent header to send upstream.
+    :param int pool_size: Number of connections kept open per host.
+    :rtype: :class: `requests.Session`
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if user_agent:
+        session.headers['User-Agent'] = user_agent
+    return session
+
+
+class BandwidthScheduler(object):
+    """Token bucket limiting the download bandwidth of a run.
+
+    The rate in effect is the limit of the window covering the current
+    local time or the default limit outside of all windows. Mirrors
+    downloading at the same time share the rate in proportion to their
+    weight, a mirror downloading on its own gets all of it. Every mirror
+    draws from its own bucket and sleeps off any debt it runs into.
+
+    :param int limit: Default limit in Mbit/s, 0 for no limit.
+    :param windows: (start, end, limit) tuples with start and end in
+                    minutes since local midnight. A window ending before it
+                    starts wraps around midnight.
+    :type windows: list[tuple]
+    """
+
+    # Mirrors which downloaded within this many seconds of the end of
+    # their last sleep share the rate, a mirror sleeping off its debt is
+    # still active however long it sleeps.
+    ACTIVE_INTERVAL = 2
+    # Seconds worth of the rate an idle mirror may burst at.
+    BURST = 1
+
+    def __init__(self, limit=0, windows=None):
+        self.limit = limit
+        self.windows = windows or []
+        self.lock = threading.Lock()
+        # mirror -> {'tokens', 'refilled', 'weight', 'until'}
+        self.buckets = {}
+
+    def rate(self, now=None):
+        """Limit in bytes per second in effect at now, 0 for no limit."""
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        limit = self.limit
+        for start, end, window_limit in self.windows:
+            if start <= end:
+                inside = start <= minute < end
+            else:
+                inside = minute >= start or minute < end
+            if inside:
+                limit = window_limit
+                break
+        return limit * 1000 * 1000 // 8
+
+    def consume(self, mirror, nbytes, weight=1):
+        """Account nbytes downloaded by mirror, sleeping if over its share.
+
+        :param str mirror: Mirror the bytes were downloaded for.
+        :param int nbytes: Number of bytes downloaded.
+        :param float weight: Weight of the mirror.
+        """
+        with self.lock:
+            now = time.time()
+            rate = self.rate(now)
+            if not rate:
+                self.buckets.pop(mirror, None)
+                return
+            bucket = self.buckets.setdefault(
+                mirror, {'tokens': 0.0, 'refilled': now, 'until': now})
+            bucket['weight'] = weight
+            active = sum(
+                b['weight'] for m, b in self.buckets.items()
+                if m == mirror or now - b['until'] < self.ACTIVE_INTERVAL)
+            share = float(rate) * weight / active
+            bucket['tokens'] = min(
+                bucket['tokens'] + (now - bucket['refilled']) * share,
+                share * self.BURST) - nbytes
+            bucket['refilled'] = now
+            wait = -bucket['tokens'] / share
+            bucket['until'] = now + max(wait, 0)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_bandwidth_schedule(schedule):
+    """Parse bandwidth_schedule into BandwidthScheduler windows.
+
+    :param str schedule: Space separated HH:MM-HH:MM=LIMIT entries.
+    :rtype: list[tuple]
+    :raises: ValueError
+    """
+    windows = []
+    for entry in (schedule or '').split():
+        match = re.match(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(\d+)$',
+                         entry)
+        if not match:
+            raise ValueError("invalid bandwidth_schedule entry "
+                             "{!r}".format(entry))
+        start_h, start_m, end_h, end_m, limit = map(int, match.groups())
+        if (max(start_h, end_h) > 24 or max(start_m, end_m) > 59):
+            raise ValueError("invalid bandwidth_schedule entry "
+                             "{!r}".format(entry))
+        windows.append((start_h * 60 + start_m, end_h * 60 + end_m, limit))
+    return windows
+
+
+def get_bandwidth_scheduler(charm_conf):
+    """Return the bandwidth scheduler of a run.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :returns: None if neither bandwidth_limit nor bandwidth_schedule is set.
+    :rtype: None | BandwidthScheduler
+    """
+    limit = int(charm_conf.get('bandwidth_limit') or 0)
+    try:
+        windows = parse_bandwidth_schedule(
+            charm_conf.get('bandwidth_schedule'))
+    except ValueError as e:
+        log.error("{}, not using the bandwidth schedule".format(e))
+        windows = []
+    if not limit and not windows:
+        return None
+    return BandwidthScheduler(limit, windows)
+
+
+class HttpContentSource(object):
+    """Content source reading a URL through a shared HTTP session.
+
+    Implements the subset of simplestreams.contentsource.ContentSource used
+    by the mirror writers: url, open(), read(), close() and the context
+    manager protocol.
+
+    :param session: HTTP session to fetch the URL with.
+    :type session: :class: `requests.Session`
+    :param str url: URL to read.
+    :param str sha256: Expected checksum of the content if known.
+    :param int size: Expected size of the content if known.
+    :param throttle: Callable(nbytes) to account downloaded bytes to.
+    """
+
+    def __init__(self, session, url, sha256=None, size=None, throttle=None):
+        self.session = session
+        self.url = url
+        self.sha256 = sha256
+        self.size = size
+        self.throttle = throttle
+        self.response = None
+
+    def open(self):
+        if self.response is not None:
+            return
+        response = self.session.get(self.url, stream=True,
+                                    timeout=HTTP_TIMEOUT)
+        if response.status_code == 404:
+            response.close()
+            raise IOError(errno.ENOENT, 'Not found', self.url)
+        response.raise_for_status()
+        self.response = response
+
+    def read(self, size=-1):
+        self.open()
+        if size is None or size < 0:
+            data = self.response.raw.read(decode_content=True)
+        else:
+            data = self.response.raw.read(size, decode_content=True)
+        if self.throttle is not None:
+            self.throttle(len(data))
+        return data
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class ChecksumMismatch(IOError):
+    """Raised when downloaded content does not match its checksum."""
+
+
+class StagingCache(object):
+    """Content-addressed cache of downloaded images.
+
+    Images are stored under their sha256 from the product metadata and are
+    only moved into place once their checksum has been verified, so a blob
+    is downloaded and verified once and then reused by every mirror, region
+    and run referring to it. Interrupted downloads are kept as <sha256>.part
+    and resumed with HTTP Range requests, within the same run or by the
+    next one.
+
+    Blobs missing from the cache are first looked for in the staging
+    caches of peer units (see PeerCacheServer), so that only one unit
+    downloads them from upstream.
+
+    :param str path: Directory to keep blobs in.
+    :param session: HTTP session to download with.
+    :type session: :class: `requests.Session`
+    :param peers: Base URLs of the staging caches of peer units.
+    :type peers: list[str]
+    """
+
+    def __init__(self, path, session, peers=()):
+        self.path = path
+        self.session = session
+        self.peers = list(peers)
+        # Peers are on the local network, bypass the upstream proxy.
+        self.peer_session = requests.Session()
+        self.peer_session.trust_env = False
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.path, sha256)
+
+    def get(self, url, sha256, size=None, segments=1, throttle=None):
+        """Return the path of a verified blob, downloading it if needed.
+
+        :param str url: URL to download the blob from.
+        :param str sha256: Expected checksum of the blob.
+        :param int size: Expected size of the blob if known.
+        :param int segments: Number of parallel range requests to download
+                             a blob of known size with.
+        :param throttle: Callable(nbytes) to account downloaded bytes to.
+        :rtype: str
+        :raises: :class: `ChecksumMismatch`
+        """
+        blob_path = self.blob_path(sha256)
+        # Serialise downloads of the same blob across threads and
+        # processes, later callers find the verified blob in place.
+        with open(blob_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(blob_path):
+                log.debug("{} found in staging cache".format(sha256))
+                os.utime(blob_path, None)
+                return blob_path
+            if self._fetch_from_peers(sha256, blob_path, size):
+                return blob_path
+            digest = None
+            segments = min(segments, (size or 0) // DOWNLOAD_SEGMENT_MIN_SIZE)
+            # A partial download left by an earlier run is resumed in a
+            # single stream rather than thrown away.
+            if segments > 1 and not os.path.exists(blob_path + '.part'):
+                digest = self._download_segmented(url, blob_path, size,
+                                                  segments, throttle)
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                if digest is not None:
+                    break
+                try:
+                    digest = self._download(url, blob_path + '.part', size,
+                                            throttle)
+                    break
+                except (requests.RequestException, socket.error) as e:
+                    if attempt == DOWNLOAD_RETRIES:
+                        raise
+                    log.warning("download of {} interrupted ({}), "
+                                "resuming".format(url, e))
+            if digest != sha256:
+                os.unlink(blob_path + '.part')
+                raise ChecksumMismatch(
+                    "{}: expected sha256 {}, got {}".format(
+                        url, sha256, digest))
+            os.rename(blob_path + '.part', blob_path)
+            return blob_path
+
+    def _fetch_from_peers(self, sha256, blob_path, size):
+        """Fetch a blob from the staging cache of a peer unit.
+
+        :returns: Whether a verified blob was put in place.
+        :rtype: bool
+        """
+        part_path = blob_path + '.part'
+        for peer in self.peers:
+            url = '{}/{}'.format(peer.rstrip('/'), sha256)
+            try:
+                digest = self._download(
+                    url, part_path, size, session=self.peer_session,
+                    timeout=(PEER_CONNECT_TIMEOUT, HTTP_TIMEOUT))
+            except (requests.RequestException, socket.error) as e:
+                log.debug("{} not fetched from peer {}: {}".format(
+                    sha256, peer, e))
+                continue
+            if digest == sha256:
+                log.info("{} fetched from peer {}".format(sha256, peer))
+                os.rename(part_path, blob_path)
+                return True
+            log.warning("{} from peer {} has sha256 {}, "
+                        "discarding it".format(sha256, peer, digest))
+            os.unlink(part_path)
+        return False
+
+    def _download(self, url, part_path, size, throttle=None, session=None,
+                  timeout=HTTP_TIMEOUT):
+        session = session or self.session
+        hasher = hashlib.sha256()
+        offset = 0
+        if os.path.exists(part_path):
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+        if size is not None and offset >= size:
+            return hasher.hexdigest()
+
+        headers = {}
+        if offset:
+            log.info("resuming download of {} at byte {}".format(url,
+                                                                 offset))
+            headers['Range'] = 'bytes={}-'.format(offset)
+        response = session.get(url, headers=headers, stream=True,
+                               timeout=timeout)
+        try:
+            if offset and response.status_code != 206:
+                # The server does not support ranges, start over.
+                log.info("{} does not support ranges, restarting "
+                         "download".format(url))
+                hasher = hashlib.sha256()
+                offset = 0
+                if response.status_code == 416:
+                    response.close()
+                    response = session.get(url, stream=True,
+                                           timeout=timeout)
+            response.raise_for_status()
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    if throttle is not None:
+                        throttle(len(chunk))
+        finally:
+            response.close()
+        return hasher.hexdigest()
+
+    def _download_segmented(self, url, blob_path, size, segments,
+                            throttle=None):
+        """Download a blob with parallel range requests into its .part file.
+
+        Segments are written in place into a file of the final size and
+        the file is hashed once all of them are complete. Interrupted
+        segments are retried, if one still fails the .part file is cut
+        back to the bytes completed by the first segment so that the
+        single stream download resumes from there.
+
+        :returns: The sha256 of the download or None if the server does
+                  not support ranges or a segment failed.
+        :rtype: None | str
+        """
+        segment_size = -(-size // segments)
+        bounds = [(start, min(start + segment_size, size) - 1)
+                  for start in range(0, size, segment_size)]
+        # The first segment doubles as a probe for range support.
+        response = self.session.get(
+            url, headers={'Range': 'bytes={}-{}'.format(*bounds[0])},
+            stream=True, timeout=HTTP_TIMEOUT)
+        if response.status_code != 206:
+            response.close()
+            log.info("{} does not support ranges, downloading it in a "
+                     "single stream".format(url))
+            return None
+
+        log.info("downloading {} in {} segments".format(url, len(bounds)))
+        part_path = blob_path + '.part'
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        progress = {}
+        try:
+            with futures.ThreadPoolExecutor(
+                    max_workers=len(bounds)) as executor:
+                jobs = [executor.submit(self._download_segment, url,
+                                        part_path, start, end,
+                                        response if start == 0 else None,
+                                        throttle, progress)
+                        for start, end in bounds]
+            for job in jobs:
+                job.result()
+        except (requests.RequestException, socket.error, IOError) as e:
+            log.warning("segmented download of {} failed ({}), resuming it "
+                        "in a single stream".format(url, e))
+            with open(part_path, 'r+b') as f:
+                f.truncate(progress.get(0, 0))
+            return None
+        except Exception:
+            os.unlink(part_path)
+            raise
+        try:
+            hasher = hashlib.sha256()
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+        except Exception:
+            os.unlink(part_path)
+            raise
+        return hasher.hexdigest()
+
+    def _download_segment(self, url, part_path, start, end, response=None,
+                          throttle=None, progress=None):
+        """Download the bytes start to end (inclusive) of a segment.
+
+        The offset reached is recorded in progress, keyed by start.
+        """
+        progress = progress if progress is not None else {}
+        offset = start
+        with open(part_path, 'r+b') as f:
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                try:
+                    if response is None:
+                        response = self.session.get(
+                            url, stream=True, timeout=HTTP_TIMEOUT,
+                            headers={'Range': 'bytes={}-{}'.format(offset,
+                                                                   end)})
+                        if response.status_code != 206:
+                            response.raise_for_status()
+                            raise IOError("{}: unexpected status {} for a "
+                                          "range request".format(
+                                              url, response.status_code))
+                    f.seek(offset)
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - offset]
+                        f.write(chunk)
+                        offset += len(chunk)
+                        progress[start] = offset
+                        if throttle is not None:
+                            throttle(len(chunk))
+                    if offset == end + 1:
+                        return
+                    raise IOError("{}: segment {}-{} ended at {}".format(
+                        url, start, end, offset))
+                except (requests.RequestException, socket.error,
+                        IOError) as e:
+                    if attempt == DOWNLOAD_RETRIES:
+                        raise
+                    log.warning("download of {} interrupted ({}), "
+                                "resuming".format(url, e))
+                finally:
+                    if response is not None:
+                        response.close()
+                        response = None
+                        response = None
+
+    def prune(self, max_bytes, max_part_age=STAGING_PART_MAX_AGE):
+        """Remove least recently used blobs beyond max_bytes.
+
+        Partial downloads count towards max_bytes as well and are removed
+        once they were not resumed for max_part_age, lock files once their
+        blob is gone. Files of blobs being downloaded are kept.
+
+        :param int max_bytes: Maximum total size of blobs and partial
+                              downloads.
+        :param int max_part_age: Age in seconds of stale partial downloads.
+        """
+        now = time.time()
+        files = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            sha256, _, suffix = name.partition('.')
+            if suffix not in ('', 'part') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            if suffix == 'part' and now - stat.st_mtime > max_part_age:
+                log.info("removing stale partial download {} from staging "
+                         "cache".format(path))
+                self._remove(sha256, path)
+                continue
+            files.append((stat.st_mtime, stat.st_size, sha256, path))
+        total = sum(size for _, size, _, _ in files)
+        for _, size, sha256, path in sorted(files):
+            if total <= max_bytes:
+                break
+            log.info("removing {} from staging cache".format(path))
+            if self._remove(sha256, path):
+                total -= size
+        for name in os.listdir(self.path):
+            sha256, _, suffix = name.partition('.')
+            blob_path = self.blob_path(sha256)
+            if (suffix == 'lock' and not os.path.exists(blob_path) and
+                    not os.path.exists(blob_path + '.part')):
+                self._remove(sha256, blob_path + '.lock')
+
+    def _remove(self, sha256, path):
+        """Remove a file of a blob unless the blob is being downloaded.
+
+        :returns: Whether the file was removed.
+        :rtype: bool
+        """
+        with open(self.blob_path(sha256) + '.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                log.debug("{} is in use, not removing it".format(path))
+                return False
+            os.unlink(path)
+        return True
+
+
+class StagedContentSource(object):
+    """Content source serving an image from the staging cache.
+
+    The image is fetched into the cache when the source is opened.
+
+    :param cache: Cache to take the image from.
+    :type cache: StagingCache
+    :param str url: Upstream URL of the image.
+    :param str sha256: Expected checksum of the image.
+    :param int size: Expected size of the image if known.
+    :param int segments: Number of parallel range requests to download the
+                         image with.
+    :param throttle: Callable(nbytes) to account downloaded bytes to.
+    """
+
+    def __init__(self, cache, url, sha256, size=None, segments=1,
+                 throttle=None):
+        self.cache = cache
+        self.url = url
+        self.sha256 = sha256
+        self.size = size
+        self.segments = segments
+        self.throttle = throttle
+        self.fd = None
+
+    def open(self):
+        if self.fd is None:
+            self.fd = open(self.cache.get(self.url, self.sha256, self.size,
+                                          self.segments, self.throttle),
+                           'rb')
+
+    def read(self, size=-1):
+        self.open()
+        return self.fd.read(size)
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, etype, value, trace):
+        self.close()
+
+
+class StreamingImageData(object):
+    """File-like object streaming an image from upstream into glance.
+
+    A background thread reads the content source into a bounded in-memory
+    queue while glance consumes it, hashing the content on the fly. The
+    checksum is verified before the final (empty) read, so a corrupted image
+    fails its upload instead of becoming active.
+
+    :param contentsource: Content source to read the image from.
+    :param str sha256: Expected checksum of the image.
+    :param int size: Expected size of the image if known.
+    """
+
+    def __init__(self, contentsource, sha256, size=None):
+        self.contentsource = contentsource
+        self.sha256 = sha256
+        self.size = size
+        self.queue = queue.Queue(maxsize=STREAMING_BUFFER_CHUNKS)
+        self.buffer = b''
+        self.eof = False
+        self.closed = threading.Event()
+        self.thread = None
+
+    def _produce(self):
+        hasher = hashlib.sha256()
+        try:
+            with self.contentsource as source:
+                while not self.closed.is_set():
+                    chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    self._put(chunk)
+            digest = hasher.hexdigest()
+            if digest != self.sha256:
+                raise ChecksumMismatch(
+                    "{}: expected sha256 {}, got {}".format(
+                        self.contentsource.url, self.sha256, digest))
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # Give up once the consumer has gone away rather than block forever
+        # on a full queue.
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._produce)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _fill(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        if item is None:
+            self.eof = True
+        else:
+            self.buffer += item
+
+    def read(self, size=-1):
+        self.start()
+        while not self.eof and (size is None or size < 0 or
+                                len(self.buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(DOWNLOAD_CHUNK_SIZE), b'')
+
+    def close(self):
+        self.closed.set()
+
+
+class StreamingImages(object):
+    """Proxy of a glance client's images manager for streaming uploads.
+
+    GlanceMirror uploads images by opening the path returned from its
+    download_image() method. For streamed images that path is an empty
+    placeholder and the upload is fed from the StreamingImageData
+    registered for it instead.
+
+    :param images: Images manager of a glance client.
+    :param dict streams: StreamingImageData by placeholder path.
+    """
+
+    def __init__(self, images, streams):
+        self.images = images
+        self.streams = streams
+
+    def upload(self, image_id, image_data, *args, **kwargs):
+        stream = self.streams.pop(getattr(image_data, 'name', None), None)
+        if stream is None:
+            return self.images.upload(image_id, image_data, *args, **kwargs)
+        image_data.close()
+        try:
+            return self.images.upload(image_id, stream, *args, **kwargs)
+        except Exception:
+            log.error("streaming upload of image {} failed, "
+                      "deleting it".format(image_id))
+            self.images.delete(image_id)
+            raise
+        finally:
+            stream.close()
+
+    def __getattr__(self, name):
+        return getattr(self.images, name)
+
+
+class StreamingGlanceClient(object):
+    """Proxy of a glance client replacing its images manager."""
+
+    def __init__(self, client, streams):
+        self.client = client
+        self.images = StreamingImages(client.images, streams)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def enable_streaming_upload(writer, reader, tmpdir=None):
+    """Make a GlanceMirror stream images into glance.
+
+    Images are piped from upstream into the glance upload instead of being
+    downloaded to a temporary file first. Items without a sha256 in their
+    product metadata are still downloaded as before.
+
+    :param writer: GlanceMirror to modify.
+    :param reader: Reader of the mirror the items are synced from.
+    :type reader: HttpMirrorReader
+    :param str tmpdir: Directory for (empty) placeholder files.
+    """
+    streams = {}
+    download_image = writer.download_image
+
+    def streaming_download_image(contentsource, image_stream_data):
+        # GlanceMirror wraps the reader's content sources, so the checksum
+        # is looked up by item path rather than taken from the source.
+        item = {}
+        if contentsource.url.startswith(reader.prefix):
+            item = reader.items.get(contentsource.url[len(reader.prefix):],
+                                    {})
+        sha256 = item.get('sha256')
+        if not sha256:
+            return download_image(contentsource, image_stream_data)
+        size = item.get('size')
+        fd, path = tempfile.mkstemp(dir=tmpdir, suffix='.stream')
+        os.close(fd)
+        streams[path] = StreamingImageData(contentsource, sha256, size)
+        if size is not None:
+            image_stream_data['size'] = size
+        log.debug("streaming {} into glance".format(contentsource.url))
+        return image_stream_data, path
+
+    writer.download_image = streaming_download_image
+    writer.gclient = StreamingGlanceClient(writer.gclient, streams)
+    return writer
+
+
+class GlanceInventory(object):
+    """Index of the glance images of a content id.
+
+    The images are listed once, in pages and filtered by content_id (and
+    owner) on the glance side, and then looked up by product name, version
+    name and checksum without further API calls. Images created, uploaded
+    or deleted through InventoryImages keep the index up to date, so one
+    inventory can be shared by every mirror of a run syncing to the same
+    region and content id.
+
+    :param images: Images manager of a glance client.
+    :param str content_id: Content id of the images to index.
+    :param str owner: Project owning the images if known.
+    """
+
+    def __init__(self, images, content_id, owner=None):
+        self.images = images
+        self.content_id = content_id
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.by_id = None
+        self.by_item = {}
+
+    @staticmethod
+    def item_key(image):
+        return (image.get('product_name'), image.get('version_name'),
+                image.get('checksum'))
+
+    def load(self):
+        """List the images of the content id unless already done."""
+        with self.lock:
+            if self.by_id is not None:
+                return
+            filters = {'content_id': self.content_id}
+            if self.owner:
+                filters['owner'] = self.owner
+            self.by_id = {}
+            for image in self.images.list(filters=filters,
+                                          page_size=GLANCE_PAGE_SIZE):
+                self._add(image)
+            log.info("{} images of {} in glance".format(
+                len(self.by_id), self.content_id))
+
+    def _add(self, image):
+        self._remove(image['id'])
+        self.by_id[image['id']] = image
+        self.by_item[self.item_key(image)] = image
+
+    def _remove(self, image_id):
+        image = self.by_id.pop(image_id, None)
+        if image is not None:
+            key = self.item_key(image)
+            if self.by_item.get(key) is image:
+                del self.by_item[key]
+
+    def add(self, image):
+        """Add or replace an image of the content id."""
+        if image.get('content_id') != self.content_id:
+            return
+        self.load()
+        with self.lock:
+            self._add(image)
+
+    def remove(self, image_id):
+        self.load()
+        with self.lock:
+            self._remove(image_id)
+
+    def list(self, **filters):
+        """Return the images matching all filters.
+
+        :rtype: list
+        """
+        self.load()
+        with self.lock:
+            return [image for image in self.by_id.values()
+                    if all(image.get(k) == v for k, v in filters.items())]
+
+    def find(self, product_name, version_name, checksum):
+        """Return the image of an item or None."""
+        self.load()
+        with self.lock:
+            return self.by_item.get((product_name, version_name, checksum))
+
+
+class RetentionStage(object):
+    """Batch of glance image deletes run after the uploads.
+
+    GlanceMirror deletes the images of versions beyond max_items one at a
+    time while it syncs a mirror. Deletes issued within collecting() are
+    queued here by mirror and region instead and run concurrently by
+    prune(), once the uploads of the mirror to the region or of all mirrors
+    are done. The metadata written by
+    GlanceMirror no longer refers to the queued images.
+
+    :param int concurrency: Maximum number of deletes run at the same time.
+    :param report: Report to account the pruning to.
+    :type report: SyncReport
+    """
+
+    def __init__(self, concurrency, report):
+        self.concurrency = max(1, concurrency)
+        self.report = report
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # (images manager, image id) to delete by (mirror, region).
+        self.pending = {}
+
+    @contextlib.contextmanager
+    def collecting(self, mirror, region=None):
+        """Queue the image deletes of the calling thread for mirror.
+
+        :param str mirror: Mirror the deletes are accounted to.
+        :param str region: Region of the glance the images are deleted from.
+        """
+        self.local.queue = (mirror, region)
+        try:
+            yield
+        finally:
+            self.local.queue = None
+
+    def collect(self, images, image_id):
+        """Queue a delete if called within collecting().
+
+        :returns: Whether the delete was queued.
+        :rtype: bool
+        """
+        key = getattr(self.local, 'queue', None)
+        if key is None:
+            return False
+        log.debug("queueing delete of image {}".format(image_id))
+        with self.lock:
+            self.pending.setdefault(key, []).append((images, image_id))
+        return True
+
+    def prune(self, queues=None):
+        """Delete the queued images of queues, of all queues if None.
+
+        :param queues: (mirror, region) queues to prune.
+        :type queues: None | list[tuple[str, str]]
+        :returns: The first error of every queue whose deletes failed.
+        :rtype: dict[tuple[str, str], Exception]
+        """
+        with self.lock:
+            if queues is None:
+                queues = list(self.pending)
+            deletes = [(key, images, image_id) for key in queues
+                       for images, image_id in self.pending.pop(key, [])]
+        errors = {}
+        if not deletes:
+            return errors
+        log.info("pruning {} image(s)".format(len(deletes)))
+        with futures.ThreadPoolExecutor(
+                max_workers=min(self.concurrency, len(deletes))) as executor:
+            jobs = [(key, image_id, executor.submit(
+                self._delete, key[0], images, image_id))
+                for key, images, image_id in deletes]
+        for key, image_id, job in jobs:
+            try:
+                job.result()
+            except Exception as e:
+                log.error("could not delete image {}: {}".format(
+                    image_id, e))
+                errors.setdefault(key, e)
+        return errors
+
+    def _delete(self, mirror, images, image_id):
+        with self.report.phase('retention', mirror):
+            images.delete(image_id)
+        self.report.count('images_pruned', mirror=mirror)
+
+
+class InventoryImages(object):
+    """Proxy of a glance client's images manager backed by an inventory.
+
+    Listings of all images and listings filtered by the inventory's content
+    id are answered from the inventory instead of glance.
+
+    :param images: Images manager of a glance client.
+    :param inventory: Inventory of the content id synchronised.
+    :type inventory: GlanceInventory
+    :param retention: Stage to queue deletes in.
+    :type retention: None | RetentionStage
+    """
+
+    def __init__(self, images, inventory, retention=None):
+        self.images = images
+        self.inventory = inventory
+        self.retention = retention
+
+    def list(self, **kwargs):
+        filters = dict(kwargs.get('filters') or {})
+        content_id = filters.get('content_id', self.inventory.content_id)
+        if (set(kwargs) - {'filters', 'page_size'} or
+                content_id != self.inventory.content_id):
+            return self.images.list(**kwargs)
+        if 'content_id' not in filters:
+            # The caller filters the images of other content ids itself.
+            return self.inventory.list()
+        return self.inventory.list(**filters)
+
+    def create(self, **kwargs):
+        image = self.images.create(**kwargs)
+        self.inventory.add(image)
+        return image
+
+    def upload(self, image_id, *args, **kwargs):
+        result = self.images.upload(image_id, *args, **kwargs)
+        # The checksum is only known to glance once the data is uploaded.
+        self.inventory.add(self.images.get(image_id))
+        return result
+
+    def update(self, image_id, *args, **kwargs):
+        image = self.images.update(image_id, *args, **kwargs)
+        self.inventory.add(image)
+        return image
+
+    def delete(self, image_id, *args, **kwargs):
+        if (self.retention is not None and
+                self.retention.collect(self, image_id)):
+            return None
+        result = self.images.delete(image_id, *args, **kwargs)
+        self.inventory.remove(image_id)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.images, name)
+
+
+class InventoryGlanceClient(object):
+    """Proxy of a glance client replacing its images manager."""
+
+    def __init__(self, client, inventory, retention=None):
+        self.client = client
+        self.images = InventoryImages(client.images, inventory, retention)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class MeteredContentSource(object):
+    """Content source wrapper accounting reads as the download phase.
+
+    :param source: Content source to wrap.
+    :param report: Report to add timings and byte counts to.
+    :type report: SyncReport
+    :param str mirror: Mirror to account the download to.
+    """
+
+    def __init__(self, source, report, mirror):
+        self.source = source
+        self.report = report
+        self.mirror = mirror
+
+    def read(self, size=-1):
+        with self.report.phase('download', self.mirror):
+            data = self.source.read(size)
+        self.report.count('bytes_downloaded', len(data), self.mirror)
+        return data
+
+    def __enter__(self):
+        with self.report.phase('download', self.mirror):
+            self.source.__enter__()
+        return self
+
+    def __exit__(self, etype, value, trace):
+        return self.source.__exit__(etype, value, trace)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
+class HttpMirrorReader(object):
+    """Mirror reader backed by a shared HTTP session.
+
+    Provides the reader interface GlanceMirror.sync() expects from
+    simplestreams.mirrors.UrlMirrorReader, but every mirror of a run shares
+    one connection pool instead of opening new connections per file.
+
+    :param str prefix: Base URL of the mirror.
+    :param session: HTTP session to fetch content with.
+    :type session: :class: `requests.Session`
+    :param policy: Callable(content, path) returning the payload of a
+                   (possibly signed) metadata document.
+    :param staging_cache: Cache to serve items with a known sha256 from.
+    :type staging_cache: None | StagingCache
+    :param report: Report to account metadata and image downloads to.
+    :type report: None | SyncReport
+    :param str mirror: Mirror to account downloads to in report.
+    :param int segments: Number of parallel range requests to download
+                         images from the staging cache with.
+    :param throttle: Callable(nbytes) to account downloaded bytes to.
+    :param priority: Order to hand products to the mirror writer in.
+    :type priority: None | TransferPriority
+    :param item_filters: Filters items failing them are dropped with as
+                         soon as a products document is parsed.
+    :type item_filters: None | ItemFilterSet
+
+    on_products, if set, is called with every products document read.
+    """
+
+    def __init__(self, prefix, session, policy, staging_cache=None,
+                 report=None, mirror=None, segments=1, throttle=None,
+                 priority=None, item_filters=None):
+        if not prefix.endswith('/'):
+            prefix += '/'
+        self.prefix = prefix
+        self.session = session
+        self.policy = policy
+        self.staging_cache = staging_cache
+        self.report = report
+        self.mirror = mirror
+        self.segments = segments
+        self.throttle = throttle
+        self.priority = priority
+        self.item_filters = item_filters
+        self.on_products = None
+        # sha256 and size of the items of the product documents read so
+        # far, by item path.
+        self.items = {}
+
+    def source(self, path):
+        source = self._source(path)
+        if self.report is not None:
+            return MeteredContentSource(source, self.report, self.mirror)
+        return source
+
+    def _source(self, path):
+        item = self.items.get(path, {})
+        if self.staging_cache is not None and item.get('sha256'):
+            return StagedContentSource(self.staging_cache,
+                                       self.prefix + path,
+                                       item['sha256'], item.get('size'),
+                                       self.segments, self.throttle)
+        return HttpContentSource(self.session, self.prefix + path,
+                                 item.get('sha256'), item.get('size'),
+                                 self.throttle)
+
+    def read_json(self, path):
+        start = time.time()
+        with self._source(path) as source:
+            raw = source.read().decode('utf-8')
+        payload = self.policy(content=raw, path=path)
+        if self.report is not None:
+            self.report.add_time('metadata_fetch', time.time() - start,
+                                 self.mirror)
+        products = json.loads(payload)
+        if 'products' not in products:
+            return raw, payload
+        dropped = 0
+        if self.item_filters is not None:
+            # The mirror writer filters items as well, but never sees
+            # those of products and versions dropped here.
+            dropped = self.item_filters.filter_products(products)
+            log.debug("{}: {} items filtered out".format(path, dropped))
+        self.register_items(products)
+        if self.on_products is not None:
+            self.on_products(products)
+        if self.priority is not None:
+            # The mirror writer transfers products in document order.
+            products = self.priority.sort_products(products)
+        if dropped or self.priority is not None:
+            payload = json.dumps(products)
+        return raw, payload
+
+    def register_items(self, products):
+        """Remember checksums of the items of a products document."""
+        for product in products.get('products', {}).values():
+            for version in product.get('versions', {}).values():
+                for item in version.get('items', {}).values():
+                    if 'path' in item:
+                        self.items[item['path']] = {
+                            'sha256': item.get('sha256'),
+                            'size': item.get('size'),
+                        }
+
+    def load_products(self, path=None, content_id=None):
+        _, payload = self.read_json(path)
+        return json.loads(payload)
+
+
+class SharedKeystoneClient(object):
+    """Keystone helper for GlanceMirror sharing one authentication.
+
+    GlanceMirror looks up its Glance endpoint and token through a
+    simplestreams.openstack compatible object. Caching the service
+    connection info means all mirrors synced by an engine reuse a single
+    token instead of authenticating once per mirror.
+
+    The engine still authenticates once per run: simplestreams builds its
+    own keystone session from the credentials in the environment, the
+    token cache of get_cached_keystone_client is not used here.
+    """
+
+    def __init__(self):
+        self._conn_info = {}
+        self._lock = threading.Lock()
+
+    def load_keystone_creds(self, **kwargs):
+        return ss_openstack.load_keystone_creds(**kwargs)
+
+    def get_service_conn_info(self, service='image', **kwargs):
+        key = (service, kwargs.get('region_name'))
+        with self._lock:
+            if key not in self._conn_info:
+                self._conn_info[key] = ss_openstack.get_service_conn_info(
+                    service, **kwargs)
+            return copy.deepcopy(self._conn_info[key])
+
+
+class SignatureVerifier(object):
+    """Verify signed documents, remembering the outcome across runs.
+
+    gpg is run once per distinct signed document and keyring: documents
+    verified before, by this or an earlier run, are only stripped of their
+    signature. Entries are keyed by the sha256 of the document and of the
+    keyring file, which is read once per run, so a changed keyring
+    verifies everything again. Failed verifications are not remembered.
+
+    :param str path: File to persist verified entries in.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or SIGNATURE_CACHE_FILE_NAME
+        self.lock = threading.Lock()
+        self.keyrings = {}
+        self.verified = collections.OrderedDict()
+        self.changed = False
+        try:
+            with open(self.path) as f:
+                for key in json.load(f):
+                    self.verified[key] = True
+        except (IOError, OSError, ValueError) as e:
+            log.debug("no usable signature cache: {}".format(e))
+
+    def _keyring_digest(self, keyring):
+        with self.lock:
+            if keyring not in self.keyrings:
+                hasher = hashlib.sha256()
+                with open(keyring, 'rb') as f:
+                    for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE),
+                                      b''):
+                        hasher.update(chunk)
+                self.keyrings[keyring] = hasher.hexdigest()
+            return self.keyrings[keyring]
+
+    def read_signed(self, content, keyring):
+        """Verify a signed document and return its payload.
+
+        :param str content: The signed document.
+        :param str keyring: Keyring to verify the signature with.
+        :rtype: str
+        :raises: The errors of simplestreams.util.read_signed.
+        """
+        key = hashlib.sha256('{}\n{}'.format(
+            self._keyring_digest(keyring), content).encode('utf-8')
+        ).hexdigest()
+        with self.lock:
+            verified = key in self.verified
+        if verified:
+            return ss_util.read_signed(content, keyring=keyring,
+                                       checked=False)
+        payload = ss_util.read_signed(content, keyring=keyring)
+        with self.lock:
+            self.verified[key] = True
+            while len(self.verified) > SIGNATURE_CACHE_SIZE:
+                self.verified.popitem(last=False)
+            self.changed = True
+        return payload
+
+    def save(self):
+        """Atomically persist the verified entries for the next runs."""
+        with self.lock:
+            if not self.changed:
+                return
+            keys = list(self.verified)
+            self.changed = False
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_file_name = self.path + '.tmp'
+        with open(tmp_file_name, 'w') as f:
+            json.dump(keys, f)
+        os.rename(tmp_file_name, self.path)
+
+
+class NativeSyncEngine(object):
+    """Synchronise mirrors in-process with the simplestreams library.
+
+    Instead of starting sstream-mirror-glance from the snap for every
+    mirror, the mirror reader and GlanceMirror writer are driven directly.
+    One engine is shared by all mirrors of a run.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :param session: HTTP session to fetch upstream content with.
+    :type session: :class: `requests.Session`
+    :param report: Report to account the phases of every mirror to.
+    :type report: None | SyncReport
+    """
+
+    def __init__(self, charm_conf, session, report=None):
+        self.session = session
+        self.report = report if report is not None else SyncReport()
+        self.keystone = SharedKeystoneClient()
+        self.staging_cache = None
+        self.staging_cache_size = int(
+            charm_conf.get('staging_cache_size') or 0) * 1024 ** 3
+        self.streaming_upload = bool(charm_conf.get('streaming_upload'))
+        self.bandwidth = get_bandwidth_scheduler(charm_conf)
+        self.retention = RetentionStage(
+            int(charm_conf.get('retention_concurrency') or 1), self.report)
+        self.verifier = SignatureVerifier()
+        # Item paths accounted as bytes_planned by mirror, see
+        # count_planned.
+        self.planned = set()
+        self.planned_lock = threading.Lock()
+        self.deferred_retention = (
+            charm_conf.get('retention_mode') == 'deferred')
+        # GlanceInventory by region and content id.
+        self.inventories = {}
+        self.inventories_lock = threading.Lock()
+        self.tmpdir = None
+        peers = charm_conf.get('peer_caches') or []
+        segmented = any(get_download_segments(mirror_info) > 1
+                        for mirror_info in charm_conf.get('mirror_list', []))
+        if len(get_target_regions(charm_conf)) > 1 or segmented:
+            # Every region reads images from the staging cache so that
+            # they are only downloaded once and segmented downloads are
+            # assembled there, use a cache for this run only if none is
+            # configured.
+            if self.streaming_upload:
+                log.warning("streaming_upload is not used when syncing to "
+                            "several regions or with download_segments")
+                self.streaming_upload = False
+            if self.staging_cache_size:
+                self.staging_cache = StagingCache(STAGING_CACHE_DIR, session,
+                                                  peers)
+            else:
+                self.tmpdir = tempfile.mkdtemp(dir=os.environ.get('HOME'))
+                self.staging_cache = StagingCache(
+                    os.path.join(self.tmpdir, 'blobs'), session, peers)
+        elif self.streaming_upload and self.staging_cache_size:
+            log.warning("streaming_upload is enabled, images are not kept "
+                        "in the staging cache")
+        elif self.staging_cache_size:
+            self.staging_cache = StagingCache(STAGING_CACHE_DIR, session,
+                                              peers)
+
+    @staticmethod
+    def is_available():
+        """Whether the simplestreams python library can be imported."""
+        return ss_glance is not None
+
+    def get_policy(self, keyring):
+        """Return a reader policy verifying signed documents."""
+        def policy(content, path):
+            if path.endswith('sjson'):
+                return self.verifier.read_signed(content, keyring)
+            return content
+        return policy
+
+    def get_inventory(self, writer, options):
+        """Return the glance inventory shared by the mirrors of a run."""
+        key = (options['region'], options['content_id'])
+        with self.inventories_lock:
+            if key not in self.inventories:
+                self.inventories[key] = GlanceInventory(
+                    writer.gclient.images, options['content_id'],
+                    getattr(writer, 'tenant_id', None))
+            return self.inventories[key]
+
+    def get_inventory_snapshot(self, region_name, content_id):
+        """Return the images of a loaded inventory or None."""
+        inventory = self.inventories.get((region_name, content_id))
+        if inventory is None or inventory.by_id is None:
+            return None
+        return inventory.list()
+
+    def get_objectstore(self, options):
+        if options['output_swift']:
+            return ss_swift.SwiftObjectStore(options['output_swift'],
+                                             region=options['region'])
+        return ss_objectstores.FileStore(options['output_dir'])
+
+    def get_writer(self, options, mirror=None):
+        """Return a GlanceMirror for options backed by the shared inventory.
+
+        :param dict options: Sync options as returned by get_mirror_options.
+        :param str mirror: Mirror to account the metadata writes to.
+        """
+        mirror_config = {
+            'max_items': options['max_items'],
+            'keep_items': options['keep_items'],
+            'cloud_name': options['cloud_name'],
+            'content_id': options['content_id'],
+            'item_filters': options['item_filters'],
+            'hypervisor_mapping': options['hypervisor_mapping'],
+            'custom_properties': options['custom_properties'],
+            'visibility': options['visibility'],
+            'image_import_conversion': options['image_import_conversion'],
+            # See update_latest_property.
+            'set_latest_property': False,
+        }
+        writer = ss_glance.GlanceMirror(
+            config=mirror_config,
+            objectstore=instrument(self.get_objectstore(options),
+                                   ['insert_content'], self.report,
+                                   'metadata_write', mirror),
+            region=options['region'],
+            name_prefix=options['name_prefix'],
+            client=self.keystone)
+        writer.gclient = InventoryGlanceClient(
+            writer.gclient, self.get_inventory(writer, options),
+            self.retention)
+        return writer
+
+    def sync(self, options):
+        """Synchronise a single mirror.
+
+        :param dict options: Sync options as returned by get_mirror_options.
+        """
+        mirror_url, path = ss_util.path_from_mirror_url(
+            options['source_mirror'], options['path'])
+        mirror = get_mirror_state_key(options)
+        throttle = None
+        if self.bandwidth is not None:
+            throttle = functools.partial(self.bandwidth.consume, mirror,
+                                         weight=options['bandwidth_weight'])
+        reader = HttpMirrorReader(mirror_url, self.session,
+                                  self.get_policy(options['keyring']),
+                                  self.staging_cache, self.report, mirror,
+                                  options['download_segments'], throttle,
+                                  get_transfer_priority(options),
+                                  ItemFilterSet(options['item_filters']))
+        writer = self.get_writer(options, mirror)
+        inventory = writer.gclient.images.inventory
+        reader.on_products = functools.partial(
+            self.count_planned, mirror, options['max_items'], inventory)
+        remove_item = writer.remove_item
+
+        def queueing_remove_item(*args, **kwargs):
+            with self.retention.collecting(mirror, options['region']):
+                return remove_item(*args, **kwargs)
+
+        writer.remove_item = queueing_remove_item
+        if self.streaming_upload:
+            enable_streaming_upload(writer, reader, options['output_dir'])
+        instrument(writer.gclient.images, ['upload'], self.report, 'upload',
+                   mirror, counter='images_uploaded')
+        log.info("syncing {} to region {} in-process".format(
+            mirror_url, options['region']))
+        writer.sync(reader, path)
+        if not self.deferred_retention:
+            # Other regions of the mirror may still be syncing.
+            key = (mirror, options['region'])
+            errors = self.retention.prune([key])
+            if errors:
+                raise errors[key]
+
+    def write_metadata(self, options):
+        """Write the product metadata of a content id from glance.
+
+        :param dict options: Sync options of a mirror of the content id.
+        """
+        writer = self.get_writer(options)
+        writer.insert_products(options['path'], writer.load_products(),
+                               None)
+
+    def count_planned(self, mirror, max_items, inventory, products):
+        """Account the items of products missing from glance as planned.
+
+        Every region uploads the items, but they are only downloaded once
+        and not at all if found in the staging cache, see SyncProgress.
+        """
+        images = nbytes = 0
+        for product_name, product in products.get('products', {}).items():
+            versions = product.get('versions', {})
+            for version_name in sorted(versions, reverse=True)[:max_items]:
+                for item in versions[version_name].get('items',
+                                                       {}).values():
+                    if inventory.find(product_name, version_name,
+                                      item.get('md5')) is not None:
+                        continue
+                    images += 1
+                    with self.planned_lock:
+                        if (mirror, item.get('path')) in self.planned:
+                            continue
+                        self.planned.add((mirror, item.get('path')))
+                    if (self.staging_cache is not None and item.get(
+                            'sha256') and os.path.exists(
+                                self.staging_cache.blob_path(
+                                    item['sha256']))):
+                        continue
+                    nbytes += int(item.get('size') or 0)
+        self.report.count('images_planned', images, mirror)
+        self.report.count('bytes_planned', nbytes, mirror)
+
+    def close(self):
+        """Release resources held for the run."""
+        try:
+            self.verifier.save()
+        except (IOError, OSError) as e:
+            log.warning("could not save the signature cache: {}".format(e))
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir)
+            self.tmpdir = None
+        elif self.staging_cache is not None:
+            self.staging_cache.prune(self.staging_cache_size)
+
+
+def strip_signature(content):
+    """Return the payload of a clearsigned document.
+
+    The signature is not verified, use this only where the payload is not
+    trusted (e.g. to find out which files a signed index refers to).
+
+    :param str content: A clearsigned or unsigned document.
+    :rtype: str
+    """
+    if not content.startswith('-----BEGIN PGP SIGNED MESSAGE-----'):
+        return content
+    lines = content.splitlines()
+    # Armor headers (e.g. "Hash: SHA512") end with the first empty line.
+    start = lines.index('') + 1
+    end = lines.index('-----BEGIN PGP SIGNATURE-----')
+    # Undo dash-escaping of lines starting with a dash.
+    payload = [line[2:] if line.startswith('- ') else line
+               for line in lines[start:end]]
+    return '\n'.join(payload) + '\n'
+
+
+def get_url_validator(session, url):
+    """Return a value that changes whenever the content of a URL changes.
+
+    :param session: HTTP session to use.
+    :type session: :class: `requests.Session`
+    :param str url: URL to check.
+    :returns: ETag, Last-Modified and Content-Length or None if the server
+              provides neither an ETag nor a Last-Modified header.
+    :rtype: None | str
+    """
+    response = session.head(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not (etag or last_modified):
+        return None
+    return '{} {} {}'.format(etag, last_modified,
+                             response.headers.get('Content-Length'))
+
+
+def get_mirror_fingerprint(session, options):
+    """Fingerprint the upstream state of a mirror.
+
+    The fingerprint covers the content of the stream index, the validators
+    (ETag/Last-Modified) of every product file it refers to and the sync
+    options, so it changes whenever a sync could have a different outcome.
+
+    :param session: HTTP session to use.
+    :type session: :class: `requests.Session`
+    :param dict options: Sync options as returned by get_mirror_options.
+    :returns: The fingerprint or None if it could not be determined.
+    :rtype: None | str
+    """
+    base_url = options['source_mirror']
+    if not base_url.endswith('/'):
+        base_url += '/'
+    try:
+        response = session.get(base_url + options['path'],
+                               timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        index = json.loads(strip_signature(response.text))
+        products = {}
+        for entry in index.get('index', {}).values():
+            path = entry['path']
+            validator = get_url_validator(session, base_url + path)
+            if validator is None:
+                log.debug("no validator for {}, cannot fingerprint "
+                          "mirror".format(path))
+                return None
+            products[path] = validator
+    except (requests.RequestException, ValueError, KeyError) as e:
+        log.warning("could not fingerprint {}: {}".format(base_url, e))
+        return None
+
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps({
+        'index': hashlib.sha256(response.content).hexdigest(),
+        'products': products,
+        'options': options,
+    }, sort_keys=True).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def get_mirror_state_key(options):
+    """Key identifying a mirror in the persisted sync state."""
+    return ' '.join([options['source_mirror'] + options['path']] +
+                    options['item_filters'])
+
+
+def load_sync_state():
+    """Load the state persisted by previous runs.
+
+    :rtype: dict
+    """
+    try:
+        with open(SYNC_STATE_FILE_NAME) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.debug("no usable sync state: {}".format(e))
+        return {}
+
+
+def save_sync_state(state):
+    """Atomically persist state for the next runs.
+
+    :param dict state: State to persist.
+    """
+    if not os.path.isdir(STATE_DIR):
+        os.makedirs(STATE_DIR)
+    tmp_file_name = SYNC_STATE_FILE_NAME + '.tmp'
+    with open(tmp_file_name, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_file_name, SYNC_STATE_FILE_NAME)
+
+
+def sync_region(options, sstream_mirror_env, engine=None):
+    """Synchronise a single mirror to a single region.
+
+    :param dict options: Sync options as returned by get_mirror_options.
+    :param dict sstream_mirror_env: Environment for sstream-mirror-glance.
+    :param engine: In-process engine to use instead of sstream-mirror-glance.
+    :type engine: None | NativeSyncEngine
+    :raises: :class: `subprocess.CalledProcessError`
+    """
+    if engine is not None:
+        engine.sync(options)
+        return
+    sync_command = build_sync_command(options)
+    env = dict(sstream_mirror_env, OS_REGION_NAME=options['region'])
+    log.info("calling sstream-mirror-glance")
+    log.debug("command: %s", " ".join(sync_command))
+    log.debug("sstream-mirror environment: %s", env)
+    subprocess.check_call(sync_command, env=env)
+
+
+def sync_regions(region_options, sstream_mirror_env, engine=None):
+    """Synchronise a single mirror to several regions at the same time.
+
+    A failure in one region does not stop the others.
+
+    :param region_options: Sync options for every region as returned by
+                           get_mirror_options.
+    :type region_options: list[dict]
+    :param dict sstream_mirror_env: Environment for sstream-mirror-glance.
+    :param engine: In-process engine to use instead of sstream-mirror-glance.
+    :type engine: None | NativeSyncEngine
+    :raises: The first error if any region failed.
+    """
+    if len(region_options) == 1:
+        sync_region(region_options[0], sstream_mirror_env, engine)
+        return
+    with futures.ThreadPoolExecutor(
+            max_workers=len(region_options)) as executor:
+        jobs = [(o['region'], executor.submit(
+            sync_region, o, sstream_mirror_env, engine))
+            for o in region_options]
+    errors = []
+    for region_name, job in jobs:
+        try:
+            job.result()
+        except Exception as e:
+            log.error("Sync of {} to region {} failed: {}".format(
+                region_options[0]['source_mirror'], region_name, e))
+            errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+def sync_mirror(charm_conf, mirror_info, sstream_mirror_env, engine=None,
+                fingerprints=None, session=None, report=None,
+                publisher=None):
+    """Synchronise a single mirror from the mirror list.
+
+    The mirror is synced to all target regions (see get_target_regions) at
+    the same time. With the native engine every image is only downloaded
+    once for all regions, through the engine's staging cache.
+
+    If a fingerprints dict is passed, the mirror is skipped when its
+    upstream fingerprint matches the one recorded by the last successful
+    sync, and the new fingerprint is recorded once the sync succeeded.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :param dict mirror_info: An entry of charm_conf['mirror_list'].
+    :param dict sstream_mirror_env: Environment for sstream-mirror-glance.
+    :param engine: In-process engine to use instead of sstream-mirror-glance.
+    :type engine: None | NativeSyncEngine
+    :param fingerprints: Fingerprints of successfully synced mirrors.
+    :type fingerprints: None | dict[str, str]
+    :param session: HTTP session used to fingerprint the mirror.
+    :type session: None | :class: `requests.Session`
+    :param report: Report to record the phases and outcome of the sync in.
+    :type report: None | SyncReport
+    :param publisher: Publisher of the metadata written to the output
+                      directory of the charm's region.
+    :type publisher: None | LocalStreamsPublisher
+    :returns: False if the mirror was skipped, True otherwise.
+    :rtype: bool
+    :raises: :class: `subprocess.CalledProcessError`, the first error if
+             several regions failed.
+    """
+    # NOTE: sstream-mirror-glance has no option to set the user agent,
+    #       charm_conf['user_agent'] is only honoured by NativeSyncEngine.
+
+    if report is None:
+        report = SyncReport()
+
+    # NOTE: output directory must be under HOME
+    #       or snap cannot access it for stream files
+    tmpdir = tempfile.mkdtemp(dir=os.environ['HOME'])
+    mirror = None
+    try:
+        log.info("Configuring sync for url {}".format(mirror_info))
+        regions = get_target_regions(charm_conf)
+        region_options = []
+        for region_name in regions:
+            output_dir = tmpdir
+            if len(regions) > 1:
+                output_dir = os.path.join(tmpdir, region_name)
+                os.mkdir(output_dir)
+            region_options.append(get_mirror_options(
+                charm_conf, mirror_info, output_dir, region_name))
+        options = region_options[0]
+        state_key = mirror = get_mirror_state_key(options)
+
+        fingerprint = None
+        if fingerprints is not None:
+            # output_dir is a new temporary directory on every run,
+            # download_segments, bandwidth_weight and transfer_priority do
+            # not change the outcome of a sync.
+            with report.phase('fingerprint', mirror):
+                fingerprint = get_mirror_fingerprint(
+                    session, dict(options, output_dir=None, regions=regions,
+                                  download_segments=None,
+                                  bandwidth_weight=None,
+                                  transfer_priority=None))
+            if fingerprint and fingerprints.get(state_key) == fingerprint:
+                log.info("{} is unchanged since the last sync, "
+                         "skipping".format(mirror_info['url']))
+                report.set_result(mirror, 'skipped')
+                return False
+
+        with report.phase('sync', mirror):
+            sync_regions(region_options, sstream_mirror_env, engine)
+        if publisher is not None:
+            publisher.add(options['output_dir'])
+
+        if fingerprints is not None:
+            if fingerprint:
+                fingerprints[state_key] = fingerprint
+            else:
+                fingerprints.pop(state_key, None)
+        report.set_result(mirror, 'synced')
+        return True
+    except Exception as e:
+        if mirror is not None:
+            report.set_result(mirror, str(e) or type(e).__name__)
+        raise
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def regenerate_metadata(charm_conf, mirror_info, engine, publisher=None):
+    """Write the product metadata again once all mirrors are done.
+
+    Mirrors share the content id and with it the product metadata, which
+    every mirror writes from the images found in glance when it started
+    and the ones it uploaded itself. Of several mirrors syncing at the same
+    time, the last one to finish thus drops the products the others landed
+    meanwhile, so the metadata is rewritten from the engine's inventory.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :param dict mirror_info: A synced entry of charm_conf['mirror_list'].
+    :param engine: In-process engine the mirrors were synced with.
+    :type engine: NativeSyncEngine
+    :param publisher: Publisher of the metadata written to the output
+                      directory of the charm's region.
+    :type publisher: None | LocalStreamsPublisher
+    """
+    tmpdir = tempfile.mkdtemp(dir=os.environ['HOME'])
+    try:
+        regions = get_target_regions(charm_conf)
+        for region_name in regions:
+            output_dir = os.path.join(tmpdir, region_name)
+            os.mkdir(output_dir)
+            engine.write_metadata(get_mirror_options(
+                charm_conf, mirror_info, output_dir, region_name))
+        if publisher is not None:
+            publisher.add(os.path.join(tmpdir, regions[0]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def do_sync(ksc, charm_conf, force=False, session=None, report=None,
+            metrics=None):
+    """Synchronise all mirrors from the mirror list.
+
+    Mirrors do not depend on each other so, with the native engine, up to
+    charm_conf['mirror_concurrency'] of them are synced at the same time. A
+    failure of one mirror neither cancels nor hides the outcome of the
+    others: every mirror runs to completion before failures are reported.
+    If several mirrors were synced at the same time, the product metadata
+    they share is written once more at the end, see regenerate_metadata.
+    Runs of sstream-mirror-glance share their log file and the metadata
+    they write, so they are never run at the same time.
+
+    With charm_conf['incremental_sync'] set, mirrors whose upstream has not
+    changed since their last successful sync are skipped unless force is
+    set.
+
+    :param ksc: An instance of a Keystone client.
+    :type ksc: :class: `keystoneclient.v3.client.Client`
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :param bool force: Sync all mirrors regardless of upstream changes.
+    :param session: HTTP session to reuse for upstream connections.
+    :type session: None | :class: `requests.Session`
+    :param report: Report to record the phases of the sync in.
+    :type report: None | SyncReport
+    :param metrics: Exporter to update whenever a mirror is done.
+    :type metrics: None | SyncMetrics
+    :returns: Per-mirror results in mirror list order, None on success.
+    :rtype: list[tuple[dict, None | Exception]]
+    :raises: :class: `MirrorSyncError`
+    """
+    region_name = charm_conf['region']
+    mirror_list = charm_conf['mirror_list']
+    if report is None:
+        report = SyncReport()
+
+    # Pass the current process' environment down along with proxy
+    # settings crafted for sstream-mirror-glance.
+    with report.phase('proxy_env'):
+        proxy_env = get_sstream_mirror_proxy_env(
+            ksc, region_name,
+            charm_conf['ignore_proxy_for_object_store'],
+            get_target_regions(charm_conf)[1:],
+        )
+    sstream_mirror_env = dict(os.environ, **proxy_env)
+
+    native = charm_conf.get('sync_engine') == 'native'
+    if native and not NativeSyncEngine.is_available():
+        log.warning("simplestreams python library is not available, "
+                    "falling back to sstream-mirror-glance")
+        native = False
+    concurrency = int(charm_conf.get('mirror_concurrency') or 1)
+    if concurrency > 1 and not native:
+        log.warning("mirror_concurrency is only supported by the native "
+                    "sync engine, syncing one mirror at a time")
+        concurrency = 1
+    max_workers = max(1, min(concurrency, len(mirror_list)))
+    if session is None:
+        session = get_http_session(charm_conf.get('user_agent'),
+                                   max(10, max_workers))
+    elif charm_conf.get('user_agent'):
+        session.headers['User-Agent'] = charm_conf['user_agent']
+
+    engine = None
+    sync_state = None
+    results = []
+    # Upstream metadata and, with the native engine, keystone, glance and
+    # swift are also accessed from this process, so the crafted NO_PROXY
+    # settings need to apply here as well, but only for this run: the sync
+    # daemon runs every sync in the same process.
+    saved_environ = override_environ(proxy_env)
+    try:
+        if native:
+            engine = NativeSyncEngine(charm_conf, session, report)
+
+        publisher = None
+        if (not charm_conf.get('use_swift') and
+                charm_conf.get('local_streams')):
+            publisher = LocalStreamsPublisher(content_ids=[
+                charm_conf['content_id_template'].format(region=region_name)
+                for region_name in get_target_regions(charm_conf)])
+
+        fingerprints = None
+        if charm_conf.get('incremental_sync'):
+            sync_state = load_sync_state()
+            fingerprints = sync_state.setdefault('fingerprints', {})
+            if force:
+                log.info("Forcing sync of all mirrors")
+                fingerprints.clear()
+        log.info("Syncing {} mirror(s), {} at a time".format(
+            len(mirror_list), max_workers))
+
+        synced = []
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Mirrors with a higher priority are started first.
+            submitted = {}
+            for index in sorted(range(len(mirror_list)), key=lambda i: -int(
+                    mirror_list[i].get('priority') or 0)):
+                submitted[index] = executor.submit(
+                    sync_mirror, charm_conf, mirror_list[index],
+                    sstream_mirror_env, engine, fingerprints, session, report,
+                    publisher)
+            jobs = [(mirror_info, submitted[index])
+                    for index, mirror_info in enumerate(mirror_list)]
+            if metrics is not None:
+                for _, job in jobs:
+                    job.add_done_callback(lambda job: metrics.update(report))
+            for mirror_info, job in jobs:
+                try:
+                    job.result()
+                except Exception as e:
+                    log.error("Sync of {} failed: {}".format(
+                        mirror_info['url'], e))
+                    results.append((mirror_info, e))
+                else:
+                    log.info("Sync of {} completed".format(mirror_info['url']))
+                    results.append((mirror_info, None))
+                    if job.result():
+                        synced.append(mirror_info)
+
+        if engine is not None:
+            # Images queued by mirrors with deferred retention.
+            with report.phase('retention'):
+                errors = {}
+                for (mirror, _), e in engine.retention.prune().items():
+                    errors.setdefault(mirror, e)
+            if errors:
+                results = [
+                    (mirror_info, e or errors.get(get_mirror_state_key(
+                        get_mirror_options(charm_conf, mirror_info, None))))
+                    for mirror_info, e in results]
+                for mirror, e in errors.items():
+                    report.set_result(mirror, str(e) or type(e).__name__)
+                    if fingerprints is not None:
+                        fingerprints.pop(mirror, None)
+
+        if engine is not None and len(synced) > 1 and max_workers > 1:
+            with report.phase('metadata'):
+                try:
+                    regenerate_metadata(charm_conf, synced[-1], engine,
+                                        publisher)
+                except Exception as e:
+                    # Mirrors skipped as unchanged would not write it again.
+                    log.error("could not regenerate the streams metadata: "
+                              "{}".format(e))
+                    if fingerprints is not None:
+                        fingerprints.clear()
+
+        if charm_conf.get('set_latest_property') and synced:
+            with report.phase('latest_property'):
+                for region_name in get_target_regions(charm_conf):
+                    content_id = charm_conf['content_id_template'].format(
+                        region=region_name)
+                    images = None
+                    if engine is not None:
+                        images = engine.get_inventory_snapshot(region_name,
+                                                               content_id)
+                    try:
+                        update_latest_property(session, ksc, region_name,
+                                               content_id, images)
+                    except (requests.RequestException,
+                            keystone_exceptions.EndpointNotFound) as e:
+                        # Retried from a fresh snapshot by the next sync,
+                        # with a new token if this one was rejected.
+                        if is_unauthorized(e):
+                            invalidate_keystone_cache()
+                        log.error("could not update the latest property "
+                                  "of {} in {}: {}".format(
+                                      content_id, region_name, e))
+
+        if publisher is not None:
+            with report.phase('publish'):
+                try:
+                    publisher.publish()
+                except (IOError, OSError) as e:
+                    # Metadata is regenerated by the next sync of each
+                    # mirror.
+                    log.error("could not publish streams metadata: "
+                              "{}".format(e))
+                    if fingerprints is not None:
+                        fingerprints.clear()
+    finally:
+        # Also on unexpected errors, so that the engine's temporary
+        # staging cache is removed and the fingerprints of the mirrors
+        # synced so far are kept.
+        if engine is not None:
+            engine.close()
+        if sync_state is not None:
+            save_sync_state(sync_state)
+        restore_environ(saved_environ)
+
+    failures = [(m, e) for m, e in results if e is not None]
+    if failures:
+        raise MirrorSyncError(failures)
+    return results
+
 
-    # NOTE(beisner): the user_agent variable was an unused assignment (lint).
-    # It may be worth re-visiting its usage, intent and benefit with the
-    # UrlMirrorReader call below at some point.  Leaving it disabled for now,
-    # and not assigning it since it is not currently utilized.
-    # user_agent = charm_conf.get("user_agent")
+def override_environ(env):
+    """Set variables of the process environment.
 
-    region_name = charm_conf['region']
+    :param dict env: Variables to set.
+    :returns: The previous values of the variables, None for unset ones.
+    :rtype: dict
+    """
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    return saved
 
-    for mirror_info in charm_conf['mirror_list']:
-        # NOTE: output directory must be under HOME
-        #       or snap cannot access it for stream files
-        tmpdir = tempfile.mkdtemp(dir=os.environ['HOME'])
-        try:
-            log.info("Configuring sync for url {}".format(mirror_info))
-            content_id = charm_conf['content_id_template'].format(
-                region=region_name)
-
-            sync_command = [
-                "/snap/bin/simplestreams.sstream-mirror-glance",
-                "-vv",
-                "--keep",
-                "--max", str(mirror_info['max']),
-                "--content-id", content_id,
-                "--cloud-name", charm_conf['cloud_name'],
-                "--path", mirror_info['path'],
-                "--name-prefix", charm_conf['name_prefix'],
-                "--keyring", charm_conf.get('keyring_path', DEFAULT_KEYRING),
-                "--log-file", SSTREAM_LOG_FILE,
-            ]
-
-            if charm_conf['use_swift']:
-                sync_command += [
-                    '--output-swift',
-                    "{}/".format(SWIFT_DATA_DIR)
-                ]
-            else:
-                # For debugging purposes only.
-                sync_command += [
-                    "--output-dir",
-                    tmpdir
-                ]
-
-            if charm_conf.get('hypervisor_mapping', False):
-                sync_command += [
-                    '--hypervisor-mapping'
-                ]
-
-            if charm_conf.get('custom_properties'):
-                custom_properties = charm_conf.get('custom_properties').split()
-                for custom_property in custom_properties:
-                    sync_command += [
-                        '--custom-property',
-                        custom_property
-                    ]
-            if charm_conf.get('image_import_conversion', False):
-                sync_command += [
-                    '--image-import-conversion'
-                ]
-
-            if charm_conf.get('set_latest_property', False):
-                sync_command += [
-                    '--set-latest-property'
-                ]
-
-            # --visibility is relatively new so use it only when the
-            # default value is modified for backward compatibility
-            if charm_conf['visibility'] != "public":
-                sync_command += [
-                    "--visibility",
-                    charm_conf['visibility'],
-                ]
-
-            sync_command += [
-                mirror_info['url'],
-            ]
-            sync_command += mirror_info['item_filters']
-
-            # Pass the current process' environment down along with proxy
-            # settings crafted for sstream-mirror-glance.
-            sstream_mirror_env = os.environ.copy()
-            sstream_mirror_env.update(get_sstream_mirror_proxy_env(
-                ksc, region_name,
-                charm_conf['ignore_proxy_for_object_store'],
-            ))
 
-            log.info("calling sstream-mirror-glance")
-            log.debug("command: %s", " ".join(sync_command))
-            log.debug("sstream-mirror environment: %s", sstream_mirror_env)
-            subprocess.check_call(sync_command, env=sstream_mirror_env)
-        finally:
-            shutil.rmtree(tmpdir)
+def restore_environ(saved):
+    """Restore variables changed by override_environ.
+
+    :param dict saved: Previous values as returned by override_environ.
+    """
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
 
 
 def get_sstream_mirror_proxy_env(ksc, region_name,
-                                 ignore_proxy_for_object_store=True):
+                                 ignore_proxy_for_object_store=True,
+                                 additional_regions=()):
     '''Get proxy settings to be passed to sstreams-mirror-glance.
 
     sstream-mirror-glance has multiple endpoints it needs to connect to:
@@ -361,6 +3113,8 @@ def get_sstream_mirror_proxy_env(ksc, region_name,
     :param str region_name: A name of the region to retrieve endpoints for.
     :param bool ignore_proxy_for_object_store: Do not include object-store
                                                endpoints into NO_PROXY.
+    :param additional_regions: Other regions to include endpoints of.
+    :type additional_regions: Iterable[str]
     '''
     proxy_settings = juju_proxy_settings()
     if proxy_settings is None:
@@ -368,13 +3122,15 @@ def get_sstream_mirror_proxy_env(ksc, region_name,
         no_proxy_set = set()
     else:
         no_proxy_set = set(proxy_settings.get('NO_PROXY').split(','))
-    additional_hosts = set([
-        urlparse.urlparse(u).hostname for u in itertools.chain(
-            get_service_endpoints(ksc, 'identity', region_name).values(),
-            get_service_endpoints(ksc, 'image', region_name).values(),
-            get_object_store_endpoints(ksc, region_name)
-            if ignore_proxy_for_object_store else [],
-        )])
+    additional_hosts = set()
+    for region in itertools.chain([region_name], additional_regions):
+        additional_hosts.update(
+            urlparse.urlparse(u).hostname for u in itertools.chain(
+                get_service_endpoints(ksc, 'identity', region).values(),
+                get_service_endpoints(ksc, 'image', region).values(),
+                get_object_store_endpoints(ksc, region)
+                if ignore_proxy_for_object_store else [],
+            ))
     no_proxy = ','.join(no_proxy_set | additional_hosts)
     proxy_settings['NO_PROXY'] = no_proxy
     proxy_settings['no_proxy'] = no_proxy
@@ -398,6 +3154,193 @@ def update_product_streams_service(ksc, services, region):
     )
 
 
+class LocalStreamsPublisher(object):
+    """Publish streams metadata under APACHE_DATA_DIR.
+
+    The metadata written by the mirrors of a run is merged into the
+    currently published tree, as a new release directory, which then
+    atomically replaces the published one by swapping the path symlink:
+    clients never see a partially written tree. Files with unchanged
+    content are hard linked from the previous release, so that their
+    modification time and with it the ETag apache derives from it stay
+    the same, and every file is also published gzip-compressed for
+    clients accepting it.
+
+    :param str path: Path the tree is published at.
+    :param str releases_dir: Directory to keep the release trees in.
+    :param content_ids: Content ids of the configured mirrors, the index
+                        entries of others and the products they point to
+                        are dropped from the published tree.
+    :type content_ids: None | list[str]
+    """
+
+    def __init__(self, path=None, releases_dir=None, content_ids=None):
+        self.path = path or LOCAL_STREAMS_DIR
+        self.releases_dir = releases_dir or LOCAL_STREAMS_RELEASES_DIR
+        self.content_ids = (set(content_ids) if content_ids is not None
+                            else None)
+        self.files = {}
+        self.index = None
+        self.lock = threading.Lock()
+
+    def add(self, output_dir):
+        """Queue the metadata written by a mirror for publishing.
+
+        :param str output_dir: Output directory of the mirror's sync.
+        """
+        for root, _, names in os.walk(output_dir):
+            for name in names:
+                full_path = os.path.join(root, name)
+                relpath = os.path.relpath(full_path, output_dir)
+                with open(full_path, 'rb') as f:
+                    content = f.read()
+                with self.lock:
+                    if relpath == STREAMS_INDEX_PATH:
+                        self.index = self._merge_index(
+                            self.index, json.loads(content.decode('utf-8')))
+                    else:
+                        self.files[relpath] = content
+
+    @staticmethod
+    def _merge_index(index, update):
+        if index is None:
+            return update
+        update = update or index
+        return dict(update, index=dict(index.get('index', {}),
+                                       **update.get('index', {})))
+
+    def publish(self):
+        """Publish the queued metadata.
+
+        :returns: The new release directory, None if nothing changed.
+        :rtype: None | str
+        """
+        with self.lock:
+            files, self.files = self.files, {}
+            index, self.index = self.index, None
+        current = (os.path.realpath(self.path)
+                   if os.path.isdir(self.path) else None)
+        dropped = set()
+        published = (os.path.join(current, STREAMS_INDEX_PATH)
+                     if current is not None else None)
+        if published is not None and os.path.exists(published):
+            with open(published) as f:
+                old = json.load(f)
+            index = self._merge_index(old, index)
+            for content_id in sorted(index['index']):
+                if (self.content_ids is not None and
+                        content_id not in self.content_ids):
+                    log.info("dropping {} from the streams metadata "
+                             "index".format(content_id))
+                    path = index['index'].pop(content_id).get('path')
+                    if path:
+                        dropped.update((path, path + '.gz'))
+            if index['index'] == old.get('index'):
+                index = None
+        if index is not None:
+            files[STREAMS_INDEX_PATH] = json.dumps(
+                index, indent=1, sort_keys=True).encode('utf-8')
+        changed = {relpath: content for relpath, content in files.items()
+                   if not self._is_published(current, relpath, content)}
+        if not changed:
+            log.info("streams metadata is unchanged, not publishing")
+            return None
+
+        if not os.path.isdir(self.releases_dir):
+            os.makedirs(self.releases_dir, 0o755)
+        release = tempfile.mkdtemp(dir=self.releases_dir)
+        os.chmod(release, 0o755)
+        try:
+            if current is not None:
+                self._link_tree(current, release, dropped - set(changed))
+            for relpath, content in changed.items():
+                self._write(release, relpath, content)
+            link = os.path.join(self.releases_dir, '.current')
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(release, link)
+            parent = os.path.dirname(self.path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent, 0o755)
+            if os.path.isdir(self.path) and not os.path.islink(self.path):
+                # Published in place by an earlier version, a symlink
+                # cannot replace a directory so it is moved aside once and
+                # pruned with the next release.
+                current = release + '.legacy'
+                os.rename(self.path, current)
+            os.rename(link, self.path)
+        except Exception:
+            shutil.rmtree(release)
+            raise
+        log.info("published {} changed streams metadata files at "
+                 "{}".format(len(changed), self.path))
+        self._prune(release, current)
+        return release
+
+    @staticmethod
+    def _is_published(current, relpath, content):
+        if current is None:
+            return False
+        try:
+            with open(os.path.join(current, relpath), 'rb') as f:
+                return f.read() == content
+        except IOError:
+            return False
+
+    @staticmethod
+    def _link_tree(source, target, exclude=()):
+        for root, _, names in os.walk(source):
+            relroot = os.path.relpath(root, source)
+            target_root = os.path.join(target, relroot)
+            if not os.path.isdir(target_root):
+                os.makedirs(target_root, 0o755)
+            for name in names:
+                if os.path.normpath(os.path.join(relroot, name)) in exclude:
+                    continue
+                os.link(os.path.join(root, name),
+                        os.path.join(target_root, name))
+
+    @staticmethod
+    def _write(release, relpath, content):
+        path = os.path.join(release, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o755)
+        for target in (path, path + '.gz'):
+            if os.path.exists(target):
+                # Hard linked from the previous release.
+                os.unlink(target)
+        with open(path, 'wb') as f:
+            f.write(content)
+        with open(path + '.gz', 'wb') as f:
+            # A fixed mtime keeps the compressed file reproducible.
+            with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                               mtime=0) as gz:
+                gz.write(content)
+        for target in (path, path + '.gz'):
+            os.chmod(target, 0o644)
+
+    def _prune(self, release, previous):
+        """Remove releases but the published and the previous one.
+
+        The previous release is kept for clients still reading from it.
+        """
+        for name in os.listdir(self.releases_dir):
+            path = os.path.join(self.releases_dir, name)
+            if path not in (release, previous) and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def get_local_streams_url(charm_conf):
+    """URL of the streams metadata published with local_streams.
+
+    :returns: None if metadata is not published locally.
+    :rtype: None | str
+    """
+    if charm_conf.get('use_swift') or not charm_conf.get('local_streams'):
+        return None
+    return charm_conf.get('local_streams_url') or None
+
+
 def get_object_store_endpoints(ksc, region_name):
     """Get object-store endpoints from the service catalog.
 
@@ -468,34 +3411,128 @@ def juju_proxy_settings():
     return proxy_settings if proxy_settings else None
 
 
-def juju_exec_cmd(cmd):
-    '''Execute the passed commands under the local unit context if required'''
-    # NOTE: determine whether juju-exec is actually required
-    #       supporting execution via actions.
-    if not os.environ.get('JUJU_CONTEXT_ID'):
+class HookToolSession(object):
+    """Run hook tools under the local unit context with few round-trips.
+
+    Outside of a hook context every hook tool invocation goes through
+    juju-exec (or juju-run), a round-trip through the juju agent. Commands
+    whose output is not needed (status-set, relation-set) are queued and
+    run together with the next command whose output is needed, or by
+    flush(), in a single juju-exec invocation. Inside a hook context the
+    commands are run directly.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._unit_name = None
+        self._lock = threading.Lock()
+
+    @property
+    def unit_name(self):
+        if self._unit_name is None:
+            id_conf, _ = get_conf()
+            self._unit_name = id_conf['unit_name']
+        return self._unit_name
+
+    def queue(self, cmd):
+        """Queue a command to run with the next batch.
+
+        :param cmd: Hook tool command line.
+        :type cmd: list[str]
+        """
+        with self._lock:
+            self._queue.append(cmd)
+
+    def call(self, cmd):
+        """Run a command along with the queued ones and return its output.
+
+        :param cmd: Hook tool command line.
+        :type cmd: list[str]
+        :rtype: str
+        :raises: :class: `subprocess.CalledProcessError`
+        """
+        with self._lock:
+            batch, self._queue = self._queue + [cmd], []
+        returncode, out = self._run(batch)[-1]
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, cmd, out)
+        return out
+
+    def flush(self):
+        """Run the queued commands, failures are only logged."""
+        with self._lock:
+            batch, self._queue = self._queue, []
+        if not batch:
+            return
+        try:
+            self._run(batch)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log.error("could not run hook tools: {}".format(e))
+
+    def _run(self, batch):
+        """Run commands, returning (returncode, output) of each."""
+        if os.environ.get('JUJU_CONTEXT_ID'):
+            results = []
+            for cmd in batch:
+                log.info("Executing command: {}".format(cmd))
+                try:
+                    results.append((0, self._decode(
+                        subprocess.check_output(cmd))))
+                except subprocess.CalledProcessError as e:
+                    results.append((e.returncode, self._decode(e.output)))
+            return self._check(batch, results)
+
+        # NOTE: determine whether juju-exec is actually required
+        #       supporting execution via actions.
         if os.path.exists('/usr/bin/juju-exec'):
             juju_exec = 'juju-exec'
         else:
             juju_exec = 'juju-run'
-        id_conf, _ = get_conf()
-        unit_name = id_conf['unit_name']
-        _cmd = [juju_exec, unit_name, ' '.join(cmd)]
-    else:
-        _cmd = cmd
-    log.info("Executing command: {}".format(_cmd))
-    out = subprocess.check_output(_cmd)
-    if six.PY3:
-        out = out.decode('utf-8')
-    return out
+        marker = 'gss-{:x}'.format(random.getrandbits(64))
+        script = ' '.join(
+            "echo '=={marker}-{i}=='; {cmd}; echo \"=={marker}-{i}-rc=$?==\";"
+            .format(marker=marker, i=i,
+                    cmd=' '.join(shlex_quote(arg) for arg in cmd))
+            for i, cmd in enumerate(batch))
+        _cmd = [juju_exec, self.unit_name, script]
+        log.info("Executing command: {}".format(_cmd))
+        out = self._decode(subprocess.check_output(_cmd))
+        results = [(int(m.group(3)), m.group(2)) for m in re.finditer(
+            r'^=={0}-(\d+)==\n(.*?)=={0}-\1-rc=(\d+)==$'.format(marker),
+            out, re.MULTILINE | re.DOTALL)]
+        if len(results) != len(batch):
+            raise subprocess.CalledProcessError(1, _cmd, out)
+        return self._check(batch, results)
+
+    @staticmethod
+    def _decode(out):
+        if six.PY3 and isinstance(out, bytes):
+            out = out.decode('utf-8')
+        return out
+
+    @staticmethod
+    def _check(batch, results):
+        for cmd, (returncode, _) in zip(batch, results):
+            if returncode:
+                log.error("{} failed with exit status {}".format(
+                    cmd, returncode))
+        return results
+
+
+hook_tools = HookToolSession()
+
+
+def juju_exec_cmd(cmd):
+    '''Execute the passed commands under the local unit context if required'''
+    return hook_tools.call(cmd)
 
 
 def status_set(status, message):
     try:
-        # NOTE: format of message is different for out of
-        #       context execution.
+        # NOTE: status is only reported once the next hook tool runs or
+        #       hook_tools is flushed when out of context.
         if not os.environ.get('JUJU_CONTEXT_ID'):
-            juju_exec_cmd(['status-set', status,
-                          '"{}"'.format(message)])
+            hook_tools.queue(['status-set', status, message])
         else:
             subprocess.check_output([
                 'status-set',
@@ -521,10 +3558,11 @@ def update_endpoint_urls(region, publicurl, adminurl, internalurl):
         }
         for k, v in relation_data.items():
             _cmd.append('{}={}'.format(k, v))
-        juju_exec_cmd(_cmd)
+        hook_tools.queue(_cmd)
 
 
 def cleanup():
+    """Remove the lock file, the lock must be held by the caller."""
     try:
         os.unlink(SYNC_RUNNING_FLAG_FILE_NAME)
     except OSError as e:
@@ -532,7 +3570,7 @@ def cleanup():
             raise e
 
 
-def set_active_status(is_object_store_present_and_used):
+def set_active_status(is_object_store_present_and_used, local_streams=False):
     """Get object-store endpoints from the service catalog.
 
     The lack of those endpoints is not fatal for the purposes of this script
@@ -545,6 +3583,9 @@ def set_active_status(is_object_store_present_and_used):
     if is_object_store_present_and_used:
         status_set('active', 'Unit is ready (Glance sync completed at {},'
                    ' metadata uploaded to object store)'.format(ts))
+    elif local_streams:
+        status_set('active', 'Unit is ready (Glance sync completed at {},'
+                   ' metadata published locally)'.format(ts))
     else:
         status_set('active', 'Unit is ready (Glance sync completed at {},'
                    ' metadata not uploaded - object-store usage disabled)'
@@ -569,33 +3610,830 @@ def is_object_store_present(ksc, region_name):
     return len(get_object_store_endpoints(ksc, region_name)) > 0
 
 
-def main():
+class ItemFilter(object):
+    """A simplestreams item filter such as "arch~(x86_64|amd64)".
 
-    log.info("glance-simplestreams-sync started.")
+    Same syntax and semantics as simplestreams.filters.ItemFilter: KEY=VALUE
+    and KEY!=VALUE compare the value, KEY~REGEX and KEY!~REGEX search it.
+
+    :param str content: The filter expression.
+    :raises: ValueError
+    """
+
+    PATTERN = re.compile(r'([\w|\-]+)[ ]*([!]{0,1}[=~])[ ]*(.*)[ ]*$')
+
+    def __init__(self, content):
+        match = self.PATTERN.match(content)
+        if not match:
+            raise ValueError("invalid item filter {!r}".format(content))
+        self.key, op, self.value = match.groups()
+        self.negate = op.startswith('!')
+        self.regex = op.endswith('~')
+        if self.regex:
+            self._matches = re.compile(self.value).search
+        else:
+            self._matches = lambda value: value == self.value
+
+    def matches(self, item):
+        """Whether a flattened item passes the filter."""
+        return bool(self._matches(str(item.get(self.key, '')))) != self.negate
+
+
+class ItemFilterSet(object):
+    """Item filters compiled into a single matcher.
+
+    Like in simplestreams an item has to pass every filter. The filters are
+    grouped by field: KEY=VALUE and KEY!=VALUE become set lookups and the
+    KEY!~REGEX filters of a field are combined into a single regex, so
+    every field of an item is looked up once.
+
+    :param contents: Filter expressions, see ItemFilter.
+    :type contents: list[str]
+    :raises: ValueError
+    """
+
+    def __init__(self, contents):
+        fields = collections.OrderedDict()
+        for f in (ItemFilter(content) for content in contents):
+            fields.setdefault(f.key, []).append(f)
+        self.checks = [(key, self._compile(filters))
+                       for key, filters in fields.items()]
+
+    @staticmethod
+    def _compile(filters):
+        equal = set(f.value for f in filters if not f.regex and not f.negate)
+        not_equal = frozenset(f.value for f in filters
+                              if not f.regex and f.negate)
+        searches = [re.compile(f.value).search for f in filters
+                    if f.regex and not f.negate]
+        excluded = [f.value for f in filters if f.regex and f.negate]
+        exclude = None
+        if len(excluded) == 1:
+            exclude = re.compile(excluded[0]).search
+        elif excluded:
+            try:
+                exclude = re.compile('|'.join(
+                    '(?:{})'.format(pattern) for pattern in excluded)).search
+            except re.error:
+                # e.g. inline flags, which only apply at the start.
+                patterns = [re.compile(pattern) for pattern in excluded]
+                exclude = (lambda value: any(pattern.search(value)
+                                             for pattern in patterns))
+        if len(equal) > 1:
+            return lambda value: False
+        expected = equal.pop() if equal else None
+
+        def check(value):
+            if expected is not None and value != expected:
+                return False
+            if value in not_equal:
+                return False
+            if exclude is not None and exclude(value):
+                return False
+            return all(search(value) for search in searches)
+        return check
+
+    def matches(self, item):
+        """Whether a flattened item passes all filters.
+
+        :param item: The item, any object with a dict's get().
+        """
+        return all(check(str(item.get(key, '')))
+                   for key, check in self.checks)
+
+    def filter_products(self, products):
+        """Drop the items of a products:1.0 document failing the filters.
+
+        Versions and products left without items are dropped as well. The
+        fields of the items are looked up through their version, product
+        and document instead of flattening every item.
+
+        :param dict products: The document, modified in place.
+        :returns: The number of items dropped.
+        :rtype: int
+        """
+        if not self.checks:
+            return 0
+        dropped = 0
+        top = _ItemFields(None, None, None, products, 'products')
+        for product_name, product in list(products.get('products',
+                                                       {}).items()):
+            product_fields = _ItemFields(top, 'product_name', product_name,
+                                         product, 'versions')
+            versions = product.get('versions', {})
+            for version_name, version in list(versions.items()):
+                version_fields = _ItemFields(product_fields, 'version_name',
+                                             version_name, version, 'items')
+                items = version.get('items', {})
+                for item_name, item in list(items.items()):
+                    if not self.matches(_ItemFields(
+                            version_fields, 'item_name', item_name, item)):
+                        del items[item_name]
+                        dropped += 1
+                if not items:
+                    del versions[version_name]
+            if not versions:
+                del products['products'][product_name]
+        return dropped
+
+
+class _ItemFields(object):
+    """Fields of an item inherited from its version, product and document.
+
+    Same precedence as iter_product_items without copying any fields.
+    """
+
+    __slots__ = ('parent', 'name_key', 'name', 'data', 'children_key')
+
+    def __init__(self, parent, name_key, name, data, children_key=None):
+        self.parent = parent
+        self.name_key = name_key
+        self.name = name
+        self.data = data
+        self.children_key = children_key
+
+    def get(self, key, default=None):
+        fields = self
+        while fields is not None:
+            if key in fields.data and key != fields.children_key:
+                return fields.data[key]
+            if key == fields.name_key:
+                return fields.name
+            fields = fields.parent
+        return default
+
+
+class TransferPriority(object):
+    """Order in which the products of a mirror are transferred.
+
+    The space separated rules of transfer_priority are applied in order,
+    products they do not tell apart keep their upstream order:
+
+    * pin:FILTER - products matching an item filter (see ItemFilter) on
+      their product fields first, e.g. pin:release=noble;
+    * lts - LTS releases first;
+    * newest - most recent release versions first;
+    * arch:ARCH[,ARCH...] - architectures in this order first.
+
+    :param str rules: The rules.
+    :raises: ValueError
+    """
+
+    def __init__(self, rules):
+        self.keys = []
+        for rule in rules.split():
+            name, _, arg = rule.partition(':')
+            if name == 'pin' and arg:
+                self.keys.append(self._pin_key(ItemFilter(arg)))
+            elif name == 'lts' and not arg:
+                self.keys.append(self._lts_key)
+            elif name == 'newest' and not arg:
+                self.keys.append(self._newest_key)
+            elif name == 'arch' and arg:
+                self.keys.append(self._arch_key(arg.split(',')))
+            else:
+                raise ValueError("invalid transfer_priority rule "
+                                 "{!r}".format(rule))
+
+    @staticmethod
+    def _pin_key(item_filter):
+        return lambda product: 0 if item_filter.matches(product) else 1
+
+    @staticmethod
+    def _lts_key(product):
+        return 0 if 'LTS' in str(product.get('release_title', '')) else 1
 
-    lockfile = open(SYNC_RUNNING_FLAG_FILE_NAME, 'w')
+    @staticmethod
+    def _newest_key(product):
+        version = re.findall(r'\d+', str(product.get('version', '')))
+        if not version:
+            return (1,)
+        return (0,) + tuple(-int(n) for n in version)
 
+    @staticmethod
+    def _arch_key(arches):
+        return lambda product: (arches.index(product.get('arch'))
+                                if product.get('arch') in arches
+                                else len(arches))
+
+    def key(self, product_name, product):
+        """Sort key of a product of a products:1.0 document."""
+        fields = {k: v for k, v in product.items() if k != 'versions'}
+        fields['product_name'] = product_name
+        return tuple(key(fields) for key in self.keys)
+
+    def sort_products(self, products):
+        """Return a products:1.0 document with its products reordered."""
+        ordered = sorted(products['products'].items(),
+                         key=lambda p: self.key(*p))
+        return dict(products, products=collections.OrderedDict(ordered))
+
+
+def get_transfer_priority(options):
+    """Return the transfer priority of a mirror.
+
+    :param dict options: Sync options as returned by get_mirror_options.
+    :returns: None to transfer products in upstream order.
+    :rtype: None | TransferPriority
+    """
+    if not options.get('transfer_priority'):
+        return None
     try:
-        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError:
-        log.info("{} is locked, exiting".format(SYNC_RUNNING_FLAG_FILE_NAME))
-        sys.exit(2)
+        return TransferPriority(options['transfer_priority'])
+    except ValueError as e:
+        log.error("{}, transferring images in upstream order".format(e))
+        return None
 
-    returncode = 0
-    atexit.register(cleanup)
+
+def iter_product_items(products):
+    """Flatten the items of a products:1.0 document.
+
+    Items inherit the fields of their version, product and document like
+    in simplestreams.
+
+    :param dict products: A products:1.0 document.
+    :returns: (product name, version name, item name, flattened item)
+    :rtype: Iterator[tuple]
+    """
+    top = {k: v for k, v in products.items() if k != 'products'}
+    for product_name, product in products.get('products', {}).items():
+        product_data = dict(top, product_name=product_name)
+        product_data.update((k, v) for k, v in product.items()
+                            if k != 'versions')
+        for version_name, version in product.get('versions', {}).items():
+            version_data = dict(product_data, version_name=version_name)
+            version_data.update((k, v) for k, v in version.items()
+                                if k != 'items')
+            for item_name, item in version.get('items', {}).items():
+                flat = dict(version_data, item_name=item_name)
+                flat.update(item)
+                yield product_name, version_name, item_name, flat
+
+
+def get_endpoint_type():
+    """Return the catalog endpoint type services are reached through.
+
+    This is the interface of the identity relation exported by
+    set_openstack_env, the public one if none is set.
+    """
+    interface = os.environ.get('OS_INTERFACE') or 'public'
+    if interface.endswith('URL'):
+        return interface
+    return '{}URL'.format(interface)
+
+
+def get_glance_url(ksc, region_name):
+    """Return the glance endpoint of a region without API version."""
+    url = ksc.service_catalog.url_for(
+        service_type='image', endpoint_type=get_endpoint_type(),
+        region_name=region_name).rstrip('/')
+    if url.endswith('/v2'):
+        url = url[:-len('/v2')]
+    return url
+
+
+def list_glance_images(session, ksc, region_name, content_id):
+    """List the images of a content id through the glance v2 API.
+
+    :param session: HTTP session to use.
+    :type session: :class: `requests.Session`
+    :param ksc: Keystone client with auth_token and project_id.
+    :type ksc: CachedKeystoneClient
+    :param str region_name: Region of the glance endpoint.
+    :param str content_id: Content id of the images to list.
+    :rtype: list[dict]
+    """
+    url = get_glance_url(ksc, region_name)
+    next_url = url + '/v2/images'
+    params = {'content_id': content_id, 'owner': ksc.project_id,
+              'limit': GLANCE_PAGE_SIZE}
+    images = []
+    while next_url:
+        response = session.get(next_url, params=params,
+                               headers={'X-Auth-Token': ksc.auth_token},
+                               verify=os.environ.get('OS_CACERT') or True,
+                               timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        body = response.json()
+        images.extend(body['images'])
+        # The next link carries the query of the first request.
+        next_url = url + body['next'] if body.get('next') else None
+        params = None
+    return images
+
+
+def get_latest_property_changes(images):
+    """Compute the latest property of a snapshot of glance images.
+
+    The image of the newest version of every os_version and architecture
+    is flagged latest=true, all others are not.
+
+    :param images: Glance images of a content id.
+    :type images: Iterable[dict]
+    :returns: Ids of the images to flag and to unflag.
+    :rtype: tuple[list[str], list[str]]
+    """
+    newest = {}
+    for image in images:
+        if (image.get('status', 'active') != 'active' or
+                not image.get('os_version')):
+            continue
+        key = (image['os_version'], image.get('architecture'))
+        order = (image.get('version_name') or '',
+                 image.get('created_at') or '')
+        if key not in newest or order > newest[key][0]:
+            newest[key] = (order, image['id'])
+    latest_ids = set(image_id for _, image_id in newest.values())
+    flag, unflag = [], []
+    for image in images:
+        flagged = str(image.get('latest')).lower() == 'true'
+        if image['id'] in latest_ids and not flagged:
+            flag.append(image['id'])
+        elif image['id'] not in latest_ids and 'latest' in image:
+            unflag.append(image['id'])
+    return sorted(flag), sorted(unflag)
+
+
+def update_latest_property(session, ksc, region_name, content_id,
+                           images=None):
+    """Maintain the latest property of the images of a content id.
+
+    Only images whose flag changes are updated, in one PATCH each.
+
+    :param session: HTTP session to use.
+    :type session: :class: `requests.Session`
+    :param ksc: Keystone client with auth_token and project_id.
+    :type ksc: CachedKeystoneClient
+    :param str region_name: Region of the glance endpoint.
+    :param str content_id: Content id of the images.
+    :param images: Snapshot of the images, listed from glance if None.
+    :type images: None | list[dict]
+    :returns: Number of images updated.
+    :rtype: int
+    """
+    if images is None:
+        images = list_glance_images(session, ksc, region_name, content_id)
+    flag, unflag = get_latest_property_changes(images)
+    url = get_glance_url(ksc, region_name)
+    headers = {
+        'X-Auth-Token': ksc.auth_token,
+        'Content-Type': 'application/openstack-images-v2.1-json-patch',
+    }
+    for image_id, patch in itertools.chain(
+            ((i, [{'op': 'add', 'path': '/latest', 'value': 'true'}])
+             for i in flag),
+            ((i, [{'op': 'remove', 'path': '/latest'}]) for i in unflag)):
+        response = session.patch('{}/v2/images/{}'.format(url, image_id),
+                                 data=json.dumps(patch), headers=headers,
+                                 verify=os.environ.get('OS_CACERT') or True,
+                                 timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+    if flag or unflag:
+        log.info("latest property set on {} and removed from {} image(s) "
+                 "of {} in {}".format(len(flag), len(unflag), content_id,
+                                      region_name))
+    return len(flag) + len(unflag)
+
+
+def plan_mirror(session, options, images):
+    """Compute what syncing a mirror to a region would change in glance.
+
+    Only the stream index and product documents are downloaded. Their
+    signatures are not verified as nothing is written.
+
+    :param session: HTTP session to fetch upstream metadata with.
+    :type session: :class: `requests.Session`
+    :param dict options: Sync options as returned by get_mirror_options.
+    :param list images: Glance images of the content id synchronised to.
+    :returns: Images to add and delete with their sizes, the images to
+              retag are planned per content id by plan_latest_property.
+    :rtype: dict
+    """
+    base_url = options['source_mirror']
+    if not base_url.endswith('/'):
+        base_url += '/'
+
+    def fetch(path):
+        response = session.get(base_url + path, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return json.loads(strip_signature(response.text))
+
+    index = fetch(options['path'])
+    paths = [entry['path'] for entry in index.get('index', {}).values()
+             if entry.get('datatype') == 'image-downloads']
+    with futures.ThreadPoolExecutor(
+            max_workers=max(1, min(len(paths), 8))) as executor:
+        documents = list(executor.map(fetch, paths))
+
+    item_filters = ItemFilterSet(options['item_filters'])
+    priority = get_transfer_priority(options)
+    upstream = {}
+    order = {}
+    for products in documents:
+        if priority is not None:
+            products = priority.sort_products(products)
+        for product_name in products.get('products', {}):
+            order.setdefault(product_name, len(order))
+        for product_name, version_name, item_name, item in (
+                iter_product_items(products)):
+            upstream.setdefault(product_name, {})
+            if item_filters.matches(item):
+                upstream[product_name].setdefault(version_name, {})[
+                    item_name] = item
+    max_items = options['max_items']
+    selected = {}
+    for product_name, versions in upstream.items():
+        for version_name in sorted(versions, reverse=True)[:max_items]:
+            for item_name, item in versions[version_name].items():
+                selected[(product_name, version_name, item_name)] = item
+
+    existing = {}
+    for image in images:
+        if image.get('product_name') in upstream:
+            existing[(image['product_name'], image.get('version_name'),
+                      image.get('item_name'))] = image
+
+    add, delete = [], {}
+    # In the order of transfer, see TransferPriority.
+    for key in sorted(selected, key=lambda k: (order[k[0]],) + k):
+        item = selected[key]
+        image = existing.get(key)
+        if image is not None:
+            if not item.get('md5') or image.get('checksum') == item['md5']:
+                continue
+            # The upstream item changed, the image is replaced.
+            delete[image['id']] = image
+        add.append({'product_name': key[0], 'version_name': key[1],
+                    'item_name': key[2], 'path': item.get('path'),
+                    'sha256': item.get('sha256'),
+                    'size': int(item.get('size') or 0),
+                    # The properties the latest property is keyed by.
+                    'os_version': item.get('version'),
+                    'architecture': GLANCE_ARCHITECTURES.get(
+                        item.get('arch'), item.get('arch'))})
+
+    kept_versions = {}
+    for product_name in upstream:
+        versions = set(v for p, v, _ in itertools.chain(selected, existing)
+                       if p == product_name)
+        kept_versions[product_name] = sorted(versions,
+                                             reverse=True)[:max_items]
+    for (product_name, version_name, _), image in existing.items():
+        if version_name not in kept_versions[product_name]:
+            delete[image['id']] = image
+
+    return {
+        'url': options['source_mirror'],
+        'region': options['region'],
+        'add': add,
+        'delete': [{'id': image['id'], 'name': image.get('name'),
+                    'product_name': image.get('product_name'),
+                    'version_name': image.get('version_name'),
+                    'size': image.get('size')}
+                   for image in sorted(delete.values(),
+                                       key=lambda i: i.get('name') or '')],
+        'bytes': sum(item['size'] for item in add),
+    }
+
+
+def plan_latest_property(region_name, images, mirrors):
+    """Compute the images whose latest property a sync would change.
+
+    get_latest_property_changes is applied to the images of a content id
+    as the planned syncs of its mirrors would leave them, like
+    update_latest_property does after the sync. Images added by the sync
+    are flagged as they are created and not reported.
+
+    :param str region_name: Region of the content id.
+    :param list images: Glance images of the content id.
+    :param list mirrors: Plans of the mirrors synced to the content id, as
+                         returned by plan_mirror.
+    :returns: The images to retag with their new latest property.
+    :rtype: list[dict]
+    """
+    deleted = set(image['id'] for mirror in mirrors
+                  for image in mirror['delete'])
+    by_id = {image['id']: image for image in images
+             if image['id'] not in deleted}
+    planned = list(by_id.values())
+    for mirror in mirrors:
+        for n, item in enumerate(mirror['add']):
+            planned.append(dict(item, id='planned:{}:{}'.format(
+                mirror['url'], n)))
+    flag, unflag = get_latest_property_changes(planned)
+    return [{'region': region_name, 'id': image_id,
+             'name': by_id[image_id].get('name'), 'latest': latest}
+            for latest, ids in ((True, flag), (False, unflag))
+            for image_id in ids if image_id in by_id]
+
+
+def get_past_throughput():
+    """Average image sync throughput of the runs in SYNC_REPORT_DIR.
+
+    :returns: Bytes per second or None if no run transferred any images.
+    :rtype: None | float
+    """
+    transferred = seconds = 0
+    try:
+        names = os.listdir(SYNC_REPORT_DIR)
+    except OSError:
+        return None
+    for name in names:
+        if not (name.startswith('sync-') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(SYNC_REPORT_DIR, name)) as f:
+                report = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue
+        for mirror in report.get('mirrors', {}).values():
+            nbytes = mirror['counters'].get('bytes_downloaded', 0)
+            duration = mirror['phases'].get('sync', 0)
+            if nbytes and duration:
+                transferred += nbytes
+                seconds += duration
+    if not seconds:
+        return None
+    return transferred / float(seconds)
+
+
+def plan_sync(charm_conf, ksc, session):
+    """Compute the changes a sync would make without transferring images.
+
+    :param dict charm_conf: Charm configuration read from mirrors.yaml.
+    :param ksc: Keystone client with auth_token and project_id.
+    :type ksc: CachedKeystoneClient
+    :param session: HTTP session to use.
+    :type session: :class: `requests.Session`
+    :rtype: dict
+    """
+    images = {}
+    mirrors = []
+    planned = {}
+    for mirror_info in charm_conf['mirror_list']:
+        for region_name in get_target_regions(charm_conf):
+            options = get_mirror_options(charm_conf, mirror_info, None,
+                                         region_name)
+            try:
+                key = (region_name, options['content_id'])
+                if key not in images:
+                    images[key] = list_glance_images(
+                        session, ksc, region_name, options['content_id'])
+                mirror = plan_mirror(session, options, images[key])
+                planned.setdefault(key, []).append(mirror)
+                mirrors.append(mirror)
+            except Exception as e:
+                log.exception("could not plan sync of {}".format(
+                    mirror_info['url']))
+                mirrors.append({'url': mirror_info['url'],
+                                'region': region_name, 'error': str(e)})
+
+    retag = []
+    if charm_conf.get('set_latest_property'):
+        for (region_name, content_id), region_mirrors in sorted(
+                planned.items()):
+            retag.extend(plan_latest_property(
+                region_name, images[(region_name, content_id)],
+                region_mirrors))
+
+    downloads = {}
+    for mirror in mirrors:
+        for item in mirror.get('add', []):
+            downloads[item['sha256'] or item['path']] = item['size']
+    transfer = sum(mirror.get('bytes', 0) for mirror in mirrors)
+    throughput = get_past_throughput()
+    return {
+        'mirrors': mirrors,
+        'retag': retag,
+        'images_to_add': sum(len(m.get('add', [])) for m in mirrors),
+        'images_to_delete': sum(len(m.get('delete', [])) for m in mirrors),
+        'images_to_retag': len(retag),
+        'bytes_to_download': sum(downloads.values()),
+        'bytes_to_transfer': transfer,
+        'throughput': throughput,
+        'estimated_seconds': (int(round(transfer / throughput))
+                              if throughput else None),
+    }
+
+
+def run_plan():
+    """Print the sync plan as JSON, the sync lock is not needed."""
+    id_conf, charm_conf = get_conf()
+    set_openstack_env(id_conf, charm_conf)
+    ksc = get_cached_keystone_client(id_conf['api_version'])
+    os.environ.update(get_sstream_mirror_proxy_env(
+        ksc, charm_conf['region'],
+        charm_conf['ignore_proxy_for_object_store'],
+        get_target_regions(charm_conf)[1:]))
+    session = get_http_session(charm_conf.get('user_agent'))
+    try:
+        plan = plan_sync(charm_conf, ksc, session)
+    except (keystone_exceptions.Unauthorized, requests.HTTPError) as e:
+        if is_unauthorized(e):
+            invalidate_keystone_cache()
+        raise
+    json.dump(plan, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Synchronise simplestreams mirrors into glance.')
+    parser.add_argument('--force', action='store_true',
+                        help='sync all mirrors, even those unchanged '
+                             'upstream since their last sync')
+    parser.add_argument('--daemon', action='store_true',
+                        help='run as a long running sync scheduler')
+    parser.add_argument('--wait', action='store_true',
+                        help='if another sync is running, wait for the '
+                             'follow-up sync serving this request instead '
+                             'of exiting with status 2')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the changes a sync would make as JSON '
+                             'without transferring any images')
+    parser.add_argument('--serve-cache', action='store_true',
+                        help='serve the staging cache to peer units')
+    return parser.parse_args(argv)
+
+
+def acquire_sync_lock(blocking=False):
+    """Take the lock serialising syncs.
+
+    :param bool blocking: Wait for the lock if another sync holds it.
+    :returns: The locked file or None if another sync holds the lock.
+    """
+    while True:
+        lockfile = open(SYNC_RUNNING_FLAG_FILE_NAME, 'a')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except IOError:
+            lockfile.close()
+            return None
+        # The previous holder removes the file on exit (see cleanup), the
+        # lock is only valid if the file is still in place.
+        try:
+            in_place = (os.stat(SYNC_RUNNING_FLAG_FILE_NAME).st_ino ==
+                        os.fstat(lockfile.fileno()).st_ino)
+        except OSError:
+            in_place = False
+        if in_place:
+            break
+        lockfile.close()
+    lockfile.truncate(0)
     lockfile.write(str(os.getpid()))
+    lockfile.flush()
+    return lockfile
+
+
+class SyncQueue(object):
+    """Sync requests coalesced across processes.
+
+    Every request gets a ticket. A sync serves all tickets issued before it
+    started, so requests arriving while a sync runs are all served by a
+    single follow-up sync. The state is kept in SYNC_QUEUE_FILE_NAME.
+    """
+
+    @contextlib.contextmanager
+    def _state(self):
+        """Yield the queue state, locked against other processes."""
+        fd = os.open(SYNC_QUEUE_FILE_NAME, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                state = json.load(f)
+            except ValueError:
+                state = {}
+            for key in ('requested', 'started', 'completed'):
+                state.setdefault(key, 0)
+            yield state
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
+    def request(self, force=False):
+        """Register a sync request.
+
+        :param bool force: Whether the sync serving it is to be forced.
+        :returns: The ticket of the request.
+        :rtype: int
+        """
+        with self._state() as state:
+            state['requested'] += 1
+            state['force'] = state.get('force', False) or force
+            return state['requested']
+
+    def pending(self):
+        """Whether requests are waiting for a sync to start."""
+        with self._state() as state:
+            return state['requested'] > state['started']
+
+    def start(self):
+        """Take all pending requests for a sync about to start.
+
+        :returns: The last ticket served and whether to force the sync.
+        :rtype: tuple[int, bool]
+        """
+        with self._state() as state:
+            state['started'] = state['requested']
+            force, state['force'] = state.get('force', False), False
+            return state['started'], force
+
+    def finish(self, ticket, returncode):
+        """Record the outcome of the sync serving tickets up to ticket."""
+        with self._state() as state:
+            if ticket >= state['completed']:
+                state['completed'] = ticket
+                state['returncode'] = returncode
+
+    def result(self, ticket):
+        """Return whether a request was served and the sync's outcome.
+
+        :rtype: tuple[bool, None | int]
+        """
+        with self._state() as state:
+            return (state['completed'] >= ticket,
+                    state.get('returncode'))
+
+
+def run_coalesced_sync(force=False, wait=False, session=None):
+    """Request a sync and run it unless another sync holds the lock.
+
+    The holder of the lock keeps running follow-up syncs while requests
+    are pending, each one serving every request registered before it
+    started. A request finding the lock taken is thus served by the
+    running sync's follow-up, which its caller can wait for.
+
+    :param bool force: Sync all mirrors regardless of upstream changes.
+    :param bool wait: Wait for the sync serving the request if another
+                      sync holds the lock.
+    :param session: HTTP session to reuse for upstream connections.
+    :type session: None | :class: `requests.Session`
+    :returns: Outcome of the sync serving the request as run_sync, 2 if
+              the request was queued without waiting.
+    :rtype: None | int
+    """
+    queue = SyncQueue()
+    ticket = queue.request(force)
+    lockfile = acquire_sync_lock()
+    if lockfile is None:
+        log.info("{} is locked, sync request {} queued".format(
+            SYNC_RUNNING_FLAG_FILE_NAME, ticket))
+        record_lock_contention()
+        if not wait:
+            return 2
+        lockfile = acquire_sync_lock(blocking=True)
+
+    while lockfile is not None:
+        try:
+            if queue.pending():
+                served, force = queue.start()
+                returncode = 1
+                try:
+                    returncode = run_sync(force=force, session=session)
+                except SystemExit as e:
+                    returncode = e.code if isinstance(e.code, int) else 1
+                    raise
+                finally:
+                    queue.finish(served, returncode)
+                    hook_tools.flush()
+        finally:
+            cleanup()
+            lockfile.close()
+        # Requests registered after the pending check above found the lock
+        # taken and rely on this process to run them.
+        lockfile = acquire_sync_lock() if queue.pending() else None
+
+    return queue.result(ticket)[1]
+
+
+def run_sync(force=False, session=None):
+    """Synchronise images, the lock must be held by the caller.
+
+    :param bool force: Sync all mirrors regardless of upstream changes.
+    :param session: HTTP session to reuse for upstream connections.
+    :type session: None | :class: `requests.Session`
+    :returns: 0 on success, None while waiting for the object store.
+    :rtype: None | int
+    """
+    returncode = 0
+    report = SyncReport()
 
     id_conf, charm_conf = get_conf()
+    metrics = get_sync_metrics(charm_conf)
 
     set_openstack_env(id_conf, charm_conf)
 
     region_name = charm_conf['region']
-    ksc = get_keystone_client(id_conf['api_version'])
-    services = [s._info for s in ksc.services.list()]
-    servicenames = [s['name'] for s in services]
-    ps_service_exists = PRODUCT_STREAMS_SERVICE_NAME in servicenames
+    with report.phase('auth'):
+        ksc = get_cached_keystone_client(id_conf['api_version'])
+    with report.phase('catalog'):
+        services = ksc.services
+        servicenames = [s['name'] for s in services]
+        ps_service_exists = PRODUCT_STREAMS_SERVICE_NAME in servicenames
 
-    object_store_present = is_object_store_present(ksc, region_name)
+        object_store_present = is_object_store_present(ksc, region_name)
 
     use_swift = charm_conf['use_swift']
     log.info("ps_service_exists={}, charm_conf['use_swift']={}"
@@ -605,20 +4443,39 @@ def main():
 
     try:
         if not assess_object_store_state(object_store_present, use_swift):
+            # Look for newly registered endpoints on the next run.
+            invalidate_keystone_cache()
             return
 
         is_object_store_present_and_used = use_swift and object_store_present
+        local_streams_url = get_local_streams_url(charm_conf)
         if ps_service_exists and is_object_store_present_and_used:
             log.info("Updating product streams service.")
-            update_product_streams_service(ksc, services, region_name)
+            with report.phase('catalog'):
+                update_product_streams_service(ksc, services, region_name)
+        elif ps_service_exists and local_streams_url:
+            log.info("Pointing product streams service at {}.".format(
+                local_streams_url))
+            update_endpoint_urls(region_name, local_streams_url,
+                                 local_streams_url, local_streams_url)
         else:
             log.info("Not updating product streams service.")
 
         log.info("Beginning image sync")
         status_set('maintenance', 'Synchronising images')
+        # Rather than with the first progress update.
+        hook_tools.flush()
 
-        do_sync(ksc, charm_conf)
-        set_active_status(is_object_store_present_and_used)
+        progress = SyncProgress(report, len(charm_conf['mirror_list']))
+        progress.start()
+        try:
+            with report.phase('sync'):
+                do_sync(ksc, charm_conf, force=force, session=session,
+                        report=report, metrics=metrics)
+        finally:
+            progress.stop()
+        set_active_status(is_object_store_present_and_used,
+                          local_streams_url is not None)
 
         # If this is an initial per-minute sync attempt, delete it on success.
         if os.path.exists(CRON_POLL_FILENAME):
@@ -630,18 +4487,276 @@ def main():
         # matching string "{PublicURL} endpoint for {type}{region} not
         # found".  where {type} is 'image' and {region} is potentially
         # not empty so we only match on this substring:
+        invalidate_keystone_cache()
         if 'endpoint for image' in e.message:
             log.info("Glance endpoint not found, will continue polling.")
             returncode = os.EX_UNAVAILABLE
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, MirrorSyncError) as e:
         returncode = e.returncode
         log.exception("Exception during syncing:")
+        if any(is_unauthorized(error)
+               for _, error in getattr(e, 'failures', [])):
+            invalidate_keystone_cache()
+        status_set('blocked', 'Image sync failed, retrying soon.')
+    except (keystone_exceptions.Unauthorized, requests.HTTPError) as e:
+        if not is_unauthorized(e):
+            raise
+        # The cached token was revoked or keystone restarted, the next run
+        # authenticates again.
+        invalidate_keystone_cache()
+        returncode = 1
+        log.exception("Keystone token rejected during syncing:")
         status_set('blocked', 'Image sync failed, retrying soon.')
 
+    try:
+        log.info("sync report written to {}".format(
+            report.write(returncode)))
+    except (IOError, OSError) as e:
+        log.warning("could not write sync report: {}".format(e))
+    if metrics is not None:
+        metrics.update(report, returncode)
     log.info("sync done.")
     return returncode
 
 
+class SyncDaemon(object):
+    """Long running sync scheduler, an alternative to the cron jobs.
+
+    Syncs on start-up and retries every DAEMON_POLL_INTERVAL seconds until
+    a sync succeeded, then syncs at the configured frequency with some
+    jitter. A sync can be requested at any time through
+    TRIGGER_SOCKET_NAME: requests arriving while a sync runs are all
+    answered by a single follow-up sync. The HTTP session and keystone
+    cache stay warm between syncs.
+    """
+
+    def __init__(self):
+        self.session = get_http_session()
+        self.synced_once = False
+        self._requests = []
+        self._lock = threading.Lock()
+        self._trigger = threading.Event()
+
+    def listen(self):
+        """Accept sync requests on the trigger socket."""
+        if os.path.exists(TRIGGER_SOCKET_NAME):
+            os.unlink(TRIGGER_SOCKET_NAME)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(TRIGGER_SOCKET_NAME)
+        finally:
+            os.umask(old_umask)
+        server.listen(5)
+        thread = threading.Thread(target=self._accept, args=(server,))
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self, server):
+        while True:
+            conn, _ = server.accept()
+            # A client slow to send its request must not hold up others.
+            conn.settimeout(TRIGGER_REQUEST_TIMEOUT)
+            thread = threading.Thread(target=self._read_request,
+                                      args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _read_request(self, conn):
+        try:
+            request = json.loads(conn.makefile('r').readline() or '{}')
+        except (socket.error, ValueError) as e:
+            log.warning("invalid sync request: {}".format(e))
+            conn.close()
+            return
+        log.info("sync requested: {}".format(request))
+        self.request(conn, request)
+
+    def request(self, conn, request):
+        """Queue a sync request answered once the next sync finished.
+
+        :param conn: Connection to send the sync result to.
+        :type conn: :class: `socket.socket`
+        :param dict request: The request, {'force': bool}.
+        """
+        with self._lock:
+            self._requests.append((conn, request))
+        self._trigger.set()
+
+    def sync(self, force):
+        try:
+            return run_coalesced_sync(force=force, wait=True,
+                                      session=self.session)
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        except Exception:
+            log.exception("Unexpected exception during syncing:")
+            return 1
+
+    def run_once(self):
+        """Run a sync serving all requests queued so far."""
+        with self._lock:
+            requests, self._requests = self._requests, []
+            self._trigger.clear()
+        force = any(request.get('force') for _, request in requests)
+        returncode = self.sync(force)
+        if returncode == 0:
+            self.synced_once = True
+        reply = json.dumps({'returncode': returncode}).encode('utf-8')
+        for conn, _ in requests:
+            try:
+                conn.sendall(reply + b'\n')
+            except socket.error as e:
+                log.debug("could not send sync result: {}".format(e))
+            finally:
+                conn.close()
+        return returncode
+
+    def next_interval(self, returncode):
+        """Seconds to wait before the next scheduled sync."""
+        if returncode != 0 and not self.synced_once:
+            return DAEMON_POLL_INTERVAL
+        try:
+            frequency = read_conf(CHARM_CONF_FILE_NAME).get('frequency')
+        except Exception:
+            frequency = None
+        interval = SYNC_INTERVALS.get(frequency, SYNC_INTERVALS['daily'])
+        return interval * (1 + random.uniform(-1, 1) * DAEMON_JITTER)
+
+    def run(self):
+        self.listen()
+        while True:
+            returncode = self.run_once()
+            interval = self.next_interval(returncode)
+            log.info("next sync in {:.0f} seconds".format(interval))
+            self._trigger.wait(interval)
+
+
+class PeerCacheHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve verified blobs of the staging cache by their sha256.
+
+    Only GET /<sha256> of complete blobs is served, with support for
+    resuming through a single open-ended range.
+    """
+
+    def do_GET(self):
+        match = PEER_CACHE_BLOB_RE.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        blob_path = os.path.join(self.server.path, match.group(1))
+        try:
+            f = open(blob_path, 'rb')
+        except IOError:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            match = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+            if match:
+                offset = int(match.group(1))
+                if offset >= size:
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    offset, size - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size - offset))
+            self.end_headers()
+            f.seek(offset)
+            try:
+                shutil.copyfileobj(f, self.wfile, DOWNLOAD_CHUNK_SIZE)
+            except socket.error as e:
+                log.debug("serving {} interrupted: {}".format(self.path, e))
+
+    def log_message(self, format, *args):
+        log.debug("peer cache: {} {}".format(self.address_string(),
+                                             format % args))
+
+
+class PeerCacheServer(socketserver.ThreadingMixIn,
+                      BaseHTTPServer.HTTPServer):
+    """HTTP server sharing the staging cache with peer units.
+
+    :param int port: Port to listen on.
+    :param str path: Directory of the staging cache.
+    :param str address: Address to listen on, all addresses if empty.
+    :param clients: Addresses of the peers to serve, anyone if None.
+    :type clients: None | list[str]
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port, path=None, address='', clients=None):
+        self.path = path or STAGING_CACHE_DIR
+        self.clients = None if clients is None else set(clients)
+        if ':' in address:
+            self.address_family = socket.AF_INET6
+        BaseHTTPServer.HTTPServer.__init__(self, (address, port),
+                                           PeerCacheHandler)
+
+    def verify_request(self, request, client_address):
+        if self.clients is None or client_address[0] in self.clients:
+            return True
+        log.warning("refusing staging cache request from {}, not a peer "
+                    "unit".format(client_address[0]))
+        return False
+
+
+def serve_cache():
+    """Serve the staging cache to peer units on peer_cache_port."""
+    charm_conf = read_conf(CHARM_CONF_FILE_NAME)
+    port = int(charm_conf.get('peer_cache_port') or 0)
+    if not port:
+        log.error("peer_cache_port is not set, not serving the staging "
+                  "cache")
+        return 1
+    if not os.path.isdir(STAGING_CACHE_DIR):
+        os.makedirs(STAGING_CACHE_DIR, 0o700)
+    # Requests are compared by IP address, peers may be known by name.
+    clients = set()
+    for peer in charm_conf.get('peer_cache_clients') or []:
+        try:
+            clients.update(info[4][0] for info in socket.getaddrinfo(
+                peer, None, 0, socket.SOCK_STREAM))
+        except socket.error as e:
+            log.warning("could not resolve peer {}: {}".format(peer, e))
+    address = charm_conf.get('peer_cache_address') or ''
+    log.info("serving the staging cache on {}:{} to {} peer(s)".format(
+        address, port, len(clients)))
+    PeerCacheServer(port, address=address,
+                    clients=clients).serve_forever()
+    return 0
+
+
+def main(args=None):
+
+    if args is None:
+        args = parse_args([])
+
+    log.info("glance-simplestreams-sync started.")
+
+    try:
+        if args.daemon:
+            return SyncDaemon().run()
+
+        if args.plan:
+            return run_plan()
+
+        if args.serve_cache:
+            return serve_cache()
+
+        return run_coalesced_sync(force=args.force, wait=args.wait)
+    finally:
+        # Statuses set out of hook context are only queued, also on
+        # sys.exit() by get_conf.
+        hook_tools.flush()
+
+
 if __name__ == "__main__":
     setup_file_logging()
-    sys.exit(main())
+    sys.exit(main(parse_args(sys.argv[1:])))
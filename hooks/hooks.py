@@ -15,9 +15,11 @@
 # limitations under the License.
 
 import base64
+import filecmp
 import glob
 import os
 import shutil
+import subprocess
 import sys
 
 
@@ -32,7 +34,8 @@ def _add_path(path):
 
 _add_path(_root)
 
-from charmhelpers.fetch import add_source, apt_install, apt_update
+from charmhelpers.fetch import (add_source, apt_install, apt_update,
+                                filter_installed_packages)
 from charmhelpers.fetch.snap import snap_install
 from charmhelpers.core import hookenv
 from charmhelpers.payload.execd import execd_preinstall
@@ -61,6 +64,10 @@ from charmhelpers.core.host import (
     CompareHostReleases,
     lsb_release,
     install_ca_cert,
+    service,
+    service_reload,
+    service_restart,
+    service_stop,
     write_file,
 )
 
@@ -81,6 +88,18 @@ CRON_JOB_FILENAME = 'glance_simplestreams_sync'
 CRON_POLL_FILENAME = 'glance_simplestreams_sync_fastpoll'
 CRON_POLL_FILEPATH = os.path.join(CRON_D, CRON_POLL_FILENAME)
 
+SYSTEMD_SYSTEM_DIR = '/etc/systemd/system'
+DAEMON_SERVICE_NAME = 'glance-simplestreams-sync'
+DAEMON_UNIT_FILENAME = DAEMON_SERVICE_NAME + '.service'
+PEER_CACHE_SERVICE_NAME = 'glance-simplestreams-sync-cache'
+PEER_CACHE_UNIT_FILENAME = PEER_CACHE_SERVICE_NAME + '.service'
+
+APACHE_CONF_DIR = '/etc/apache2/conf-available'
+APACHE_CONF_NAME = 'glance-simplestreams-sync'
+APACHE_CONF_FILENAME = 'glance-simplestreams-sync-apache.conf'
+# Path of the streams metadata published with local_streams.
+LOCAL_STREAMS_PATH = 'simplestreams/data'
+
 ERR_FILE_EXISTS = 17
 
 PACKAGES = ['python-glanceclient',
@@ -89,7 +108,7 @@ PACKAGES = ['python-glanceclient',
 
 PY3_PACKAGES = ['python3-glanceclient',
                 'python3-yaml', 'python3-keystoneclient',
-                'python3-swiftclient']
+                'python3-swiftclient', 'python3-simplestreams']
 
 KEYSTONE_CA_CERT = "/usr/local/share/ca-certificates/keystone_juju_ca_cert.crt"
 VAULT_CA_CERT = "/usr/local/share/ca-certificates/vault_juju_ca_cert.crt"
@@ -174,12 +193,43 @@ class MirrorsConfigServiceContext(OSContextGenerator):
         if len(modify_hook_scripts) == 0:
             modify_hook_scripts.append('/bin/true')
 
+        # Staging caches advertised by peer units, see cluster_changed.
+        peers = hookenv.relations_of_type('cluster')
+        peer_caches = sorted(set(
+            unit['cache-url'] for unit in peers if unit.get('cache-url')))
+        # The staging cache is only served to peer units, on the address
+        # it is advertised on.
+        peer_cache_clients = sorted(set(
+            unit['private-address'] for unit in peers
+            if unit.get('private-address')))
+        peer_cache_address = None
+        if get_peer_cache_url():
+            peer_cache_address = hookenv.unit_get('private-address')
+
         if config.get('custom_keyring'):
             keyring_path = CUSTOM_KEYRING_PATH
         else:
             keyring_path = '/usr/share/keyrings/ubuntu-cloudimage-keyring.gpg'
 
         return dict(mirror_list=config['mirror_list'],
+                    mirror_concurrency=config['mirror_concurrency'],
+                    sync_engine=config['sync_engine'],
+                    staging_cache_size=config['staging_cache_size'],
+                    streaming_upload=config['streaming_upload'],
+                    incremental_sync=config['incremental_sync'],
+                    retention_mode=config['retention_mode'],
+                    retention_concurrency=config['retention_concurrency'],
+                    bandwidth_limit=config['bandwidth_limit'],
+                    bandwidth_schedule=config['bandwidth_schedule'],
+                    transfer_priority=config['transfer_priority'],
+                    peer_cache_port=config['peer_cache_port'],
+                    peer_cache_address=peer_cache_address,
+                    peer_cache_clients=peer_cache_clients,
+                    peer_caches=peer_caches,
+                    local_streams=config['local_streams'],
+                    local_streams_url=get_local_streams_url(),
+                    metrics_textfile_dir=config['metrics_textfile_dir'],
+                    frequency=config['frequency'],
                     modify_hook_scripts=', '.join(modify_hook_scripts),
                     name_prefix=config['name_prefix'],
                     visibility=config['visibility'],
@@ -188,6 +238,7 @@ class MirrorsConfigServiceContext(OSContextGenerator):
                     ignore_proxy_for_object_store=config[
                         'ignore_proxy_for_object_store'],
                     region=config['region'],
+                    additional_regions=config['additional_regions'],
                     cloud_name=config['cloud_name'],
                     user_agent=config['user_agent'],
                     custom_properties=config['custom_properties'],
@@ -269,6 +320,102 @@ def uninstall_cron_poll():
         os.remove(CRON_POLL_FILEPATH)
 
 
+def install_sync_daemon():
+    """Installs and (re)starts the systemd sync daemon."""
+    shutil.copy(os.path.join("files", DAEMON_UNIT_FILENAME),
+                SYSTEMD_SYSTEM_DIR)
+    service_reload_daemon()
+    service('enable', DAEMON_SERVICE_NAME)
+    service_restart(DAEMON_SERVICE_NAME)
+
+
+def uninstall_sync_daemon():
+    "Stops and removes the systemd sync daemon"
+    unit_path = os.path.join(SYSTEMD_SYSTEM_DIR, DAEMON_UNIT_FILENAME)
+    if os.path.isfile(unit_path):
+        service_stop(DAEMON_SERVICE_NAME)
+        service('disable', DAEMON_SERVICE_NAME)
+        os.remove(unit_path)
+        service_reload_daemon()
+
+
+def install_peer_cache_service():
+    """Installs and (re)starts the staging cache server for peer units."""
+    shutil.copy(os.path.join("files", PEER_CACHE_UNIT_FILENAME),
+                SYSTEMD_SYSTEM_DIR)
+    service_reload_daemon()
+    service('enable', PEER_CACHE_SERVICE_NAME)
+    service_restart(PEER_CACHE_SERVICE_NAME)
+
+
+def uninstall_peer_cache_service():
+    "Stops and removes the staging cache server for peer units"
+    unit_path = os.path.join(SYSTEMD_SYSTEM_DIR, PEER_CACHE_UNIT_FILENAME)
+    if os.path.isfile(unit_path):
+        service_stop(PEER_CACHE_SERVICE_NAME)
+        service('disable', PEER_CACHE_SERVICE_NAME)
+        os.remove(unit_path)
+        service_reload_daemon()
+
+
+def get_peer_cache_url():
+    """Return the URL peer units fetch staging cache blobs from.
+
+    :returns: None if the staging cache is not shared.
+    :rtype: None | str
+    """
+    config = hookenv.config()
+    if not (config['peer_cache_port'] and config['staging_cache_size']):
+        return None
+    return 'http://{}:{}'.format(hookenv.unit_get('private-address'),
+                                 config['peer_cache_port'])
+
+
+def get_local_streams_url():
+    """Return the URL of the streams metadata published on this unit.
+
+    :returns: None if metadata is not published locally.
+    :rtype: None | str
+    """
+    config = hookenv.config()
+    if config['use_swift'] or not config['local_streams']:
+        return None
+    return 'http://{}/{}'.format(hookenv.unit_get('private-address'),
+                                 LOCAL_STREAMS_PATH)
+
+
+def install_local_streams_server():
+    """Installs apache to serve streams metadata published by the sync.
+
+    Nothing is done if apache already serves the current configuration.
+    """
+    packages = filter_installed_packages(['apache2'])
+    if packages:
+        apt_install(packages, fatal=True)
+    source = os.path.join("files", APACHE_CONF_FILENAME)
+    conf_path = os.path.join(APACHE_CONF_DIR, APACHE_CONF_NAME + '.conf')
+    if (os.path.isfile(conf_path) and
+            filecmp.cmp(source, conf_path, shallow=False)):
+        return
+    shutil.copy(source, conf_path)
+    subprocess.check_call(['a2enmod', 'rewrite', 'headers'])
+    subprocess.check_call(['a2enconf', APACHE_CONF_NAME])
+    service_reload('apache2')
+
+
+def uninstall_local_streams_server():
+    "Stops serving streams metadata, apache itself is left installed"
+    conf_path = os.path.join(APACHE_CONF_DIR, APACHE_CONF_NAME + '.conf')
+    if os.path.isfile(conf_path):
+        subprocess.check_call(['a2disconf', APACHE_CONF_NAME])
+        os.remove(conf_path)
+        service_reload('apache2')
+
+
+def service_reload_daemon():
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+
+
 @hooks.hook('identity-service-relation-joined')
 def identity_service_joined(relation_id=None):
     config = hookenv.config()
@@ -279,7 +426,8 @@ def identity_service_joined(relation_id=None):
     # necessarily know the swift endpoint URL (it might not even exist
     # yet).
 
-    url = 'http://' + hookenv.unit_get('private-address')
+    url = (get_local_streams_url() or
+           'http://' + hookenv.unit_get('private-address'))
     relation_data = {
         'service': 'image-stream',
         'region': config['region'],
@@ -297,6 +445,23 @@ def identity_service_changed():
     ensure_perms()
 
 
+@hooks.hook('cluster-relation-joined')
+def cluster_joined(relation_id=None):
+    hookenv.relation_set(relation_id=relation_id,
+                         **{'cache-url': get_peer_cache_url()})
+
+
+@hooks.hook('cluster-relation-changed',
+            'cluster-relation-departed')
+def cluster_changed():
+    configs = get_configs()
+    configs.write(MIRRORS_CONF_FILE_NAME)
+    ensure_perms()
+    if get_peer_cache_url():
+        # The server only admits the peers known when it started.
+        service_restart(PEER_CACHE_SERVICE_NAME)
+
+
 @hooks.hook('install.real')
 def install():
     execd_preinstall()
@@ -354,16 +519,35 @@ def config_changed():
         hookenv.log("'frequency' changed, removing cron job")
         uninstall_cron_script()
 
-    if config['run']:
+    if config['run'] and config['sync_scheduler'] == 'daemon':
+        hookenv.log("installing sync daemon, removing cron jobs")
+        uninstall_cron_script()
+        uninstall_cron_poll()
+        install_sync_daemon()
+    elif config['run']:
         hookenv.log("installing to cronjob to "
                     "/etc/cron.{}".format(config['frequency']))
         hookenv.log("installing {} for polling".format(CRON_POLL_FILEPATH))
+        uninstall_sync_daemon()
         install_cron_poll()
         install_cron_script()
     else:
         hookenv.log("'run' set to False, removing cron jobs")
         uninstall_cron_script()
         uninstall_cron_poll()
+        uninstall_sync_daemon()
+
+    if get_local_streams_url():
+        install_local_streams_server()
+    else:
+        uninstall_local_streams_server()
+
+    if get_peer_cache_url():
+        install_peer_cache_service()
+    else:
+        uninstall_peer_cache_service()
+    for relation_id in hookenv.relation_ids('cluster'):
+        cluster_joined(relation_id)
 
     if config.get('ssl_ca'):
         install_ca_cert(
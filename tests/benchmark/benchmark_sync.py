@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Offline end-to-end benchmark of glance_simplestreams_sync.main().
+
+Synthetic streams are generated and served together with keystone, glance
+and swift stand-ins (see fake_cloud), the script's configuration, state and
+lock files are redirected into a temporary directory and juju hook tools
+are replaced by stubs counting their invocations. main() then runs in this
+process and the wall time, throughput, peak RSS and API calls are reported.
+
+Run from the top of the charm, e.g.:
+
+    python3 tests/benchmark/benchmark_sync.py --products 4 --versions 2 \\
+        --image-size 64 --runs 2 --engine native
+
+Later runs show the cost of a sync without upstream changes. The native
+engine needs the simplestreams python library, the snap engine
+/snap/bin/simplestreams.sstream-mirror-glance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from unittest import mock
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+import fake_cloud  # noqa: E402
+import files.glance_simplestreams_sync as gss  # noqa: E402
+
+HOOK_TOOLS = {
+    'status-set': '',
+    'relation-ids': 'echo identity-service:1',
+    'relation-set': '',
+}
+
+
+def install_hook_tools(bin_dir, calls_log):
+    """Install stubs of juju-exec and the hook tools used by the script."""
+    os.makedirs(bin_dir)
+    scripts = dict(HOOK_TOOLS)
+    # The unit name is dropped and the command run by the shell, like
+    # juju-exec does in the unit's context.
+    scripts['juju-exec'] = 'shift; exec /bin/bash -c "$1"'
+    scripts['juju-run'] = scripts['juju-exec']
+    for name, body in scripts.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/bash\necho "{}" >> {}\n{}\n'.format(
+                name, calls_log, body))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def write_config(conf_dir, cloud, streams, args):
+    os.makedirs(conf_dir)
+    identity = {
+        'api_version': 3,
+        'auth_host': '127.0.0.1',
+        'auth_port': cloud.httpd.server_address[1],
+        'auth_protocol': 'http',
+        'service_host': '127.0.0.1',
+        'service_port': cloud.httpd.server_address[1],
+        'service_protocol': 'http',
+        'internal_host': '127.0.0.1',
+        'internal_port': cloud.httpd.server_address[1],
+        'internal_protocol': 'http',
+        'admin_tenant_id': cloud.PROJECT_ID,
+        'admin_tenant_name': 'services',
+        'admin_user': 'admin',
+        'admin_password': 'benchmark',
+        'admin_domain_name': 'default',
+        'unit_name': 'glance-simplestreams-sync/0',
+    }
+    mirrors = {
+        'mirror_list': [{
+            'url': cloud.mirror_url,
+            'name_prefix': 'benchmark:released',
+            'path': streams.index_path,
+            'max': args.versions,
+            'item_filters': ['arch~(x86_64|amd64)', 'ftype~(disk1.img)'],
+        }],
+        'mirror_concurrency': 1,
+        'sync_engine': args.engine,
+        'staging_cache_size': args.staging_cache_size,
+        'streaming_upload': args.streaming_upload,
+        'incremental_sync': args.incremental_sync,
+        'bandwidth_limit': args.bandwidth_limit,
+        'metrics_textfile_dir': '',
+        'frequency': 'hourly',
+        'user_agent': 'glance-simplestreams-sync-benchmark',
+        'modify_hook_scripts': '',
+        'name_prefix': 'auto-sync/',
+        'visibility': 'public',
+        'use_swift': True,
+        'ignore_proxy_for_object_store': True,
+        'region': cloud.region,
+        'additional_regions': '',
+        'cloud_name': 'benchmark',
+        'content_id_template': 'auto.sync',
+        'hypervisor_mapping': False,
+        'image_import_conversion': False,
+        'keyring_path': (streams.keyring if streams.sign
+                         else gss.DEFAULT_KEYRING),
+    }
+    with open(os.path.join(conf_dir, 'identity.yaml'), 'w') as f:
+        yaml.safe_dump(identity, f)
+    with open(os.path.join(conf_dir, 'mirrors.yaml'), 'w') as f:
+        yaml.safe_dump(mirrors, f)
+
+
+def redirect_paths(workdir):
+    """Patch the script's well-known paths into workdir."""
+    state_dir = os.path.join(workdir, 'state')
+    conf_dir = os.path.join(workdir, 'conf')
+    paths = {
+        'CHARM_CONF_FILE_NAME': os.path.join(conf_dir, 'mirrors.yaml'),
+        'ID_CONF_FILE_NAME': os.path.join(conf_dir, 'identity.yaml'),
+        'SYNC_RUNNING_FLAG_FILE_NAME': os.path.join(workdir, 'sync.pid'),
+        'SYNC_QUEUE_FILE_NAME': os.path.join(workdir, 'sync.queue'),
+        'PROGRESS_FILE_NAME': os.path.join(workdir, 'sync.progress'),
+        'STATE_DIR': state_dir,
+        'SYNC_STATE_FILE_NAME': os.path.join(state_dir, 'sync-state.json'),
+        'KEYSTONE_CACHE_FILE_NAME': os.path.join(state_dir,
+                                                 'keystone-cache.json'),
+        'SYNC_REPORT_DIR': os.path.join(state_dir, 'reports'),
+        'SIGNATURE_CACHE_FILE_NAME': os.path.join(state_dir,
+                                                  'signature-cache.json'),
+        'METRICS_STATE_FILE_NAME': os.path.join(state_dir, 'metrics.json'),
+        'STAGING_CACHE_DIR': os.path.join(workdir, 'blobs'),
+        'CRON_POLL_FILENAME': os.path.join(workdir, 'fastpoll'),
+        'CACERT_FILE': os.path.join(workdir, 'cacert.pem'),
+        'SSTREAM_LOG_FILE': os.path.join(workdir, 'sstream-mirror.log'),
+    }
+    return [mock.patch.object(gss, name, value)
+            for name, value in paths.items()], conf_dir
+
+
+def peak_rss_mb():
+    """Peak RSS of this process and of its waited-for children."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+
+
+def run_once(cloud, calls_log):
+    calls_before = dict(cloud.calls)
+    uploaded_before = cloud.bytes_uploaded
+    served_before = cloud.bytes_served
+    open(calls_log, 'w').close()
+    gss.hook_tools = gss.HookToolSession()
+
+    start = time.time()
+    try:
+        returncode = gss.main(gss.parse_args(['--force']))
+    except SystemExit as e:
+        returncode = e.code
+    finally:
+        gss.cleanup()
+    wall = time.time() - start
+
+    with open(calls_log) as f:
+        hook_calls = [line.strip() for line in f]
+    api_calls = {}
+    for (service, method), count in cloud.calls.items():
+        count -= calls_before.get((service, method), 0)
+        if count:
+            api_calls['{} {}'.format(service, method)] = count
+    uploaded = cloud.bytes_uploaded - uploaded_before
+    return {
+        'returncode': returncode,
+        'wall_seconds': round(wall, 3),
+        'bytes_downloaded': cloud.bytes_served - served_before,
+        'bytes_uploaded': uploaded,
+        'upload_bytes_per_second': round(uploaded / wall) if wall else 0,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'api_calls': api_calls,
+        'juju_exec_calls': hook_calls.count('juju-exec') +
+        hook_calls.count('juju-run'),
+        'hook_tool_calls': len(hook_calls),
+        'glance_images': len(cloud.images),
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--products', type=int, default=2)
+    parser.add_argument('--versions', type=int, default=2)
+    parser.add_argument('--image-size', type=int, default=16,
+                        help='size of every image in MiB')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='number of consecutive syncs to measure')
+    parser.add_argument('--engine', choices=['native', 'snap'],
+                        default='native')
+    parser.add_argument('--staging-cache-size', type=int, default=0)
+    parser.add_argument('--streaming-upload', action='store_true')
+    parser.add_argument('--incremental-sync', action='store_true')
+    parser.add_argument('--bandwidth-limit', type=int, default=0,
+                        help='download limit in Mbit/s')
+    parser.add_argument('--unsigned', action='store_true',
+                        help='do not sign the generated streams')
+    parser.add_argument('--output', help='also write the results as JSON')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the working directory')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.engine == 'native' and not gss.NativeSyncEngine.is_available():
+        sys.exit('the native engine needs the simplestreams python library')
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='gss-benchmark-')
+    streams_dir = os.path.join(workdir, 'mirror')
+    os.makedirs(streams_dir)
+    print('generating streams in {}'.format(streams_dir))
+    streams = fake_cloud.SyntheticStreams(
+        streams_dir, args.products, args.versions,
+        args.image_size * 1024 * 1024, sign=not args.unsigned).generate()
+    cloud = fake_cloud.FakeCloud(streams_dir).start()
+
+    bin_dir = os.path.join(workdir, 'bin')
+    calls_log = os.path.join(workdir, 'hook-tools.log')
+    install_hook_tools(bin_dir, calls_log)
+    patches, conf_dir = redirect_paths(workdir)
+    write_config(conf_dir, cloud, streams, args)
+    home = os.path.join(workdir, 'home')
+    os.makedirs(home)
+    env = {
+        'HOME': home,
+        'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+        'NO_PROXY': '127.0.0.1', 'no_proxy': '127.0.0.1',
+    }
+
+    results = {'parameters': vars(args),
+               'stream_bytes': streams.total_bytes, 'runs': []}
+    try:
+        with mock.patch.dict(os.environ, env):
+            os.environ.pop('JUJU_CONTEXT_ID', None)
+            for patch in patches:
+                patch.start()
+            try:
+                for run in range(args.runs):
+                    result = run_once(cloud, calls_log)
+                    results['runs'].append(result)
+                    print('run {}: {}'.format(
+                        run + 1, json.dumps(result, sort_keys=True)))
+            finally:
+                for patch in patches:
+                    patch.stop()
+    finally:
+        cloud.stop()
+        if args.keep:
+            print('working directory kept in {}'.format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0 if all(r['returncode'] == 0 for r in results['runs']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
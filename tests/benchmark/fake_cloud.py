@@ -0,0 +1,476 @@
+#
+# Copyright 2024 Canonical Ltd.
+#
+# This file is part of the glance-simplestreams sync charm.
+
+# The glance-simplestreams sync charm is free software: you can
+# redistribute it and/or modify it under the terms of the GNU Affero General
+# Public License as published by the Free Software Foundation, either
+# version 3 of the License, or (at your option) any later version.
+#
+# The charm is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this charm.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local stand-ins for a simplestreams mirror, keystone, glance and swift.
+
+Everything is served by a single threaded HTTP server on 127.0.0.1 and kept
+in memory, apart from the synthetic streams which are generated into a
+directory. Only the parts of the APIs used by glance-simplestreams-sync,
+sstream-mirror-glance and the python clients they use are implemented.
+"""
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+
+from http import server
+from urllib import parse as urlparse
+
+CHUNK_SIZE = 1024 * 1024
+
+IMAGE_SCHEMA = {
+    'name': 'image',
+    'properties': {
+        'id': {'type': 'string'},
+        'name': {'type': ['null', 'string']},
+        'status': {'type': 'string'},
+        'visibility': {'type': 'string'},
+        'container_format': {'type': ['null', 'string']},
+        'disk_format': {'type': ['null', 'string']},
+        'checksum': {'type': ['null', 'string']},
+        'size': {'type': ['null', 'integer']},
+        'tags': {'type': 'array', 'items': {'type': 'string'}},
+    },
+    'additionalProperties': {'type': 'string'},
+}
+
+
+class SyntheticStreams(object):
+    """Generate a simplestreams mirror with synthetic images.
+
+    Every product has versions versions of a single disk1.img item of
+    image_size bytes. With sign set and gpg available, the index and the
+    products document are also clearsigned as .sjson with a throw-away key
+    exported to keyring.
+
+    :param str path: Directory to generate the mirror in.
+    :param int products: Number of products.
+    :param int versions: Number of versions per product.
+    :param int image_size: Size of every image in bytes.
+    :param bool sign: Whether to generate signed documents.
+    """
+
+    CONTENT_ID = 'com.example.benchmark:released:download'
+
+    def __init__(self, path, products=2, versions=2, image_size=CHUNK_SIZE,
+                 sign=True):
+        self.path = path
+        self.products = products
+        self.versions = versions
+        self.image_size = image_size
+        self.sign = sign and shutil.which('gpg') is not None
+        self.keyring = os.path.join(path, 'keyring.gpg')
+        self.total_bytes = 0
+
+    @property
+    def index_path(self):
+        return 'streams/v1/index.{}'.format('sjson' if self.sign else 'json')
+
+    def _write_image(self, rel_path, seed):
+        abs_path = os.path.join(self.path, rel_path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        block = hashlib.sha256(seed.encode('utf-8')).digest() * (
+            CHUNK_SIZE // 32)
+        sha256, md5 = hashlib.sha256(), hashlib.md5()
+        remaining = self.image_size
+        with open(abs_path, 'wb') as f:
+            while remaining > 0:
+                chunk = block[:remaining]
+                f.write(chunk)
+                sha256.update(chunk)
+                md5.update(chunk)
+                remaining -= len(chunk)
+        self.total_bytes += self.image_size
+        return {'ftype': 'disk1.img', 'path': rel_path,
+                'size': self.image_size, 'sha256': sha256.hexdigest(),
+                'md5': md5.hexdigest()}
+
+    def _write_json(self, rel_path, data):
+        abs_path = os.path.join(self.path, rel_path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        with open(abs_path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        if self.sign:
+            subprocess.check_call(
+                ['gpg', '--batch', '--yes', '--clearsign', '--output',
+                 re.sub(r'\.json$', '.sjson', abs_path), abs_path],
+                env=self.gpg_env)
+
+    def _create_key(self):
+        self.gpg_home = tempfile.mkdtemp()
+        self.gpg_env = dict(os.environ, GNUPGHOME=self.gpg_home)
+        subprocess.check_call(
+            ['gpg', '--batch', '--passphrase', '', '--quick-gen-key',
+             'gss-benchmark', 'default', 'default', 'never'],
+            env=self.gpg_env, stderr=subprocess.DEVNULL)
+        with open(self.keyring, 'wb') as f:
+            f.write(subprocess.check_output(['gpg', '--export'],
+                                            env=self.gpg_env))
+
+    def generate(self):
+        if self.sign:
+            self._create_key()
+        updated = datetime.datetime.utcnow().strftime(
+            '%a, %d %b %Y %H:%M:%S +0000')
+        products = {}
+        for p in range(self.products):
+            name = 'com.example.benchmark:server:{}:amd64'.format(p)
+            versions = {}
+            for v in range(self.versions):
+                serial = '2024010{}'.format(v + 1)
+                versions[serial] = {'items': {'disk1.img': self._write_image(
+                    'server/{}/{}/disk1.img'.format(p, serial),
+                    '{}-{}'.format(name, serial))}}
+            products[name] = {'arch': 'amd64', 'os': 'ubuntu',
+                              'release': 'bench{}'.format(p),
+                              'version': '{}.04'.format(p),
+                              'versions': versions}
+        products_path = 'streams/v1/{}.json'.format(self.CONTENT_ID)
+        self._write_json(products_path, {
+            'content_id': self.CONTENT_ID, 'datatype': 'image-downloads',
+            'format': 'products:1.0', 'updated': updated,
+            'products': products})
+        self._write_json('streams/v1/index.json', {
+            'format': 'index:1.0', 'updated': updated,
+            'index': {self.CONTENT_ID: {
+                'datatype': 'image-downloads', 'format': 'products:1.0',
+                'path': products_path, 'updated': updated,
+                'products': sorted(products)}}})
+        if self.sign:
+            shutil.rmtree(self.gpg_home)
+        return self
+
+
+class FakeCloud(object):
+    """HTTP server standing in for the streams mirror and the cloud.
+
+    Services are told apart by the first path component: /mirror/ serves
+    the generated streams, /v3, /glance/v2 and /swift/v1 the APIs.
+    Every request is counted by service and method.
+
+    :param str streams_dir: Directory generated by SyntheticStreams.
+    :param str region: Region of all catalog endpoints.
+    """
+
+    PROJECT_ID = 'b1e4c3d2a5f6478980a1b2c3d4e5f601'
+
+    def __init__(self, streams_dir, region='RegionOne'):
+        self.streams_dir = streams_dir
+        self.region = region
+        self.calls = collections.Counter()
+        self.bytes_served = 0
+        self.bytes_uploaded = 0
+        self.images = collections.OrderedDict()
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.httpd = server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                self._handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.httpd.server_address[1])
+
+    @property
+    def mirror_url(self):
+        return self.url + '/mirror/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler_class(self):
+        cloud = self
+
+        class Handler(RequestHandler):
+            pass
+        Handler.cloud = cloud
+        return Handler
+
+    def catalog(self):
+        services = [('identity', 'keystone', '/v3'),
+                    ('image', 'glance', '/glance'),
+                    ('object-store', 'swift',
+                     '/swift/v1/AUTH_{}'.format(self.PROJECT_ID))]
+        return [{
+            'id': name, 'name': name, 'type': service_type,
+            'endpoints': [{
+                'id': '{}-{}'.format(name, interface),
+                'interface': interface, 'region': self.region,
+                'region_id': self.region, 'url': self.url + path,
+            } for interface in ('public', 'internal', 'admin')],
+        } for service_type, name, path in services]
+
+    def token(self):
+        now = datetime.datetime.utcnow()
+        return {'token': {
+            'methods': ['password'],
+            'issued_at': now.strftime('%Y-%m-%dT%H:%M:%S.000000Z'),
+            'expires_at': (now + datetime.timedelta(hours=1)).strftime(
+                '%Y-%m-%dT%H:%M:%S.000000Z'),
+            'user': {'id': 'admin', 'name': 'admin',
+                     'domain': {'id': 'default', 'name': 'Default'}},
+            'project': {'id': self.PROJECT_ID, 'name': 'services',
+                        'domain': {'id': 'default', 'name': 'Default'}},
+            'roles': [{'id': 'admin', 'name': 'Admin'}],
+            'catalog': self.catalog(),
+        }}
+
+
+class RequestHandler(server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    cloud = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=None, headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+            headers = dict(headers or {}, **{
+                'Content-Type': 'application/json'})
+        body = body or b''
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_body(self):
+        """Yield the request body, chunked transfer encoding included."""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return
+                yield self.rfile.read(size)
+                self.rfile.readline()
+        remaining = int(self.headers.get('Content-Length') or 0)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+    def _json_body(self):
+        return json.loads(b''.join(self._read_body()) or b'{}')
+
+    def _dispatch(self):
+        url = urlparse.urlparse(self.path)
+        service, _, rest = url.path.lstrip('/').partition('/')
+        if service == 'v3':
+            # set_openstack_env() puts keystone at the root of a host.
+            service, rest = 'keystone', url.path.lstrip('/')
+        with self.cloud.lock:
+            self.cloud.calls[(service, self.command)] += 1
+        handler = getattr(self, '_{}'.format(service), None)
+        if handler is None:
+            return self._reply(404)
+        return handler('/' + rest, urlparse.parse_qs(url.query))
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    def _mirror(self, path, query):
+        abs_path = os.path.join(self.cloud.streams_dir, path.lstrip('/'))
+        if '..' in path or not os.path.isfile(abs_path):
+            return self._reply(404)
+        stat = os.stat(abs_path)
+        headers = {'ETag': '"{:x}-{:x}"'.format(int(stat.st_mtime),
+                                                stat.st_size),
+                   'Accept-Ranges': 'bytes'}
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= stat.st_size:
+                return self._reply(416, headers=headers)
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stat.st_size - 1, stat.st_size)
+        self.send_response(206 if match else 200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(stat.st_size - start))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with open(abs_path, 'rb') as f:
+            f.seek(start)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                self.wfile.write(chunk)
+                with self.cloud.lock:
+                    self.cloud.bytes_served += len(chunk)
+
+    def _keystone(self, path, query):
+        if path == '/v3/auth/tokens' and self.command == 'POST':
+            self._json_body()
+            return self._reply(201, self.cloud.token(), {
+                'X-Subject-Token': uuid.uuid4().hex})
+        if path == '/v3/services':
+            return self._reply(200, {'services': [{
+                'id': s['id'], 'name': s['name'], 'type': s['type'],
+                'enabled': True} for s in self.cloud.catalog()],
+                'links': {'self': None, 'next': None, 'previous': None}})
+        if path.rstrip('/') in ('', '/v3'):
+            return self._reply(200, {'version': {
+                'id': 'v3.14', 'status': 'stable',
+                'links': [{'rel': 'self', 'href': self.cloud.url + '/v3/'}],
+                'media-types': [{
+                    'base': 'application/json',
+                    'type': 'application/vnd.openstack.identity-v3+json'}],
+            }})
+        return self._reply(404)
+
+    def _image(self, image_id):
+        image = self.cloud.images.get(image_id)
+        if image is None:
+            self._reply(404)
+        return image
+
+    def _glance(self, path, query):
+        images = self.cloud.images
+        if path.rstrip('/') in ('', '/versions'):
+            return self._reply(200, {'versions': [{
+                'id': 'v2.9', 'status': 'CURRENT',
+                'links': [{'rel': 'self',
+                           'href': self.cloud.url + '/glance/v2/'}]}]})
+        if path == '/v2/schemas/image':
+            return self._reply(200, IMAGE_SCHEMA)
+        if path == '/v2/schemas/images':
+            return self._reply(200, {'name': 'images', 'properties': {
+                'images': {'type': 'array', 'items': IMAGE_SCHEMA}}})
+        if path == '/v2/images' and self.command == 'GET':
+            limit = int(query.pop('limit', ['20'])[0])
+            marker = query.pop('marker', [None])[0]
+            for key in ('sort', 'sort_key', 'sort_dir'):
+                query.pop(key, None)
+            with self.cloud.lock:
+                matches = [i for i in images.values() if all(
+                    str(i.get(k)) in v for k, v in query.items())]
+            if marker is not None:
+                ids = [i['id'] for i in matches]
+                matches = matches[ids.index(marker) + 1:]
+            body = {'images': matches[:limit], 'schema': '/v2/schemas/images',
+                    'first': '/v2/images'}
+            if len(matches) > limit:
+                body['next'] = '/v2/images?' + urlparse.urlencode(
+                    dict({k: v[0] for k, v in query.items()},
+                         limit=limit, marker=matches[limit - 1]['id']))
+            return self._reply(200, body)
+        if path == '/v2/images' and self.command == 'POST':
+            image = dict(self._json_body(), id=str(uuid.uuid4()),
+                         status='queued', checksum=None, size=None)
+            image.setdefault('tags', [])
+            image.setdefault('visibility', 'shared')
+            image['file'] = '/v2/images/{}/file'.format(image['id'])
+            image['self'] = '/v2/images/{}'.format(image['id'])
+            image['schema'] = '/v2/schemas/image'
+            with self.cloud.lock:
+                images[image['id']] = image
+            return self._reply(201, image)
+        match = re.match(r'^/v2/images/([^/]+)(/file)?$', path)
+        if not match:
+            return self._reply(404)
+        image = self._image(match.group(1))
+        if image is None:
+            return
+        if match.group(2) and self.command == 'PUT':
+            md5, size = hashlib.md5(), 0
+            for chunk in self._read_body():
+                md5.update(chunk)
+                size += len(chunk)
+            with self.cloud.lock:
+                self.cloud.bytes_uploaded += size
+            image.update(status='active', checksum=md5.hexdigest(),
+                         size=size)
+            return self._reply(204)
+        if self.command == 'GET':
+            return self._reply(200, image)
+        if self.command == 'PATCH':
+            for op in self._json_body():
+                key = op['path'].lstrip('/')
+                if op['op'] == 'remove':
+                    image.pop(key, None)
+                else:
+                    image[key] = op['value']
+            return self._reply(200, image)
+        if self.command == 'DELETE':
+            with self.cloud.lock:
+                images.pop(image['id'])
+            return self._reply(204)
+        return self._reply(405)
+
+    def _swift(self, path, query):
+        parts = path.strip('/').split('/', 3)[2:]
+        objects = self.cloud.objects
+        if not parts:
+            containers = sorted(set(c for c, _ in objects))
+            return self._reply(200 if self.command == 'GET' else 204,
+                               [{'name': c} for c in containers]
+                               if self.command == 'GET' else None)
+        container = parts[0]
+        if len(parts) == 1:
+            if self.command in ('PUT', 'POST'):
+                return self._reply(201)
+            if self.command == 'GET':
+                prefix = query.get('prefix', [''])[0]
+                with self.cloud.lock:
+                    listing = [{'name': o, 'bytes': len(data),
+                                'hash': hashlib.md5(data).hexdigest()}
+                               for (c, o), data in sorted(objects.items())
+                               if c == container and o.startswith(prefix)]
+                if query.get('marker'):
+                    listing = []
+                return self._reply(200, listing)
+            return self._reply(204)
+        key = (container, parts[1])
+        if self.command == 'PUT':
+            data = b''.join(self._read_body())
+            with self.cloud.lock:
+                objects[key] = data
+            return self._reply(201, headers={
+                'ETag': hashlib.md5(data).hexdigest()})
+        with self.cloud.lock:
+            data = objects.get(key)
+        if data is None:
+            return self._reply(404)
+        if self.command == 'DELETE':
+            with self.cloud.lock:
+                objects.pop(key, None)
+            return self._reply(204)
+        return self._reply(200, data, {
+            'ETag': hashlib.md5(data).hexdigest()})
@@ -16,8 +16,12 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import json
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
 import unittest.mock as mock
 import unittest
 
@@ -46,9 +50,14 @@ class TestActions(unittest.TestCase):
         actions._add_path(newPath)
         self.assertEqual(sys.path.count(newPath), 1)
 
+    @mock.patch("actions.action_set")
+    @mock.patch("actions.action_get")
     @mock.patch("actions.action_fail")
     @mock.patch("subprocess.call")
-    def test_sync_images(self, mock_subprocess_call, mock_action_fail):
+    def test_sync_images(self, mock_subprocess_call, mock_action_fail,
+                         mock_action_get, mock_action_set):
+        params = {"force": False, "wait": True}
+        mock_action_get.side_effect = params.get
         # test pass, action_fail not called:
         mock_subprocess_call.return_value = 0
         self.assertEqual(actions.sync_images(None), 0, "Expect exit status 0")
@@ -69,3 +78,116 @@ class TestActions(unittest.TestCase):
         mock_action_fail.assert_called_once_with(
             "{} is locked, exiting".format(FILE_PATH)
         )
+
+        # test queued behind a running sync without waiting:
+        params["wait"] = False
+        mock_action_fail.reset_mock()
+        self.assertEqual(actions.sync_images(None), 0, "Expect exit status 0")
+        self.assertFalse(mock_action_fail.called, "Should not call")
+        mock_action_set.assert_called_once_with({"result": "sync queued"})
+
+    @mock.patch("actions.action_get")
+    @mock.patch("subprocess.call")
+    def test_sync_images_force(self, mock_subprocess_call, mock_action_get):
+        mock_action_get.return_value = True
+        mock_subprocess_call.return_value = 0
+        self.assertEqual(actions.sync_images(None), 0, "Expect exit status 0")
+        mock_subprocess_call.assert_called_once_with(
+            ["/usr/share/glance-simplestreams-sync/"
+             "glance-simplestreams-sync.sh", "--force", "--wait"])
+
+    @mock.patch("actions.trigger_daemon_sync")
+    @mock.patch("actions.log")
+    @mock.patch("actions.action_get")
+    @mock.patch("os.path.exists")
+    @mock.patch("subprocess.call")
+    def test_sync_images_daemon(self, mock_subprocess_call, mock_exists,
+                                mock_action_get, mock_log,
+                                mock_trigger_daemon_sync):
+        mock_exists.return_value = True
+        mock_action_get.return_value = True
+        mock_trigger_daemon_sync.return_value = 0
+        self.assertEqual(actions.sync_images(None), 0, "Expect exit status 0")
+        mock_trigger_daemon_sync.assert_called_once_with(True, True)
+        mock_subprocess_call.assert_not_called()
+
+        # Fall back to the sync script if the daemon does not answer.
+        mock_trigger_daemon_sync.side_effect = ConnectionRefusedError()
+        mock_subprocess_call.return_value = 1
+        self.assertEqual(actions.sync_images(None), 1, "Expect exit status 1")
+        mock_subprocess_call.assert_called_once_with(
+            ["/usr/share/glance-simplestreams-sync/"
+             "glance-simplestreams-sync.sh", "--force", "--wait"])
+
+    @mock.patch("actions.action_set")
+    @mock.patch("actions.action_get")
+    @mock.patch("os.path.exists")
+    @mock.patch("subprocess.call")
+    @mock.patch("socket.socket")
+    def test_sync_images_daemon_still_running(self, mock_socket,
+                                              mock_subprocess_call,
+                                              mock_exists, mock_action_get,
+                                              mock_action_set):
+        mock_exists.return_value = True
+        mock_action_get.return_value = True
+        sock = mock_socket.return_value
+        sock.makefile.return_value.readline.side_effect = \
+            actions.socket.timeout()
+        self.assertEqual(actions.sync_images(None), 0, "Expect exit status 0")
+        self.assertEqual(sock.settimeout.call_args_list,
+                         [mock.call(actions.DAEMON_CONNECT_TIMEOUT),
+                          mock.call(actions.DAEMON_REPLY_TIMEOUT)])
+        sock.close.assert_called_once_with()
+        mock_action_set.assert_called_once_with(
+            {"result": "sync still running"})
+        mock_subprocess_call.assert_not_called()
+
+    @mock.patch("actions.action_set")
+    @mock.patch("actions.action_fail")
+    @mock.patch("subprocess.check_output")
+    def test_sync_plan(self, mock_check_output, mock_action_fail,
+                       mock_action_set):
+        mock_check_output.return_value = (
+            b'{"mirrors": [], "images_to_add": 2, "images_to_delete": 1, '
+            b'"images_to_retag": 0, "bytes_to_download": 20, '
+            b'"bytes_to_transfer": 40, "throughput": null, '
+            b'"estimated_seconds": null}')
+        self.assertEqual(actions.sync_plan(None), 0)
+        mock_check_output.assert_called_once_with(
+            [actions.SYNC_SCRIPT, "--plan"])
+        results = mock_action_set.call_args[0][0]
+        self.assertEqual(results["images-to-add"], 2)
+        self.assertEqual(results["bytes-to-transfer"], 40)
+        self.assertEqual(results["estimated-seconds"], "unknown")
+        self.assertFalse(mock_action_fail.called)
+
+        mock_check_output.side_effect = subprocess.CalledProcessError(1, [])
+        self.assertEqual(actions.sync_plan(None), 1)
+        mock_action_fail.assert_called_once()
+
+    @mock.patch("actions.function_log")
+    def test_log_progress(self, mock_function_log):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        progress_file = os.path.join(tmpdir, "progress")
+        # Progress file written before every poll, None removes it.
+        messages = ["1/2 mirrors done", "1/2 mirrors done", None,
+                    "2/2 mirrors done"]
+
+        def wait(interval):
+            if not messages:
+                return True
+            message = messages.pop(0)
+            if message is None:
+                os.unlink(progress_file)
+            else:
+                with open(progress_file, "w") as f:
+                    json.dump({"message": message}, f)
+            return False
+
+        done = mock.MagicMock()
+        done.wait.side_effect = wait
+        with mock.patch("actions.PROGRESS_FILE_NAME", progress_file):
+            actions.log_progress(done)
+        self.assertEqual(mock_function_log.call_args_list, [
+            mock.call("1/2 mirrors done"), mock.call("2/2 mirrors done")])
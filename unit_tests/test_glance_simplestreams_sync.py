@@ -16,7 +16,16 @@ See the License for the specific language governing permissions and
 limitations under the License.
 '''
 
+import collections
+import datetime
 import files.glance_simplestreams_sync as gss
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
 import unittest.mock as mock
 import unittest
 
@@ -72,6 +81,51 @@ JUJU_CONTEXT_ID=glance-simplestreams-sync/0-run-commands-3325280900519425661
 '''
         self.assertEqual(gss.juju_proxy_settings(), None)
 
+    @mock.patch.dict(gss.os.environ, {}, clear=True)
+    @mock.patch('files.glance_simplestreams_sync.get_conf')
+    @mock.patch('files.glance_simplestreams_sync.os.path.exists')
+    @mock.patch('files.glance_simplestreams_sync.random.getrandbits')
+    @mock.patch('files.glance_simplestreams_sync.subprocess.check_output')
+    def test_hook_tool_session(self, _check_output, _getrandbits, _exists,
+                               _get_conf):
+        _getrandbits.return_value = 0xabc
+        _exists.return_value = True
+        _get_conf.return_value = ({'unit_name': 'gss/0'}, {})
+        _check_output.return_value = (
+            b'==gss-abc-0==\n==gss-abc-0-rc=0==\n'
+            b'==gss-abc-1==\nidentity-service:4\n==gss-abc-1-rc=0==\n')
+        session = gss.HookToolSession()
+        session.queue(['status-set', 'maintenance', "Syncing 'images'"])
+        self.assertEqual(session.call(['relation-ids', 'identity-service']),
+                         'identity-service:4\n')
+        _check_output.assert_called_once_with([
+            'juju-exec', 'gss/0',
+            "echo '==gss-abc-0=='; status-set maintenance "
+            "'Syncing '\"'\"'images'\"'\"''; "
+            "echo \"==gss-abc-0-rc=$?==\"; "
+            "echo '==gss-abc-1=='; relation-ids identity-service; "
+            "echo \"==gss-abc-1-rc=$?==\";"])
+
+        # Nothing is run without queued commands, the unit name is only
+        # read once.
+        session.flush()
+        self.assertEqual(_check_output.call_count, 1)
+        _check_output.return_value = (
+            b'==gss-abc-0==\nERROR no relation\n==gss-abc-0-rc=2==\n')
+        with self.assertRaises(gss.subprocess.CalledProcessError) as ctx:
+            session.call(['relation-get'])
+        self.assertEqual(ctx.exception.returncode, 2)
+        _get_conf.assert_called_once_with()
+
+    @mock.patch.object(gss.hook_tools, 'flush')
+    @mock.patch.object(gss, 'run_plan')
+    def test_main_flushes_status(self, _run_plan, _flush):
+        # get_conf() sets a blocked status and exits on invalid config.
+        _run_plan.side_effect = SystemExit(1)
+        with self.assertRaises(SystemExit):
+            gss.main(gss.parse_args(['--plan']))
+        _flush.assert_called_once_with()
+
     @mock.patch('files.glance_simplestreams_sync.get_service_endpoints')
     @mock.patch('files.glance_simplestreams_sync.juju_proxy_settings')
     def test_get_sstream_mirror_proxy_env(self,
@@ -452,3 +506,1657 @@ JUJU_CONTEXT_ID=glance-simplestreams-sync/0-run-commands-3325280900519425661
         expected['OS_ENDPOINT_TYPE'] = 'internal'
 
         self.assertEqual(expected, mock_os.environ)
+
+    @mock.patch.dict(gss.os.environ, {})
+    @mock.patch('files.glance_simplestreams_sync.get_sstream_mirror_proxy_env')
+    @mock.patch('files.glance_simplestreams_sync.sync_mirror')
+    def test_do_sync(self, _sync_mirror, _get_proxy_env):
+        _get_proxy_env.return_value = {'NO_PROXY': '192.0.2.42'}
+        mirror_list = [{'url': 'http://example.com/releases/'},
+                       {'url': 'http://example.com/daily/'},
+                       {'url': 'http://example.com/minimal/'}]
+        charm_conf = {
+            'region': 'TestRegion',
+            'mirror_list': mirror_list,
+            'ignore_proxy_for_object_store': True,
+            'mirror_concurrency': 2,
+        }
+        with mock.patch.object(gss, 'log') as log:
+            results = gss.do_sync(mock.MagicMock(), charm_conf)
+        # sstream-mirror-glance runs are never concurrent.
+        log.warning.assert_called_once_with(
+            "mirror_concurrency is only supported by the native sync "
+            "engine, syncing one mirror at a time")
+        self.assertEqual(results, [(m, None) for m in mirror_list])
+        self.assertEqual(_sync_mirror.call_count, 3)
+        # The proxy environment is computed once for all mirrors.
+        _get_proxy_env.assert_called_once()
+        for call, mirror_info in zip(_sync_mirror.call_args_list,
+                                     mirror_list):
+            args, _ = call
+            self.assertEqual(args[1], mirror_info)
+            self.assertEqual(args[2]['NO_PROXY'], '192.0.2.42')
+        # The proxy settings only apply to the process during the sync.
+        self.assertNotIn('NO_PROXY', gss.os.environ)
+
+    @mock.patch.dict(gss.os.environ, {})
+    @mock.patch('files.glance_simplestreams_sync.get_sstream_mirror_proxy_env')
+    @mock.patch('files.glance_simplestreams_sync.sync_mirror')
+    def test_do_sync_failure_isolated(self, _sync_mirror, _get_proxy_env):
+        _get_proxy_env.return_value = {}
+        mirror_list = [{'url': 'http://example.com/releases/'},
+                       {'url': 'http://example.com/daily/'},
+                       {'url': 'http://example.com/minimal/'}]
+        error = subprocess.CalledProcessError(3, 'sstream-mirror-glance')
+
+        def sync_mirror_side_effect(charm_conf, mirror_info, env, engine,
+                                    fingerprints, session, report,
+                                    publisher):
+            if mirror_info['url'].endswith('daily/'):
+                raise error
+
+        _sync_mirror.side_effect = sync_mirror_side_effect
+        charm_conf = {
+            'region': 'TestRegion',
+            'mirror_list': mirror_list,
+            'ignore_proxy_for_object_store': True,
+        }
+        with self.assertRaises(gss.MirrorSyncError) as ctx:
+            gss.do_sync(mock.MagicMock(), charm_conf)
+        # Mirrors after the failed one still ran.
+        self.assertEqual(_sync_mirror.call_count, 3)
+        self.assertEqual(ctx.exception.failures, [(mirror_list[1], error)])
+        self.assertEqual(ctx.exception.returncode, 3)
+
+    @mock.patch.dict(gss.os.environ, {})
+    @mock.patch('files.glance_simplestreams_sync.get_sstream_mirror_proxy_env')
+    @mock.patch('files.glance_simplestreams_sync.sync_mirror')
+    @mock.patch.object(gss, 'NativeSyncEngine')
+    @mock.patch.object(gss, 'LocalStreamsPublisher')
+    @mock.patch.object(gss, 'save_sync_state')
+    @mock.patch.object(gss, 'load_sync_state')
+    def test_do_sync_cleanup(self, _load_sync_state, _save_sync_state,
+                             _publisher, _engine, _sync_mirror,
+                             _get_proxy_env):
+        _get_proxy_env.return_value = {}
+        _load_sync_state.return_value = {}
+        _engine.return_value.retention.prune.return_value = {}
+        _publisher.return_value.publish.side_effect = RuntimeError('boom')
+        charm_conf = {
+            'region': 'TestRegion',
+            'mirror_list': [{'url': 'http://example.com/releases/'}],
+            'ignore_proxy_for_object_store': True,
+            'sync_engine': 'native',
+            'incremental_sync': True,
+            'use_swift': False,
+            'local_streams': True,
+            'content_id_template': 'com.example.{region}',
+        }
+        with self.assertRaises(RuntimeError):
+            gss.do_sync(mock.MagicMock(), charm_conf)
+        # The engine is closed and the state saved on unexpected errors.
+        _engine.return_value.close.assert_called_once_with()
+        _save_sync_state.assert_called_once_with({'fingerprints': {}})
+        _publisher.assert_called_once_with(
+            content_ids=['com.example.TestRegion'])
+
+    @mock.patch.dict(gss.os.environ, {})
+    @mock.patch('files.glance_simplestreams_sync.get_sstream_mirror_proxy_env')
+    @mock.patch('files.glance_simplestreams_sync.sync_mirror')
+    @mock.patch.object(gss, 'update_latest_property')
+    @mock.patch.object(gss, 'invalidate_keystone_cache')
+    def test_do_sync_unauthorized(self, _invalidate_keystone_cache,
+                                  _update_latest_property, _sync_mirror,
+                                  _get_proxy_env):
+        _get_proxy_env.return_value = {}
+        response = mock.MagicMock(status_code=401)
+        _update_latest_property.side_effect = gss.requests.HTTPError(
+            response=response)
+        charm_conf = {
+            'region': 'TestRegion',
+            'mirror_list': [{'url': 'http://example.com/releases/'}],
+            'ignore_proxy_for_object_store': True,
+            'set_latest_property': True,
+            'content_id_template': 'auto.sync',
+        }
+        gss.do_sync(mock.MagicMock(), charm_conf)
+        # The next run authenticates again rather than reuse the token.
+        _invalidate_keystone_cache.assert_called_once_with()
+        self.assertTrue(gss.is_unauthorized(
+            keystone_exceptions.Unauthorized()))
+        response.status_code = 404
+        self.assertFalse(gss.is_unauthorized(
+            gss.requests.HTTPError(response=response)))
+
+    def test_sync_report(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        report = gss.SyncReport()
+        with report.phase('auth'):
+            pass
+        report.add_time('download', 2, mirror='m1')
+        report.add_time('download', 3, mirror='m1')
+        report.count('bytes_downloaded', 10, mirror='m1')
+        report.count('bytes_downloaded', 5, mirror='m2')
+        report.set_result('m1', 'synced')
+
+        with mock.patch.object(gss, 'SYNC_REPORT_DIR', tmpdir), \
+                mock.patch.object(gss, 'SYNC_REPORTS_KEPT', 1):
+            open(os.path.join(tmpdir, 'sync-20000101T000000Z.json'),
+                 'w').close()
+            path = report.write(0)
+        self.assertEqual(os.listdir(tmpdir), [os.path.basename(path)])
+        # A run started within the same second does not overwrite it.
+        with mock.patch.object(gss, 'SYNC_REPORT_DIR', tmpdir):
+            other = gss.SyncReport()
+            other.started = report.started
+            other_path = other.write(1)
+        self.assertNotEqual(other_path, path)
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         sorted(os.path.basename(p)
+                                for p in (path, other_path)))
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual(data['returncode'], 0)
+        self.assertIn('auth', data['phases'])
+        self.assertEqual(data['counters'], {'bytes_downloaded': 15})
+        self.assertEqual(data['mirrors']['m1'], {
+            'phases': {'download': 5},
+            'counters': {'bytes_downloaded': 10},
+            'result': 'synced',
+        })
+
+        # The newest reports are kept, regardless of the name's order.
+        with mock.patch.object(gss, 'SYNC_REPORT_DIR', tmpdir), \
+                mock.patch.object(gss, 'SYNC_REPORTS_KEPT', 2):
+            last = gss.SyncReport()
+            last.started = report.started
+            last_path = last.write(1)
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         sorted(os.path.basename(p)
+                                for p in (other_path, last_path)))
+        self.assertEqual(
+            sorted(['sync-20000101T000000Z-10.json',
+                    'sync-20000101T000000Z-2.json',
+                    'sync-20000101T000000Z.json'],
+                   key=gss.SyncReport.sort_key),
+            ['sync-20000101T000000Z.json', 'sync-20000101T000000Z-2.json',
+             'sync-20000101T000000Z-10.json'])
+
+    def test_sync_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        textfile = os.path.join(tmpdir, gss.METRICS_TEXTFILE_NAME)
+        report = gss.SyncReport()
+        report.add_time('sync', 12, mirror='http://a/"b"')
+        report.count('bytes_downloaded', 100, mirror='http://a/"b"')
+        report.set_result('http://a/"b"', 'synced')
+        metrics = gss.get_sync_metrics({'metrics_textfile_dir': tmpdir})
+        with mock.patch.object(gss, 'STATE_DIR', tmpdir), \
+                mock.patch.object(gss, 'METRICS_STATE_FILE_NAME',
+                                  os.path.join(tmpdir, 'metrics.json')):
+            # Progress is exported but not added to the totals.
+            metrics.update(report)
+            metrics.update(report)
+            with open(textfile) as f:
+                self.assertIn('gss_bytes_downloaded_total'
+                              '{mirror="http://a/\\"b\\""} 100\n', f.read())
+
+            metrics.update(report, 0)
+            metrics.count_lock_contention()
+            metrics.update(report, 1)
+            with open(textfile) as f:
+                content = f.read()
+        self.assertIn('# TYPE gss_bytes_downloaded_total counter\n',
+                      content)
+        self.assertIn('gss_bytes_downloaded_total'
+                      '{mirror="http://a/\\"b\\""} 200\n', content)
+        self.assertIn('gss_sync_duration_seconds'
+                      '{mirror="http://a/\\"b\\""} 12\n', content)
+        self.assertIn('gss_lock_contention_total 1\n', content)
+        self.assertIn('gss_sync_runs_total{result="failure"} 1\n', content)
+        self.assertIn('gss_sync_runs_total{result="success"} 1\n', content)
+        self.assertIn('gss_last_success_timestamp ', content)
+        self.assertIsNone(gss.get_sync_metrics(
+            {'metrics_textfile_dir': os.path.join(tmpdir, 'missing')}))
+
+    def test_instrument(self):
+        report = gss.SyncReport()
+        images = mock.MagicMock()
+        upload = images.upload
+        gss.instrument(images, ['upload'], report, 'upload', 'm1',
+                       counter='images_uploaded')
+        images.upload('image-id', b'data')
+        upload.assert_called_once_with('image-id', b'data')
+        self.assertIn('upload', report.mirrors['m1']['phases'])
+        self.assertEqual(report.counters, {'images_uploaded': 1})
+
+        # Every method keeps calling its own implementation.
+        store = mock.MagicMock()
+        store.insert_content.return_value = 'inserted'
+        store.remove.return_value = 'removed'
+        gss.instrument(store, ['insert_content', 'remove'], report,
+                       'metadata_write')
+        self.assertEqual(store.insert_content(), 'inserted')
+        self.assertEqual(store.remove(), 'removed')
+
+    @mock.patch('files.glance_simplestreams_sync.shutil')
+    @mock.patch('files.glance_simplestreams_sync.tempfile')
+    @mock.patch('files.glance_simplestreams_sync.subprocess.check_call')
+    def test_sync_mirror(self, _check_call, _tempfile, _shutil):
+        _tempfile.mkdtemp.return_value = '/root/tmpdir'
+        charm_conf = {
+            'region': 'TestRegion',
+            'content_id_template': 'auto.sync.{region}',
+            'cloud_name': 'testcloud',
+            'name_prefix': 'auto-sync/',
+            'use_swift': True,
+            'visibility': 'public',
+        }
+        mirror_info = {
+            'url': 'http://example.com/releases/',
+            'path': 'streams/v1/index.sjson',
+            'max': 1,
+            'item_filters': ['arch~(x86_64|amd64)'],
+        }
+        with mock.patch.dict(gss.os.environ, {'HOME': '/root'}):
+            gss.sync_mirror(charm_conf, mirror_info, {'HOME': '/root'})
+        _check_call.assert_called_once_with([
+            '/snap/bin/simplestreams.sstream-mirror-glance', '-vv', '--keep',
+            '--max', '1', '--content-id', 'auto.sync.TestRegion',
+            '--cloud-name', 'testcloud', '--path', 'streams/v1/index.sjson',
+            '--name-prefix', 'auto-sync/', '--keyring', gss.DEFAULT_KEYRING,
+            '--log-file', gss.SSTREAM_LOG_FILE,
+            '--output-swift', 'simplestreams/data/',
+            'http://example.com/releases/', 'arch~(x86_64|amd64)',
+        ], env={'HOME': '/root', 'OS_REGION_NAME': 'TestRegion'})
+        _shutil.rmtree.assert_called_once_with('/root/tmpdir')
+
+    @mock.patch('files.glance_simplestreams_sync.shutil')
+    @mock.patch('files.glance_simplestreams_sync.os.mkdir')
+    @mock.patch('files.glance_simplestreams_sync.tempfile')
+    @mock.patch('files.glance_simplestreams_sync.subprocess.check_call')
+    def test_sync_mirror_regions(self, _check_call, _tempfile, _mkdir,
+                                 _shutil):
+        _tempfile.mkdtemp.return_value = '/root/tmpdir'
+        charm_conf = {
+            'region': 'R1',
+            'additional_regions': 'R2 R1 R3',
+            'content_id_template': 'auto.sync.{region}',
+            'cloud_name': 'testcloud',
+            'name_prefix': 'auto-sync/',
+            'use_swift': False,
+            'visibility': 'public',
+        }
+        mirror_info = {
+            'url': 'http://example.com/releases/',
+            'path': 'streams/v1/index.sjson',
+            'max': 1,
+            'item_filters': [],
+        }
+        self.assertEqual(gss.get_target_regions(charm_conf),
+                         ['R1', 'R2', 'R3'])
+
+        def check_call(cmd, env):
+            if env['OS_REGION_NAME'] == 'R2':
+                raise subprocess.CalledProcessError(1, cmd)
+        _check_call.side_effect = check_call
+        with mock.patch.dict(gss.os.environ, {'HOME': '/root'}), \
+                self.assertRaises(subprocess.CalledProcessError):
+            gss.sync_mirror(charm_conf, mirror_info, {'HOME': '/root'})
+
+        # A failed region does not stop the others.
+        calls = {kwargs['env']['OS_REGION_NAME']: cmd
+                 for (cmd,), kwargs in _check_call.call_args_list}
+        self.assertEqual(sorted(calls), ['R1', 'R2', 'R3'])
+        for region_name, cmd in calls.items():
+            self.assertIn('auto.sync.{}'.format(region_name), cmd)
+            self.assertIn('/root/tmpdir/{}'.format(region_name), cmd)
+        _shutil.rmtree.assert_called_once_with('/root/tmpdir')
+
+    def test_build_sync_command_options(self):
+        charm_conf = {
+            'region': 'TestRegion',
+            'content_id_template': 'auto.sync',
+            'cloud_name': 'testcloud',
+            'name_prefix': 'auto-sync/',
+            'use_swift': False,
+            'visibility': 'private',
+            'hypervisor_mapping': True,
+            'custom_properties': 'hw_firmware_type=uefi hw_vif_multiqueue=1',
+            'set_latest_property': True,
+            'keyring_path': '/tmp/keyring.gpg',
+        }
+        mirror_info = {
+            'url': 'http://example.com/releases/',
+            'path': 'streams/v1/index.json',
+            'max': 2,
+            'item_filters': [],
+        }
+        options = gss.get_mirror_options(charm_conf, mirror_info, '/tmp/out')
+        self.assertEqual(options['output_dir'], '/tmp/out')
+        self.assertIsNone(options['output_swift'])
+        self.assertEqual(gss.build_sync_command(options), [
+            '/snap/bin/simplestreams.sstream-mirror-glance', '-vv', '--keep',
+            '--max', '2', '--content-id', 'auto.sync',
+            '--cloud-name', 'testcloud', '--path', 'streams/v1/index.json',
+            '--name-prefix', 'auto-sync/', '--keyring', '/tmp/keyring.gpg',
+            '--log-file', gss.SSTREAM_LOG_FILE,
+            '--output-dir', '/tmp/out',
+            '--hypervisor-mapping',
+            '--custom-property', 'hw_firmware_type=uefi',
+            '--custom-property', 'hw_vif_multiqueue=1',
+            '--visibility', 'private',
+            'http://example.com/releases/',
+        ])
+
+    def test_http_mirror_reader(self):
+        session = mock.MagicMock()
+        response = session.get.return_value
+        response.status_code = 200
+        response.raw.read.return_value = b'{"format": "index:1.0"}'
+        policy = mock.MagicMock(side_effect=lambda content, path: content)
+        reader = gss.HttpMirrorReader('http://example.com/releases', session,
+                                      policy)
+        self.assertEqual(reader.load_products('streams/v1/index.json'),
+                         {'format': 'index:1.0'})
+        session.get.assert_called_once_with(
+            'http://example.com/releases/streams/v1/index.json',
+            stream=True, timeout=gss.HTTP_TIMEOUT)
+        policy.assert_called_once_with(content='{"format": "index:1.0"}',
+                                       path='streams/v1/index.json')
+        response.close.assert_called_once_with()
+
+        response.status_code = 404
+        with self.assertRaises(IOError) as ctx:
+            reader.source('streams/v1/missing.json').read()
+        self.assertEqual(ctx.exception.errno, gss.errno.ENOENT)
+
+    def test_staging_cache_resume(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        content = b'0123456789'
+        sha256 = gss.hashlib.sha256(content).hexdigest()
+        with open(os.path.join(tmpdir, sha256 + '.part'), 'wb') as f:
+            f.write(content[:4])
+        session = mock.MagicMock()
+        response = session.get.return_value
+        response.status_code = 206
+        response.iter_content.return_value = [content[4:]]
+        cache = gss.StagingCache(tmpdir, session)
+
+        path = cache.get('http://example.com/a.img', sha256, len(content))
+        session.get.assert_called_once_with(
+            'http://example.com/a.img', headers={'Range': 'bytes=4-'},
+            stream=True, timeout=gss.HTTP_TIMEOUT)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+        # A verified blob is reused without downloading it again.
+        session.get.reset_mock()
+        self.assertEqual(
+            cache.get('http://example.com/b.img', sha256, len(content)),
+            path)
+        session.get.assert_not_called()
+
+        cache.prune(0)
+        self.assertFalse(os.path.exists(path))
+
+    def test_staging_cache_prune(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache = gss.StagingCache(tmpdir, mock.MagicMock())
+        now = time.time()
+        for name, size, age in [('a', 4, 30), ('b', 4, 20), ('c.part', 4, 10),
+                                ('d.part', 1, 8 * 24 * 3600), ('e', 4, 0),
+                                ('a.lock', 0, 30), ('f.lock', 0, 0)]:
+            path = os.path.join(tmpdir, name)
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+            os.utime(path, (now - age, now - age))
+
+        # The blob being downloaded is kept.
+        with open(os.path.join(tmpdir, 'b.lock'), 'w') as lock:
+            gss.fcntl.flock(lock, gss.fcntl.LOCK_EX)
+            cache.prune(8)
+        # The stale partial download and lock files of missing blobs are
+        # removed, the partial download counts towards the size.
+        self.assertEqual(sorted(os.listdir(tmpdir)), ['b', 'b.lock', 'e'])
+
+    def test_staging_cache_checksum_mismatch(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        session = mock.MagicMock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.iter_content.return_value = [b'corrupt']
+        cache = gss.StagingCache(tmpdir, session)
+        with self.assertRaises(gss.ChecksumMismatch):
+            cache.get('http://example.com/a.img', 'f' * 64)
+        self.assertEqual(os.listdir(tmpdir), ['f' * 64 + '.lock'])
+
+    @mock.patch.object(gss, 'ss_util')
+    def test_signature_verifier(self, _ss_util):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        keyring = os.path.join(tmpdir, 'keyring.gpg')
+        with open(keyring, 'wb') as f:
+            f.write(b'key')
+        cache_path = os.path.join(tmpdir, 'state', 'signature-cache.json')
+        _ss_util.read_signed.return_value = 'payload'
+
+        verifier = gss.SignatureVerifier(cache_path)
+        self.assertEqual(verifier.read_signed('signed', keyring), 'payload')
+        _ss_util.read_signed.assert_called_once_with('signed',
+                                                     keyring=keyring)
+        verifier.save()
+
+        # Later runs only strip the signature of verified documents.
+        _ss_util.read_signed.reset_mock()
+        verifier = gss.SignatureVerifier(cache_path)
+        verifier.read_signed('signed', keyring)
+        _ss_util.read_signed.assert_called_once_with(
+            'signed', keyring=keyring, checked=False)
+
+        # Failed verifications are not remembered.
+        _ss_util.read_signed.reset_mock()
+        _ss_util.read_signed.side_effect = ValueError('bad signature')
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                verifier.read_signed('forged', keyring)
+        self.assertEqual(_ss_util.read_signed.call_count, 2)
+
+        # A changed keyring verifies documents again.
+        _ss_util.read_signed.reset_mock()
+        _ss_util.read_signed.side_effect = None
+        with open(keyring, 'wb') as f:
+            f.write(b'other key')
+        verifier = gss.SignatureVerifier(cache_path)
+        verifier.read_signed('signed', keyring)
+        _ss_util.read_signed.assert_called_once_with('signed',
+                                                     keyring=keyring)
+
+    def test_local_streams_publisher(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'simplestreams', 'data')
+        publisher = gss.LocalStreamsPublisher(
+            path, os.path.join(tmpdir, 'simplestreams', '.releases'))
+
+        def write_output(content_id, products):
+            output_dir = tempfile.mkdtemp(dir=tmpdir)
+            os.makedirs(os.path.join(output_dir, 'streams', 'v1'))
+            index = {'format': 'index:1.0', 'index': {content_id: {
+                'path': 'streams/v1/{}.json'.format(content_id)}}}
+            for name, content in (('index', index), (content_id, products)):
+                with open(os.path.join(output_dir, 'streams', 'v1',
+                                       name + '.json'), 'w') as f:
+                    json.dump(content, f)
+            return output_dir
+
+        def read(relpath):
+            with open(os.path.join(path, relpath), 'rb') as f:
+                return f.read()
+
+        publisher.add(write_output('a', {'products': {'p': 1}}))
+        publisher.add(write_output('b', {'products': {'p': 2}}))
+        first = publisher.publish()
+        self.assertEqual(os.path.realpath(path), first)
+        self.assertEqual(
+            sorted(json.loads(read('streams/v1/index.json'))['index']),
+            ['a', 'b'])
+        self.assertEqual(
+            gss.gzip.decompress(read('streams/v1/a.json.gz')),
+            read('streams/v1/a.json'))
+
+        # Nothing changed, nothing is published.
+        publisher.add(write_output('a', {'products': {'p': 1}}))
+        self.assertIsNone(publisher.publish())
+
+        # Unchanged files are carried over as they are.
+        b_stat = os.stat(os.path.join(path, 'streams/v1/b.json'))
+        publisher.add(write_output('a', {'products': {'p': 3}}))
+        second = publisher.publish()
+        self.assertEqual(os.path.realpath(path), second)
+        self.assertEqual(json.loads(read('streams/v1/a.json')),
+                         {'products': {'p': 3}})
+        self.assertEqual(
+            os.stat(os.path.join(path, 'streams/v1/b.json')).st_ino,
+            b_stat.st_ino)
+        self.assertEqual(
+            sorted(json.loads(read('streams/v1/index.json'))['index']),
+            ['a', 'b'])
+
+        # Only the previous release is kept besides the published one.
+        publisher.add(write_output('a', {'products': {'p': 4}}))
+        third = publisher.publish()
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.isdir(second))
+        self.assertEqual(os.path.realpath(path), third)
+
+        # Content ids no longer configured are dropped with their products.
+        publisher = gss.LocalStreamsPublisher(
+            path, os.path.join(tmpdir, 'simplestreams', '.releases'),
+            content_ids=['a'])
+        self.assertIsNotNone(publisher.publish())
+        self.assertEqual(
+            sorted(json.loads(read('streams/v1/index.json'))['index']),
+            ['a'])
+        self.assertFalse(os.path.exists(os.path.join(path,
+                                                     'streams/v1/b.json')))
+        self.assertFalse(os.path.exists(
+            os.path.join(path, 'streams/v1/b.json.gz')))
+        self.assertIsNone(publisher.publish())
+
+    def test_local_streams_publisher_legacy_dir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'simplestreams', 'data')
+        os.makedirs(os.path.join(path, 'streams', 'v1'))
+        with open(os.path.join(path, 'streams', 'v1', 'old.json'), 'w') as f:
+            f.write('{}')
+        output_dir = tempfile.mkdtemp(dir=tmpdir)
+        os.makedirs(os.path.join(output_dir, 'streams', 'v1'))
+        with open(os.path.join(output_dir, 'streams', 'v1', 'a.json'),
+                  'w') as f:
+            f.write('{}')
+        publisher = gss.LocalStreamsPublisher(
+            path, os.path.join(tmpdir, 'simplestreams', '.releases'))
+        publisher.add(output_dir)
+        release = publisher.publish()
+        # The directory published in place is replaced by the symlink.
+        self.assertTrue(os.path.islink(path))
+        self.assertEqual(os.path.realpath(path), release)
+        for name in ('a.json', 'old.json'):
+            self.assertTrue(os.path.exists(
+                os.path.join(path, 'streams', 'v1', name)))
+
+    def test_staging_cache_peers(self):
+        peer_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, peer_dir)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        content = b'0123456789'
+        sha256 = gss.hashlib.sha256(content).hexdigest()
+        with open(os.path.join(peer_dir, sha256), 'wb') as f:
+            f.write(content)
+        # A partial download is resumed from the peer.
+        with open(os.path.join(tmpdir, sha256 + '.part'), 'wb') as f:
+            f.write(content[:4])
+        server = gss.PeerCacheServer(0, peer_dir, '127.0.0.1',
+                                     ['127.0.0.1'])
+        self.addCleanup(server.server_close)
+        # Only peer units are served.
+        self.assertFalse(server.verify_request(None, ('192.0.2.1', 4242)))
+        thread = gss.threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        session = mock.MagicMock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.iter_content.return_value = [b'other']
+        # The first peer is unreachable and skipped.
+        cache = gss.StagingCache(tmpdir, session, [
+            'http://127.0.0.1:1',
+            'http://127.0.0.1:{}/'.format(server.server_address[1])])
+
+        path = cache.get('http://example.com/a.img', sha256, len(content))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        session.get.assert_not_called()
+
+        # Blobs missing from every peer are downloaded from upstream.
+        other = gss.hashlib.sha256(b'other').hexdigest()
+        cache.get('http://example.com/b.img', other)
+        session.get.assert_called_once_with(
+            'http://example.com/b.img', headers={}, stream=True,
+            timeout=gss.HTTP_TIMEOUT)
+
+    @mock.patch.object(gss, 'DOWNLOAD_SEGMENT_MIN_SIZE', 4)
+    def test_staging_cache_segmented(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        content = b'0123456789'
+        sha256 = gss.hashlib.sha256(content).hexdigest()
+
+        def get(url, headers=None, **kwargs):
+            start, end = headers['Range'][len('bytes='):].split('-')
+            response = mock.MagicMock(status_code=206)
+            response.iter_content.return_value = [
+                content[int(start):int(end) + 1]]
+            return response
+
+        session = mock.MagicMock()
+        session.get.side_effect = get
+        cache = gss.StagingCache(tmpdir, session)
+        path = cache.get('http://example.com/a.img', sha256, len(content),
+                         segments=3)
+        # Segments are capped by DOWNLOAD_SEGMENT_MIN_SIZE.
+        self.assertEqual(
+            sorted(c[1]['headers']['Range']
+                   for c in session.get.call_args_list),
+            ['bytes=0-4', 'bytes=5-9'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(path + '.part'))
+
+    @mock.patch.object(gss, 'DOWNLOAD_SEGMENT_MIN_SIZE', 4)
+    def test_staging_cache_segmented_fallback(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        content = b'0123456789'
+        sha256 = gss.hashlib.sha256(content).hexdigest()
+        ranges = []
+
+        def get(url, headers=None, **kwargs):
+            ranges.append(headers['Range'])
+            start, end = headers['Range'][len('bytes='):].split('-')
+            response = mock.MagicMock(status_code=206)
+            if end == '9':
+                response.iter_content.side_effect = gss.socket.error
+            else:
+                response.iter_content.return_value = [
+                    content[int(start):int(end or len(content)) + 1]]
+            return response
+
+        session = mock.MagicMock()
+        session.get.side_effect = get
+        cache = gss.StagingCache(tmpdir, session)
+        with mock.patch.object(gss, 'log'):
+            path = cache.get('http://example.com/a.img', sha256,
+                             len(content), segments=2)
+        # The failed segment is resumed in a single stream after the
+        # bytes completed by the first segment.
+        self.assertEqual(ranges[-1], 'bytes=5-')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    @mock.patch.object(gss, 'DOWNLOAD_SEGMENT_MIN_SIZE', 4)
+    def test_staging_cache_segmented_resume(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        content = b'0123456789'
+        sha256 = gss.hashlib.sha256(content).hexdigest()
+        cache = gss.StagingCache(tmpdir, mock.MagicMock())
+        with open(cache.blob_path(sha256) + '.part', 'wb') as f:
+            f.write(content[:3])
+        cache.session.get.return_value.status_code = 206
+        cache.session.get.return_value.iter_content.return_value = [
+            content[3:]]
+        path = cache.get('http://example.com/a.img', sha256, len(content),
+                         segments=2)
+        cache.session.get.assert_called_once_with(
+            'http://example.com/a.img', headers={'Range': 'bytes=3-'},
+            stream=True, timeout=gss.HTTP_TIMEOUT)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    @mock.patch.object(gss, 'DOWNLOAD_SEGMENT_MIN_SIZE', 4)
+    def test_staging_cache_segmented_no_ranges(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        content = b'0123456789'
+        sha256 = gss.hashlib.sha256(content).hexdigest()
+        session = mock.MagicMock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.iter_content.return_value = [content]
+        cache = gss.StagingCache(tmpdir, session)
+        path = cache.get('http://example.com/a.img', sha256, len(content),
+                         segments=2)
+        self.assertEqual(session.get.call_count, 2)
+        self.assertEqual(session.get.call_args[1]['headers'], {})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_parse_bandwidth_schedule(self):
+        self.assertEqual(
+            gss.parse_bandwidth_schedule('08:00-18:30=100 22:00-6:00=0'),
+            [(480, 1110, 100), (1320, 360, 0)])
+        self.assertEqual(gss.parse_bandwidth_schedule(None), [])
+        with self.assertRaises(ValueError):
+            gss.parse_bandwidth_schedule('8-18=100')
+        self.assertIsNone(gss.get_bandwidth_scheduler({}))
+        self.assertIsNone(gss.get_bandwidth_scheduler(
+            {'bandwidth_limit': 0, 'bandwidth_schedule': 'bogus'}))
+
+    @mock.patch.object(gss.time, 'localtime')
+    def test_bandwidth_scheduler_rate(self, _localtime):
+        scheduler = gss.BandwidthScheduler(
+            8, [(480, 1080, 80), (1320, 360, 0)])
+        for hour, rate in ((7, 1000000), (12, 10000000), (23, 0), (3, 0)):
+            _localtime.return_value = mock.MagicMock(tm_hour=hour, tm_min=0)
+            self.assertEqual(scheduler.rate(), rate)
+
+    @mock.patch.object(gss.time, 'sleep')
+    @mock.patch.object(gss.time, 'time')
+    def test_bandwidth_scheduler_consume(self, _time, _sleep):
+        _time.return_value = 1000.0
+        scheduler = gss.BandwidthScheduler(8)
+        # A mirror on its own gets the full rate of 1 MB/s.
+        scheduler.consume('a', 1000000)
+        _sleep.assert_called_once_with(1.0)
+        # Mirrors downloading at the same time share it by weight.
+        _sleep.reset_mock()
+        scheduler.consume('b', 1000000, weight=3)
+        _sleep.assert_called_once_with(1000000 / 750000.)
+        _sleep.reset_mock()
+        _time.return_value = 1001.0
+        scheduler.consume('a', 250000)
+        # 'a' refilled a quarter of the rate in the second and is still
+        # 1000000 bytes in debt.
+        _sleep.assert_called_once_with(4.0)
+
+        # 'b' sleeping off its debt for longer than ACTIVE_INTERVAL still
+        # shares the rate.
+        scheduler = gss.BandwidthScheduler(8)
+        _time.return_value = 1000.0
+        scheduler.consume('b', 10000000)
+        _sleep.reset_mock()
+        _time.return_value = 1005.0
+        scheduler.consume('a', 500000)
+        _sleep.assert_called_once_with(1.0)
+        # Once 'b' is done, 'a' gets the full rate again, bursting a
+        # second worth of it.
+        _sleep.reset_mock()
+        _time.return_value = 1020.0
+        scheduler.consume('a', 2000000)
+        _sleep.assert_called_once_with(1.0)
+
+    def test_http_mirror_reader_staged(self):
+        products = {'products': {'com.example:p': {'versions': {'1': {
+            'items': {'disk1.img': {'path': 'a/disk1.img',
+                                    'sha256': 'abc', 'size': 10}}}}}}}
+        session = mock.MagicMock()
+        response = session.get.return_value
+        response.status_code = 200
+        response.raw.read.return_value = json.dumps(products).encode()
+        policy = mock.MagicMock(side_effect=lambda content, path: content)
+        cache = mock.MagicMock()
+        reader = gss.HttpMirrorReader('http://example.com/releases', session,
+                                      policy, cache)
+        reader.load_products('streams/v1/products.json')
+
+        source = reader.source('a/disk1.img')
+        self.assertIsInstance(source, gss.StagedContentSource)
+        self.assertEqual(source.url, 'http://example.com/releases/a/disk1.img')
+        self.assertEqual((source.sha256, source.size), ('abc', 10))
+        self.assertIsInstance(reader.source('b/unknown.img'),
+                              gss.HttpContentSource)
+
+    def test_streaming_image_data(self):
+        content = b'x' * (gss.DOWNLOAD_CHUNK_SIZE + 10)
+        source = mock.MagicMock()
+        source.__enter__.return_value = source
+        source.read.side_effect = [content[:gss.DOWNLOAD_CHUNK_SIZE],
+                                   content[gss.DOWNLOAD_CHUNK_SIZE:], b'']
+        stream = gss.StreamingImageData(
+            source, gss.hashlib.sha256(content).hexdigest(), len(content))
+        self.assertEqual(b''.join(stream), content)
+
+        source.read.side_effect = [b'corrupt', b'']
+        stream = gss.StreamingImageData(source, 'f' * 64)
+        self.assertEqual(stream.read(7), b'corrupt')
+        with self.assertRaises(gss.ChecksumMismatch):
+            stream.read()
+
+    def test_enable_streaming_upload(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        class ChecksummingContentSource(object):
+            """Wrapper GlanceMirror puts around the reader's sources."""
+
+            def __init__(self, csrc, checksums, size=None):
+                self.cs = csrc
+                self.url = csrc.url
+                self.size = size
+
+        writer = mock.MagicMock()
+        download_image = writer.download_image
+        images = writer.gclient.images
+        reader = gss.HttpMirrorReader('http://a/', mock.MagicMock(), None)
+        reader.register_items({'products': {'p': {'versions': {'v': {
+            'items': {'b': {'path': 'b.img', 'sha256': 'abc',
+                            'size': 10}}}}}}})
+        gss.enable_streaming_upload(writer, reader, tmpdir)
+
+        source = ChecksummingContentSource(reader.source('b.img'),
+                                           {'sha256': 'abc'})
+        data, path = writer.download_image(source, {})
+        self.assertEqual(data, {'size': 10})
+        download_image.assert_not_called()
+        with open(path, 'rb') as f:
+            writer.gclient.images.upload('image-id', f)
+        image_id, stream = images.upload.call_args[0]
+        self.assertEqual(image_id, 'image-id')
+        self.assertIsInstance(stream, gss.StreamingImageData)
+        self.assertIs(stream.contentsource, source)
+        self.assertEqual(stream.sha256, 'abc')
+
+        # Failed uploads do not leave the image behind.
+        images.upload.side_effect = gss.ChecksumMismatch('mismatch')
+        _, path = writer.download_image(source, {})
+        with open(path, 'rb') as f, self.assertRaises(gss.ChecksumMismatch):
+            writer.gclient.images.upload('image-id', f)
+        images.delete.assert_called_once_with('image-id')
+
+        # Items without a checksum are downloaded as before.
+        source = ChecksummingContentSource(reader.source('c.img'), {})
+        writer.download_image(source, {})
+        download_image.assert_called_once_with(source, {})
+
+    @mock.patch.object(gss, 'ss_swift')
+    @mock.patch.object(gss, 'ss_glance')
+    @mock.patch.object(gss, 'ss_util')
+    def test_native_sync_engine(self, _ss_util, _ss_glance, _ss_swift):
+        _ss_util.path_from_mirror_url.return_value = (
+            'http://example.com/releases/', 'streams/v1/index.sjson')
+        charm_conf = {
+            'region': 'TestRegion',
+            'content_id_template': 'auto.sync',
+            'cloud_name': 'testcloud',
+            'name_prefix': 'auto-sync/',
+            'use_swift': True,
+            'visibility': 'public',
+            'user_agent': 'gss-test',
+        }
+        mirror_info = {
+            'url': 'http://example.com/releases/',
+            'path': 'streams/v1/index.sjson',
+            'max': 1,
+            'item_filters': ['arch~(x86_64|amd64)'],
+        }
+        session = gss.get_http_session(charm_conf['user_agent'])
+        engine = gss.NativeSyncEngine(charm_conf, session)
+        self.assertEqual(engine.session.headers['User-Agent'], 'gss-test')
+        engine.sync(gss.get_mirror_options(charm_conf, mirror_info, None))
+
+        _ss_swift.SwiftObjectStore.assert_called_once_with(
+            'simplestreams/data/', region='TestRegion')
+        _, kwargs = _ss_glance.GlanceMirror.call_args
+        self.assertEqual(kwargs['config']['max_items'], 1)
+        self.assertEqual(kwargs['config']['content_id'], 'auto.sync')
+        self.assertEqual(kwargs['config']['item_filters'],
+                         ['arch~(x86_64|amd64)'])
+        self.assertEqual(kwargs['name_prefix'], 'auto-sync/')
+        self.assertIs(kwargs['client'], engine.keystone)
+        writer = _ss_glance.GlanceMirror.return_value
+        reader, path = writer.sync.call_args[0]
+        self.assertEqual(path, 'streams/v1/index.sjson')
+        self.assertIs(reader.session, engine.session)
+
+    @mock.patch.object(gss, 'ss_glance')
+    def test_native_sync_engine_regions(self, _ss_glance):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        charm_conf = {
+            'region': 'R1',
+            'additional_regions': 'R2',
+            'streaming_upload': True,
+        }
+        with mock.patch.dict(gss.os.environ, {'HOME': tmpdir}):
+            engine = gss.NativeSyncEngine(charm_conf, mock.MagicMock())
+        # Images are staged once for all regions rather than streamed.
+        self.assertFalse(engine.streaming_upload)
+        self.assertTrue(engine.staging_cache.path.startswith(tmpdir))
+        engine.close()
+        self.assertEqual(os.listdir(tmpdir), [])
+
+    @mock.patch('files.glance_simplestreams_sync.get_sstream_mirror_proxy_env')
+    @mock.patch.object(gss, 'ss_objectstores')
+    @mock.patch.object(gss, 'ss_glance')
+    @mock.patch.object(gss, 'ss_util')
+    def test_do_sync_native_concurrent_metadata(self, _ss_util, _ss_glance,
+                                                _ss_objectstores,
+                                                _get_proxy_env):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        _get_proxy_env.return_value = {}
+        _ss_util.path_from_mirror_url.side_effect = lambda url, path: (
+            url, path)
+        images = []
+        glance = mock.MagicMock()
+        glance.images.list.side_effect = lambda **kwargs: list(images)
+
+        def create(**kwargs):
+            images.append(dict(kwargs, id=kwargs['product_name']))
+            return images[-1]
+
+        glance.images.create.side_effect = create
+        # Both mirrors load the products before either landed its own.
+        loaded = threading.Barrier(2, timeout=5)
+        written = []
+
+        class GlanceMirror(object):
+            def __init__(self, config, objectstore, region, name_prefix,
+                         client):
+                self.config = config
+                self.gclient = glance
+
+            def load_products(self):
+                return sorted(image['product_name']
+                              for image in self.gclient.images.list())
+
+            def sync(self, reader, path):
+                target = self.load_products()
+                loaded.wait()
+                self.gclient.images.create(
+                    product_name=path, content_id='auto.sync')
+                self.insert_products(path, target + [path], None)
+
+            def insert_products(self, path, target, content):
+                written.append(target)
+
+            def remove_item(self, data, src, target, pedigree):
+                pass
+
+        _ss_glance.GlanceMirror.side_effect = GlanceMirror
+        charm_conf = {
+            'region': 'TestRegion',
+            'mirror_list': [
+                {'url': 'http://example.com/releases/', 'path': 'released',
+                 'max': 1, 'item_filters': []},
+                {'url': 'http://example.com/daily/', 'path': 'daily',
+                 'max': 1, 'item_filters': []},
+            ],
+            'ignore_proxy_for_object_store': True,
+            'mirror_concurrency': 2,
+            'sync_engine': 'native',
+            'content_id_template': 'auto.sync',
+            'cloud_name': 'testcloud',
+            'name_prefix': 'auto-sync/',
+            'use_swift': False,
+            'visibility': 'public',
+        }
+        with mock.patch.dict(gss.os.environ, {'HOME': tmpdir}):
+            gss.do_sync(mock.MagicMock(), charm_conf)
+        # Each mirror only wrote its own product, the metadata written last
+        # has both.
+        self.assertEqual(sorted(written[:2]), [['daily'], ['released']])
+        self.assertEqual(written[2:], [['daily', 'released']])
+        self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_item_filter(self):
+        item = {'arch': 'amd64', 'ftype': 'disk1.img', 'release': 'jammy'}
+        self.assertTrue(gss.ItemFilter('arch~(x86_64|amd64)').matches(item))
+        self.assertTrue(gss.ItemFilter('release=jammy').matches(item))
+        self.assertFalse(gss.ItemFilter('release!=jammy').matches(item))
+        self.assertFalse(gss.ItemFilter('ftype!~disk').matches(item))
+        self.assertFalse(gss.ItemFilter('label=release').matches(item))
+        with self.assertRaises(ValueError):
+            gss.ItemFilter('arch')
+
+    @mock.patch.object(gss.hook_tools, 'flush')
+    @mock.patch.object(gss, 'status_set')
+    def test_sync_progress(self, _status_set, _flush):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        progress_file = os.path.join(tmpdir, 'progress')
+        report = gss.SyncReport()
+        report.count('images_planned', 4, 'a')
+        report.count('bytes_planned', 4000000, 'a')
+        report.set_result('b', 'synced')
+        progress = gss.SyncProgress(report, 3)
+        with mock.patch.object(gss, 'PROGRESS_FILE_NAME', progress_file):
+            progress.tick(1000.0)
+            report.count('bytes_downloaded', 1000000, 'a')
+            report.count('images_uploaded', 1, 'a')
+            # Status updates are rate limited, the file is not.
+            progress.tick(1010.0)
+            with open(progress_file) as f:
+                snapshot = json.load(f)
+            self.assertEqual(snapshot['mirrors']['a']['bytes_per_second'],
+                             100000)
+            self.assertEqual(snapshot['eta_seconds'], 30)
+            self.assertEqual(snapshot['message'],
+                             'Synchronising images: 1/3 mirrors done, '
+                             '1/4 images, 0.1 MB/s, ETA 0:00:30')
+            _status_set.assert_called_once_with(
+                'maintenance', 'Synchronising images: 1/3 mirrors done, '
+                '0/4 images')
+            progress.tick(1030.0)
+            _status_set.assert_called_with('maintenance', mock.ANY)
+            self.assertEqual(_status_set.call_count, 2)
+            self.assertEqual(_flush.call_count, 2)
+            progress.stop()
+        self.assertFalse(os.path.exists(progress_file))
+
+    def test_item_filter_set(self):
+        expressions = ['arch~(x86_64|amd64)', 'ftype!~root', 'ftype!~lxd',
+                       'release!=trusty', 'label=release']
+        item_filters = gss.ItemFilterSet(expressions)
+        for item in ({'arch': 'amd64', 'ftype': 'disk1.img',
+                      'release': 'jammy', 'label': 'release'},
+                     {'arch': 'amd64', 'ftype': 'lxd.tar.xz',
+                      'release': 'jammy', 'label': 'release'},
+                     {'arch': 'amd64', 'ftype': 'disk1.img',
+                      'release': 'trusty', 'label': 'release'},
+                     {'arch': 'arm64', 'ftype': 'disk1.img',
+                      'release': 'jammy', 'label': 'release'},
+                     {'arch': 'amd64', 'ftype': 'disk1.img'}):
+            self.assertEqual(
+                item_filters.matches(item),
+                all(gss.ItemFilter(e).matches(item) for e in expressions))
+        self.assertFalse(gss.ItemFilterSet(['arch=a', 'arch=b']).matches(
+            {'arch': 'a'}))
+        self.assertTrue(gss.ItemFilterSet([]).matches({}))
+
+        products = {'label': 'release', 'products': {
+            'p:jammy:amd64': {'arch': 'amd64', 'release': 'jammy',
+                              'versions': {
+                                  '1': {'items': {
+                                      'disk1.img': {'ftype': 'disk1.img'},
+                                      'root.tar.xz': {'ftype': 'root.tar.xz'},
+                                  }},
+                                  '2': {'items': {
+                                      'lxd.tar.xz': {'ftype': 'lxd.tar.xz'},
+                                  }},
+                              }},
+            'p:jammy:arm64': {'arch': 'arm64', 'release': 'jammy',
+                              'versions': {'1': {'items': {
+                                  'disk1.img': {'ftype': 'disk1.img'}}}}},
+        }}
+        expected = [item[:3] for item in gss.iter_product_items(products)
+                    if item_filters.matches(item[3])]
+        self.assertEqual(item_filters.filter_products(products), 3)
+        self.assertEqual(
+            [item[:3] for item in gss.iter_product_items(products)],
+            expected)
+        self.assertEqual(list(products['products']), ['p:jammy:amd64'])
+        self.assertEqual(
+            list(products['products']['p:jammy:amd64']['versions']), ['1'])
+
+    def test_transfer_priority(self):
+        products = {'products': collections.OrderedDict([
+            ('p:focal:arm64', {'release': 'focal', 'version': '20.04',
+                               'release_title': '20.04 LTS',
+                               'arch': 'arm64', 'versions': {}}),
+            ('p:oracular:amd64', {'release': 'oracular', 'version': '24.10',
+                                  'release_title': '24.10',
+                                  'arch': 'amd64', 'versions': {}}),
+            ('p:jammy:amd64', {'release': 'jammy', 'version': '22.04',
+                               'release_title': '22.04 LTS',
+                               'arch': 'amd64', 'versions': {}}),
+            ('p:focal:amd64', {'release': 'focal', 'version': '20.04',
+                               'release_title': '20.04 LTS',
+                               'arch': 'amd64', 'versions': {}}),
+        ])}
+        priority = gss.TransferPriority('pin:release=focal lts newest '
+                                        'arch:amd64')
+        self.assertEqual(list(priority.sort_products(products)['products']),
+                         ['p:focal:amd64', 'p:focal:arm64', 'p:jammy:amd64',
+                          'p:oracular:amd64'])
+        # Products the rules do not tell apart keep their upstream order.
+        self.assertEqual(
+            list(gss.TransferPriority('lts').sort_products(
+                products)['products']),
+            ['p:focal:arm64', 'p:jammy:amd64', 'p:focal:amd64',
+             'p:oracular:amd64'])
+        with self.assertRaises(ValueError):
+            gss.TransferPriority('oldest')
+        self.assertIsNone(gss.get_transfer_priority(
+            {'transfer_priority': 'arch:'}))
+        self.assertIsNone(gss.get_transfer_priority({}))
+
+    def test_plan_mirror(self):
+        index = {'index': {'com.example:download': {
+            'datatype': 'image-downloads',
+            'path': 'streams/v1/products.json'}}}
+        item = {'ftype': 'disk1.img', 'arch': 'amd64', 'size': 10}
+        versions = {
+            '1': {'items': {'disk1.img': dict(item, md5='a', path='1.img')}},
+            '2': {'items': {'disk1.img': dict(item, md5='b', path='2.img')}},
+            '3': {'items': {'disk1.img': dict(item, md5='c', path='3.img',
+                                              arch='arm64')}},
+        }
+        products = {'products': {'com.example:p': {'arch': 'amd64',
+                                                   'versions': versions}}}
+        documents = {
+            'http://example.com/releases/streams/v1/index.json': index,
+            'http://example.com/releases/streams/v1/products.json': products,
+        }
+        session = mock.MagicMock()
+        session.get.side_effect = lambda url, **kwargs: mock.MagicMock(
+            text=json.dumps(documents[url]))
+        images = [
+            {'id': 'old', 'name': 'p-0', 'product_name': 'com.example:p',
+             'version_name': '0', 'item_name': 'disk1.img', 'checksum': 'z',
+             'latest': 'true'},
+            {'id': 'cur', 'name': 'p-1', 'product_name': 'com.example:p',
+             'version_name': '1', 'item_name': 'disk1.img', 'checksum': 'a'},
+            {'id': 'other', 'product_name': 'com.example:other',
+             'version_name': '1', 'item_name': 'disk1.img'},
+        ]
+        options = {
+            'source_mirror': 'http://example.com/releases',
+            'path': 'streams/v1/index.json',
+            'region': 'R1',
+            'item_filters': ['arch~(x86_64|amd64)'],
+            'max_items': 2,
+            'set_latest_property': True,
+        }
+        plan = gss.plan_mirror(session, options, images)
+        self.assertEqual([(i['version_name'], i['size']) for i in plan['add']],
+                         [('2', 10)])
+        self.assertEqual(plan['add'][0]['architecture'], 'x86_64')
+        self.assertEqual([i['id'] for i in plan['delete']], ['old'])
+        self.assertEqual(plan['bytes'], 10)
+
+        options['max_items'] = 3
+        plan = gss.plan_mirror(session, options, images)
+        self.assertEqual([i['id'] for i in plan['delete']], [])
+
+    def test_plan_latest_property(self):
+        images = [
+            {'id': 'j1', 'name': 'jammy-1', 'os_version': '22.04',
+             'architecture': 'x86_64', 'version_name': '1',
+             'latest': 'true'},
+            {'id': 'j0', 'name': 'jammy-0', 'os_version': '22.04',
+             'architecture': 'x86_64', 'version_name': '0'},
+            # Synced by another mirror of the same content id.
+            {'id': 'n1', 'name': 'noble-1', 'os_version': '24.04',
+             'architecture': 'x86_64', 'version_name': '1'},
+            {'id': 'a1', 'name': 'jammy-arm-1', 'os_version': '22.04',
+             'architecture': 'aarch64', 'version_name': '1',
+             'latest': 'true'},
+        ]
+        mirrors = [
+            {'url': 'http://example.com/jammy/', 'delete': [{'id': 'j0'}],
+             'add': [{'os_version': '22.04', 'architecture': 'x86_64',
+                      'version_name': '2'}]},
+            {'url': 'http://example.com/noble/', 'delete': [], 'add': []},
+        ]
+        # The same rule as update_latest_property, across the mirrors of
+        # the content id: new images are flagged as they are created.
+        self.assertEqual(
+            gss.plan_latest_property('R1', images, mirrors),
+            [{'region': 'R1', 'id': 'n1', 'name': 'noble-1',
+              'latest': True},
+             {'region': 'R1', 'id': 'j1', 'name': 'jammy-1',
+              'latest': False}])
+
+    @mock.patch.object(gss, 'get_past_throughput')
+    @mock.patch.object(gss, 'plan_mirror')
+    @mock.patch.object(gss, 'list_glance_images')
+    def test_plan_sync_retag(self, _list_glance_images, _plan_mirror,
+                             _get_past_throughput):
+        _get_past_throughput.return_value = None
+        _list_glance_images.return_value = [
+            {'id': 'old', 'os_version': '22.04', 'version_name': '1',
+             'latest': 'true'}]
+        _plan_mirror.side_effect = lambda session, options, images: {
+            'url': options['source_mirror'], 'region': options['region'],
+            'delete': [], 'bytes': 0,
+            'add': [{'os_version': '22.04', 'version_name': '2',
+                     'path': options['source_mirror'], 'sha256': None,
+                     'size': 0}]}
+        charm_conf = {
+            'region': 'R1', 'content_id_template': 'auto.sync.{region}',
+            'cloud_name': 'cloud', 'name_prefix': 'auto-sync/',
+            'visibility': 'public', 'use_swift': False,
+            'set_latest_property': True,
+            'mirror_list': [
+                {'url': 'http://example.com/{}/'.format(name),
+                 'path': 'streams/v1/index.json', 'item_filters': [],
+                 'max': 1} for name in ('a', 'b')],
+        }
+        plan = gss.plan_sync(charm_conf, mock.MagicMock(), mock.MagicMock())
+        # Retagged once for the content id, not once per mirror.
+        _list_glance_images.assert_called_once()
+        self.assertEqual(plan['retag'], [
+            {'region': 'R1', 'id': 'old', 'name': None, 'latest': False}])
+        self.assertEqual(plan['images_to_retag'], 1)
+
+    def test_get_latest_property_changes(self):
+        images = [
+            {'id': 'j1', 'os_version': '22.04', 'architecture': 'x86_64',
+             'version_name': '20240101', 'latest': 'true'},
+            {'id': 'j2', 'os_version': '22.04', 'architecture': 'x86_64',
+             'version_name': '20240102'},
+            {'id': 'j3', 'os_version': '22.04', 'architecture': 'x86_64',
+             'version_name': '20240103', 'status': 'queued'},
+            {'id': 'a1', 'os_version': '22.04', 'architecture': 'aarch64',
+             'version_name': '20240101', 'latest': 'true'},
+            {'id': 'n1', 'os_version': '24.04', 'architecture': 'x86_64',
+             'version_name': '20240101', 'latest': 'false'},
+        ]
+        self.assertEqual(gss.get_latest_property_changes(images),
+                         (['j2', 'n1'], ['j1']))
+        images[0].pop('latest')
+        images[1]['latest'] = 'true'
+        images[4]['latest'] = 'true'
+        self.assertEqual(gss.get_latest_property_changes(images), ([], []))
+
+    def test_update_latest_property(self):
+        ksc = mock.MagicMock(auth_token='token')
+        ksc.service_catalog.url_for.return_value = 'http://glance:9292/v2/'
+        session = mock.MagicMock()
+        images = [
+            {'id': 'old', 'os_version': '22.04', 'version_name': '1',
+             'latest': 'true'},
+            {'id': 'new', 'os_version': '22.04', 'version_name': '2'},
+        ]
+        self.assertEqual(gss.update_latest_property(
+            session, ksc, 'R1', 'auto.sync', images), 2)
+        session.get.assert_not_called()
+        self.assertEqual(
+            [(c[0][0], json.loads(c[1]['data']))
+             for c in session.patch.call_args_list],
+            [('http://glance:9292/v2/images/new',
+              [{'op': 'add', 'path': '/latest', 'value': 'true'}]),
+             ('http://glance:9292/v2/images/old',
+              [{'op': 'remove', 'path': '/latest'}])])
+
+    @mock.patch.dict(gss.os.environ, {})
+    def test_list_glance_images_interface(self):
+        ksc = mock.MagicMock(auth_token='token', project_id='p1')
+        ksc.service_catalog.url_for.return_value = 'http://glance:9292'
+        session = mock.MagicMock()
+        session.get.return_value.json.return_value = {'images': []}
+        gss.list_glance_images(session, ksc, 'R1', 'auto.sync')
+        ksc.service_catalog.url_for.assert_called_with(
+            service_type='image', endpoint_type='publicURL',
+            region_name='R1')
+        # The interface set_openstack_env took from identity.yaml.
+        gss.os.environ['OS_INTERFACE'] = 'internal'
+        gss.list_glance_images(session, ksc, 'R1', 'auto.sync')
+        ksc.service_catalog.url_for.assert_called_with(
+            service_type='image', endpoint_type='internalURL',
+            region_name='R1')
+
+    def test_get_past_throughput(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch.object(gss, 'SYNC_REPORT_DIR', tmpdir):
+            self.assertIsNone(gss.get_past_throughput())
+            for name, nbytes in (('sync-1.json', 300), ('sync-2.json', 100)):
+                with open(os.path.join(tmpdir, name), 'w') as f:
+                    json.dump({'mirrors': {'m': {
+                        'phases': {'sync': 2}, 'counters': {
+                            'bytes_downloaded': nbytes}}}}, f)
+            self.assertEqual(gss.get_past_throughput(), 100.)
+
+    def test_glance_inventory(self):
+        image_a = {'id': 'a', 'content_id': 'auto.sync',
+                   'product_name': 'p', 'version_name': '1', 'checksum': 'x'}
+        image_b = {'id': 'b', 'content_id': 'auto.sync',
+                   'product_name': 'p', 'version_name': '2', 'checksum': None}
+        images = mock.MagicMock()
+        images.list.return_value = iter([image_a])
+        images.create.return_value = image_b
+        images.get.return_value = dict(image_b, checksum='y')
+        inventory = gss.GlanceInventory(images, 'auto.sync', 'project')
+        proxy = gss.InventoryImages(images, inventory)
+
+        self.assertEqual(proxy.list(), [image_a])
+        self.assertEqual(proxy.list(filters={'content_id': 'auto.sync',
+                                             'version_name': '2'}), [])
+        images.list.assert_called_once_with(
+            filters={'content_id': 'auto.sync', 'owner': 'project'},
+            page_size=gss.GLANCE_PAGE_SIZE)
+        self.assertIs(inventory.find('p', '1', 'x'), image_a)
+
+        proxy.create(name='b')
+        proxy.upload('b', mock.sentinel.data)
+        self.assertEqual(inventory.find('p', '2', 'y')['id'], 'b')
+        proxy.delete('a')
+        images.delete.assert_called_once_with('a')
+        self.assertIsNone(inventory.find('p', '1', 'x'))
+        self.assertEqual([i['id'] for i in proxy.list()], ['b'])
+
+        # Listings of other content ids still go to glance.
+        proxy.list(filters={'content_id': 'other'})
+        images.list.assert_called_with(filters={'content_id': 'other'})
+        self.assertEqual(images.list.call_count, 2)
+
+    def test_retention_stage(self):
+        report = gss.SyncReport()
+        retention = gss.RetentionStage(2, report)
+        images = mock.MagicMock()
+        images.list.return_value = []
+        proxy = gss.InventoryImages(
+            images, gss.GlanceInventory(images, 'auto.sync'), retention)
+        with retention.collecting('m1', 'R1'):
+            proxy.delete('a')
+        with retention.collecting('m1', 'R2'):
+            proxy.delete('b')
+        with retention.collecting('m2', 'R1'):
+            proxy.delete('c')
+        # Deletes outside of collecting() are not queued.
+        proxy.delete('d')
+        images.delete.assert_called_once_with('d')
+
+        def delete(image_id):
+            if image_id == 'c':
+                raise IOError('gone')
+
+        images.delete.side_effect = delete
+        # The other regions of a mirror keep their queue.
+        self.assertEqual(retention.prune([('m1', 'R1')]), {})
+        self.assertEqual(report.mirrors['m1']['counters']['images_pruned'],
+                         1)
+        self.assertEqual(list(retention.pending), [('m1', 'R2'),
+                                                   ('m2', 'R1')])
+        errors = retention.prune()
+        self.assertEqual(list(errors), [('m2', 'R1')])
+        self.assertEqual(report.mirrors['m1']['counters']['images_pruned'],
+                         2)
+        self.assertEqual(
+            sorted(c[0][0] for c in images.delete.call_args_list),
+            ['a', 'b', 'c', 'd'])
+        self.assertEqual(retention.prune(), {})
+
+    @mock.patch.object(gss, 'ss_openstack')
+    def test_shared_keystone_client(self, _ss_openstack):
+        _ss_openstack.get_service_conn_info.return_value = {'token': 'abc'}
+        client = gss.SharedKeystoneClient()
+        for _ in range(3):
+            self.assertEqual(
+                client.get_service_conn_info('image', region_name='R1'),
+                {'token': 'abc'})
+        _ss_openstack.get_service_conn_info.assert_called_once_with(
+            'image', region_name='R1')
+
+    @mock.patch.dict(gss.os.environ, {})
+    @mock.patch.object(gss, 'ss_glance', None)
+    @mock.patch('files.glance_simplestreams_sync.get_sstream_mirror_proxy_env')
+    @mock.patch('files.glance_simplestreams_sync.sync_mirror')
+    def test_do_sync_native_unavailable(self, _sync_mirror, _get_proxy_env):
+        _get_proxy_env.return_value = {}
+        charm_conf = {
+            'region': 'TestRegion',
+            'mirror_list': [{'url': 'http://example.com/releases/'}],
+            'ignore_proxy_for_object_store': True,
+            'sync_engine': 'native',
+        }
+        gss.do_sync(mock.MagicMock(), charm_conf)
+        args, _ = _sync_mirror.call_args
+        self.assertIsNone(args[3])
+
+    def test_strip_signature(self):
+        signed = ('-----BEGIN PGP SIGNED MESSAGE-----\n'
+                  'Hash: SHA512\n'
+                  '\n'
+                  '{"index": {}}\n'
+                  '- --dash\n'
+                  '-----BEGIN PGP SIGNATURE-----\n'
+                  '\n'
+                  'iQIcBAEBCgAGBQJ\n'
+                  '-----END PGP SIGNATURE-----\n')
+        self.assertEqual(gss.strip_signature(signed),
+                         '{"index": {}}\n--dash\n')
+        self.assertEqual(gss.strip_signature('{"index": {}}'),
+                         '{"index": {}}')
+
+    def test_get_mirror_fingerprint(self):
+        index = {'index': {
+            'com.ubuntu.cloud:released:download': {
+                'path': 'streams/v1/com.ubuntu.cloud:released:download.json',
+            }}}
+        session = mock.MagicMock()
+        session.get.return_value.text = json.dumps(index)
+        session.get.return_value.content = json.dumps(index).encode()
+        session.head.return_value.headers = {'ETag': '"abc"'}
+        options = {'source_mirror': 'http://example.com/releases',
+                   'path': 'streams/v1/index.json', 'max_items': 1}
+        fingerprint = gss.get_mirror_fingerprint(session, options)
+        self.assertIsNotNone(fingerprint)
+        session.head.assert_called_once_with(
+            'http://example.com/releases/streams/v1/'
+            'com.ubuntu.cloud:released:download.json',
+            allow_redirects=True, timeout=gss.HTTP_TIMEOUT)
+        # Stable for unchanged upstream.
+        self.assertEqual(gss.get_mirror_fingerprint(session, options),
+                         fingerprint)
+        # Changes with product file validators and sync options.
+        session.head.return_value.headers = {'ETag': '"def"'}
+        self.assertNotEqual(gss.get_mirror_fingerprint(session, options),
+                            fingerprint)
+        session.head.return_value.headers = {'ETag': '"abc"'}
+        self.assertNotEqual(
+            gss.get_mirror_fingerprint(session, dict(options, max_items=2)),
+            fingerprint)
+        # No validators, no fingerprint.
+        session.head.return_value.headers = {}
+        self.assertIsNone(gss.get_mirror_fingerprint(session, options))
+
+    @mock.patch('files.glance_simplestreams_sync.shutil')
+    @mock.patch('files.glance_simplestreams_sync.tempfile')
+    @mock.patch('files.glance_simplestreams_sync.get_mirror_fingerprint')
+    @mock.patch('files.glance_simplestreams_sync.subprocess.check_call')
+    def test_sync_mirror_incremental(self, _check_call, _get_fingerprint,
+                                     _tempfile, _shutil):
+        _tempfile.mkdtemp.return_value = '/root/tmpdir'
+        _get_fingerprint.return_value = 'abc'
+        charm_conf = {
+            'region': 'TestRegion',
+            'content_id_template': 'auto.sync',
+            'cloud_name': 'testcloud',
+            'name_prefix': 'auto-sync/',
+            'use_swift': True,
+            'visibility': 'public',
+        }
+        mirror_info = {
+            'url': 'http://example.com/releases/',
+            'path': 'streams/v1/index.sjson',
+            'max': 1,
+            'item_filters': ['arch~(x86_64|amd64)'],
+        }
+        fingerprints = {}
+        with mock.patch.dict(gss.os.environ, {'HOME': '/root'}):
+            self.assertTrue(gss.sync_mirror(charm_conf, mirror_info, {},
+                                            fingerprints=fingerprints))
+            _check_call.assert_called_once()
+            self.assertEqual(list(fingerprints.values()), ['abc'])
+
+            # Unchanged upstream is skipped.
+            _check_call.reset_mock()
+            self.assertFalse(gss.sync_mirror(charm_conf, mirror_info, {},
+                                             fingerprints=fingerprints))
+            _check_call.assert_not_called()
+
+            # A failed sync does not record the new fingerprint.
+            _get_fingerprint.return_value = 'def'
+            _check_call.side_effect = subprocess.CalledProcessError(1, 'x')
+            with self.assertRaises(subprocess.CalledProcessError):
+                gss.sync_mirror(charm_conf, mirror_info, {},
+                                fingerprints=fingerprints)
+            self.assertEqual(list(fingerprints.values()), ['abc'])
+
+    def test_catalog_index(self):
+        service_catalog = mock.MagicMock()
+        service_catalog.get_endpoints.return_value = {
+            'image': [
+                {'interface': 'public', 'region_id': 'TestRegion',
+                 'url': 'https://10.5.2.43:9292'},
+                {'interface': 'admin', 'region_id': 'TestRegion',
+                 'url': 'https://10.5.3.43:9292'},
+                {'interface': 'public', 'region_id': 'OtherRegion',
+                 'url': 'https://10.6.2.43:9292'},
+            ],
+            'identity': [
+                {'publicURL': 'https://10.5.2.42:5000/v2.0',
+                 'internalURL': 'https://10.5.1.42:5000/v2.0',
+                 'adminURL': 'https://10.5.3.42:35357/v2.0',
+                 'region': 'TestRegion'},
+            ],
+        }
+        catalog = gss.CatalogIndex.from_service_catalog(service_catalog)
+        self.assertEqual(
+            catalog.url_for(service_type='image', endpoint_type='publicURL',
+                            region_name='OtherRegion'),
+            'https://10.6.2.43:9292')
+        self.assertEqual(
+            catalog.url_for(service_type='image', endpoint_type='adminURL',
+                            region_name='TestRegion'),
+            'https://10.5.3.43:9292')
+        self.assertEqual(
+            gss.get_service_endpoints(
+                mock.MagicMock(service_catalog=catalog), 'identity',
+                'TestRegion'), {
+                    'publicURL': 'https://10.5.2.42:5000/v2.0',
+                    'internalURL': 'https://10.5.1.42:5000/v2.0',
+                    'adminURL': 'https://10.5.3.42:35357/v2.0',
+            })
+        with self.assertRaises(keystone_exceptions.EndpointNotFound) as ctx:
+            catalog.url_for(service_type='image',
+                            endpoint_type='internalURL',
+                            region_name='TestRegion')
+        self.assertIn('endpoint for image', ctx.exception.message)
+
+    @mock.patch('files.glance_simplestreams_sync.get_keystone_client')
+    def test_get_cached_keystone_client(self, _get_keystone_client):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        cache_file = os.path.join(tmpdir, 'keystone-cache.json')
+        ksc = _get_keystone_client.return_value
+        ksc.auth_ref.auth_token = 'token'
+        ksc.auth_ref.expires = (datetime.datetime.utcnow() +
+                                datetime.timedelta(hours=1))
+        ksc.auth_ref.project_id = 'project'
+        ksc.services.list.return_value = [
+            mock.MagicMock(_info={'name': 'glance', 'type': 'image'})]
+        ksc.service_catalog.get_endpoints.return_value = {
+            'image': [{'interface': 'public', 'region_id': 'TestRegion',
+                       'url': 'https://10.5.2.43:9292'}]}
+
+        with mock.patch.multiple(gss, STATE_DIR=tmpdir,
+                                 KEYSTONE_CACHE_FILE_NAME=cache_file):
+            for _ in range(3):
+                cached = gss.get_cached_keystone_client(3)
+                self.assertEqual(cached.services,
+                                 [{'name': 'glance', 'type': 'image'}])
+                self.assertEqual(cached.service_catalog.url_for(
+                    'image', 'publicURL', 'TestRegion'),
+                    'https://10.5.2.43:9292')
+            # Authenticated once, later runs were served from the cache.
+            _get_keystone_client.assert_called_once_with(3)
+            self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+
+            # Tokens about to expire are refreshed.
+            ksc.auth_ref.expires = (datetime.datetime.utcnow() +
+                                    datetime.timedelta(minutes=1))
+            gss.invalidate_keystone_cache()
+            gss.get_cached_keystone_client(3)
+            gss.get_cached_keystone_client(3)
+            self.assertEqual(_get_keystone_client.call_count, 3)
+
+    @mock.patch('files.glance_simplestreams_sync.run_sync')
+    @mock.patch('files.glance_simplestreams_sync.cleanup')
+    @mock.patch('files.glance_simplestreams_sync.acquire_sync_lock')
+    def test_sync_daemon_run_once(self, _acquire_sync_lock, _cleanup,
+                                  _run_sync):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        patcher = mock.patch.object(gss, 'SYNC_QUEUE_FILE_NAME',
+                                    os.path.join(tmpdir, 'queue'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _run_sync.return_value = 0
+        daemon = gss.SyncDaemon()
+        conns = [mock.MagicMock(), mock.MagicMock()]
+        daemon.request(conns[0], {})
+        daemon.request(conns[1], {'force': True})
+        self.assertEqual(daemon.run_once(), 0)
+        # Both requests were served by a single forced sync.
+        _run_sync.assert_called_once_with(force=True, session=daemon.session)
+        for conn in conns:
+            conn.sendall.assert_called_once_with(b'{"returncode": 0}\n')
+            conn.close.assert_called_once_with()
+        self.assertTrue(daemon.synced_once)
+        _cleanup.assert_called_once_with()
+        _acquire_sync_lock.return_value.close.assert_called_once_with()
+
+        # Nothing queued, a scheduled sync is not forced.
+        _run_sync.reset_mock()
+        daemon.run_once()
+        _run_sync.assert_called_once_with(force=False, session=daemon.session)
+
+        # Another sync holds the lock, the daemon waits for it and runs
+        # the follow-up sync itself.
+        lockfile = mock.MagicMock()
+        _acquire_sync_lock.side_effect = [None, lockfile]
+        _run_sync.reset_mock()
+        _run_sync.return_value = 1
+        self.assertEqual(daemon.run_once(), 1)
+        _acquire_sync_lock.assert_called_with(blocking=True)
+        _run_sync.assert_called_once_with(force=False, session=daemon.session)
+        lockfile.close.assert_called_once_with()
+
+    @mock.patch.object(gss, 'record_lock_contention')
+    @mock.patch.object(gss, 'run_sync')
+    def test_run_coalesced_sync(self, _run_sync, _record_lock_contention):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        def run_sync(force, session):
+            if _run_sync.call_count == 1:
+                # A burst of requests while the first sync runs.
+                self.assertEqual(gss.run_coalesced_sync(), 2)
+                self.assertEqual(gss.run_coalesced_sync(force=True), 2)
+            return _run_sync.call_count - 1
+
+        _run_sync.side_effect = run_sync
+        with mock.patch.object(gss, 'SYNC_RUNNING_FLAG_FILE_NAME',
+                               os.path.join(tmpdir, 'sync.pid')), \
+                mock.patch.object(gss, 'SYNC_QUEUE_FILE_NAME',
+                                  os.path.join(tmpdir, 'queue')):
+            self.assertEqual(gss.run_coalesced_sync(), 1)
+            self.assertFalse(
+                os.path.exists(gss.SYNC_RUNNING_FLAG_FILE_NAME))
+            self.assertFalse(gss.SyncQueue().pending())
+            self.assertEqual(gss.SyncQueue().result(3), (True, 1))
+        # The burst was served by a single forced follow-up sync.
+        self.assertEqual(_run_sync.call_args_list,
+                         [mock.call(force=False, session=None),
+                          mock.call(force=True, session=None)])
+        self.assertEqual(_record_lock_contention.call_count, 2)
+
+    def test_sync_daemon_accept(self):
+        daemon = gss.SyncDaemon()
+        server = mock.MagicMock()
+        slow, conn = mock.MagicMock(), mock.MagicMock()
+        server.accept.side_effect = [(slow, None), (conn, None),
+                                     SystemExit]
+        requested = threading.Event()
+        reading = threading.Event()
+
+        def readline():
+            reading.set()
+            requested.wait(10)
+            raise gss.socket.timeout('timed out')
+
+        slow.makefile.return_value.readline.side_effect = readline
+        conn.makefile.return_value.readline.return_value = \
+            '{"force": true}\n'
+        with mock.patch.object(daemon, 'request',
+                               side_effect=lambda *a: requested.set()) \
+                as request, mock.patch.object(gss, 'log'):
+            with self.assertRaises(SystemExit):
+                daemon._accept(server)
+            # A client slow to send its request does not hold up others.
+            self.assertTrue(requested.wait(10))
+            request.assert_called_once_with(conn, {'force': True})
+        for c in (slow, conn):
+            c.settimeout.assert_called_once_with(
+                gss.TRIGGER_REQUEST_TIMEOUT)
+        self.assertTrue(reading.wait(10))
+        for _ in range(100):
+            if slow.close.called:
+                break
+            time.sleep(0.01)
+        slow.close.assert_called_once_with()
+
+    @mock.patch('files.glance_simplestreams_sync.read_conf')
+    def test_sync_daemon_next_interval(self, _read_conf):
+        _read_conf.return_value = {'frequency': 'hourly'}
+        daemon = gss.SyncDaemon()
+        # Poll until the first sync succeeded.
+        self.assertEqual(daemon.next_interval(1), gss.DAEMON_POLL_INTERVAL)
+        self.assertEqual(daemon.next_interval(None),
+                         gss.DAEMON_POLL_INTERVAL)
+        for returncode in [0, 1]:
+            daemon.synced_once = True
+            interval = daemon.next_interval(returncode)
+            self.assertGreaterEqual(interval, 3600 * (1 - gss.DAEMON_JITTER))
+            self.assertLessEqual(interval, 3600 * (1 + gss.DAEMON_JITTER))
@@ -4,6 +4,10 @@ import os
 import shutil
 import tempfile
 
+import jinja2
+import yaml
+
+import files.glance_simplestreams_sync as gss
 from hooks import hooks
 from test_utils import CharmTestCase
 
@@ -11,6 +15,7 @@ from test_utils import CharmTestCase
 TO_PATCH = [
     'apt_update',
     'apt_install',
+    'filter_installed_packages',
     'get_release',
     'install_ca_cert',
     'get_configs',
@@ -35,6 +40,10 @@ class TestConfigChanged(CharmTestCase):
         self.get_release.return_value = 'icehouse'
         self.mock_configs = mock.MagicMock()
         self.get_configs.return_value = self.mock_configs
+        patcher = mock.patch('charmhelpers.core.hookenv.relation_ids')
+        self.relation_ids = patcher.start()
+        self.relation_ids.return_value = []
+        self.addCleanup(patcher.stop)
 
     def tearDown(self):
         CharmTestCase.tearDown(self)
@@ -137,6 +146,123 @@ class TestConfigChanged(CharmTestCase):
         remove.assert_any_call(hooks.CRON_POLL_FILEPATH)
         update_nrpe_config.assert_called()
 
+    @mock.patch.object(hooks, 'service_reload_daemon')
+    @mock.patch.object(hooks, 'service_restart')
+    @mock.patch.object(hooks, 'service')
+    @mock.patch('shutil.copy')
+    @mock.patch.object(hooks, 'update_nrpe_config')
+    @mock.patch('os.path.exists')
+    @mock.patch('os.remove')
+    @mock.patch('glob.glob')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    @mock.patch('charmhelpers.core.hookenv.relations_of_type')
+    def test_sync_daemon(self, relations_of_type, config, glob, remove,
+                         exists, update_nrpe_config, copy, service,
+                         service_restart, service_reload_daemon):
+        self.test_config.set('run', True)
+        self.test_config.set('sync_scheduler', 'daemon')
+        setattr(self.test_config, "changed", lambda x: False)
+        config.return_value = self.test_config
+        glob.return_value = [os.path.join('/etc/cron.daily/',
+                                          hooks.CRON_JOB_FILENAME)]
+        exists.return_value = True
+        hooks.config_changed()
+
+        # Cron jobs are replaced by the daemon.
+        remove.assert_any_call(os.path.join('/etc/cron.daily/',
+                                            hooks.CRON_JOB_FILENAME))
+        remove.assert_any_call(hooks.CRON_POLL_FILEPATH)
+        copy.assert_called_once_with(
+            os.path.join('files', hooks.DAEMON_UNIT_FILENAME),
+            hooks.SYSTEMD_SYSTEM_DIR)
+        service_reload_daemon.assert_called_once_with()
+        service.assert_called_once_with('enable', hooks.DAEMON_SERVICE_NAME)
+        service_restart.assert_called_once_with(hooks.DAEMON_SERVICE_NAME)
+
+    @mock.patch.object(hooks, 'service_reload_daemon')
+    @mock.patch.object(hooks, 'service_restart')
+    @mock.patch.object(hooks, 'service')
+    @mock.patch('shutil.copy')
+    @mock.patch.object(hooks, 'update_nrpe_config')
+    @mock.patch('charmhelpers.core.hookenv.relation_set')
+    @mock.patch('charmhelpers.core.hookenv.unit_get')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    @mock.patch('charmhelpers.core.hookenv.relations_of_type')
+    def test_peer_cache(self, relations_of_type, config, unit_get,
+                        relation_set, update_nrpe_config, copy, service,
+                        service_restart, service_reload_daemon):
+        self.test_config.set('run', False)
+        self.test_config.set('staging_cache_size', 100)
+        self.test_config.set('peer_cache_port', 8090)
+        setattr(self.test_config, "changed", lambda x: False)
+        config.return_value = self.test_config
+        unit_get.return_value = '10.0.0.1'
+        peers = [{'private-address': '10.0.0.2',
+                  'cache-url': 'http://10.0.0.2:8090'},
+                 {'private-address': '10.0.0.3'}]
+        relations_of_type.side_effect = lambda reltype: (
+            peers if reltype == 'cluster' else [])
+        self.relation_ids.return_value = ['cluster:1']
+        hooks.config_changed()
+
+        copy.assert_any_call(
+            os.path.join('files', hooks.PEER_CACHE_UNIT_FILENAME),
+            hooks.SYSTEMD_SYSTEM_DIR)
+        service_restart.assert_called_once_with(
+            hooks.PEER_CACHE_SERVICE_NAME)
+        relation_set.assert_called_once_with(
+            relation_id='cluster:1', **{'cache-url': 'http://10.0.0.1:8090'})
+        ctxt = hooks.MirrorsConfigServiceContext()()
+        self.assertEqual(ctxt['peer_cache_address'], '10.0.0.1')
+        self.assertEqual(ctxt['peer_cache_clients'], ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(ctxt['peer_caches'], ['http://10.0.0.2:8090'])
+
+    @mock.patch('subprocess.check_call')
+    @mock.patch.object(hooks, 'service_reload')
+    @mock.patch('shutil.copy')
+    @mock.patch.object(hooks, 'update_nrpe_config')
+    @mock.patch('charmhelpers.core.hookenv.unit_get')
+    @mock.patch('charmhelpers.core.hookenv.config')
+    @mock.patch('charmhelpers.core.hookenv.relations_of_type')
+    def test_local_streams(self, relations_of_type, config, unit_get,
+                           update_nrpe_config, copy, service_reload,
+                           check_call):
+        self.test_config.set('run', False)
+        self.test_config.set('use_swift', False)
+        self.test_config.set('local_streams', True)
+        setattr(self.test_config, "changed", lambda x: False)
+        config.return_value = self.test_config
+        unit_get.return_value = '10.0.0.1'
+        self.filter_installed_packages.return_value = ['apache2']
+        conf_path = os.path.join(hooks.APACHE_CONF_DIR,
+                                 hooks.APACHE_CONF_NAME + '.conf')
+        with mock.patch('os.path.isfile', return_value=False):
+            hooks.config_changed()
+
+        self.assertEqual(hooks.get_local_streams_url(),
+                         'http://10.0.0.1/simplestreams/data')
+        self.filter_installed_packages.assert_called_once_with(['apache2'])
+        self.apt_install.assert_called_once_with(['apache2'], fatal=True)
+        copy.assert_called_once_with(
+            os.path.join('files', hooks.APACHE_CONF_FILENAME), conf_path)
+        check_call.assert_any_call(['a2enconf', hooks.APACHE_CONF_NAME])
+        service_reload.assert_called_once_with('apache2')
+
+        # Apache is left alone once it serves the current configuration.
+        self.filter_installed_packages.return_value = []
+        self.apt_install.reset_mock()
+        copy.reset_mock()
+        service_reload.reset_mock()
+        with mock.patch('os.path.isfile', return_value=True), \
+                mock.patch('filecmp.cmp', return_value=True) as cmp:
+            hooks.install_local_streams_server()
+        cmp.assert_called_once_with(
+            os.path.join('files', hooks.APACHE_CONF_FILENAME), conf_path,
+            shallow=False)
+        self.apt_install.assert_not_called()
+        copy.assert_not_called()
+        service_reload.assert_not_called()
+
     @mock.patch("charmhelpers.core.hookenv.resource_get")
     @mock.patch("os.stat")
     def test_resource_get_simplestreams(self, mock_os_stat, mock_resource_get):
@@ -147,3 +273,35 @@ class TestConfigChanged(CharmTestCase):
 
         mock_os_stat.return_value.st_size = 0
         self.assertEqual(hooks._resource_get('simplestreams'), None)
+
+
+class TestMirrorsConfig(CharmTestCase):
+    def setUp(self):
+        CharmTestCase.setUp(self, hooks, [])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    @mock.patch('charmhelpers.core.hookenv.config')
+    @mock.patch('charmhelpers.core.hookenv.relations_of_type')
+    def test_default_config_loads(self, relations_of_type, config):
+        """mirrors.yaml rendered from the defaults passes get_conf()."""
+        config.return_value = self.test_config
+        relations_of_type.return_value = []
+        templates = jinja2.Environment(loader=jinja2.FileSystemLoader(
+            os.path.join(os.path.dirname(hooks.__file__), '..',
+                         'templates')))
+        charm_conf_file = os.path.join(self.tmpdir, 'mirrors.yaml')
+        with open(charm_conf_file, 'w') as f:
+            f.write(templates.get_template('mirrors.yaml').render(
+                hooks.MirrorsConfigServiceContext()()))
+        id_conf_file = os.path.join(self.tmpdir, 'identity.yaml')
+        with open(id_conf_file, 'w') as f:
+            yaml.safe_dump({'api_version': 3}, f)
+
+        with mock.patch.object(gss, 'CHARM_CONF_FILE_NAME',
+                               charm_conf_file), \
+                mock.patch.object(gss, 'ID_CONF_FILE_NAME', id_conf_file):
+            _, charm_conf = gss.get_conf()
+        self.assertEqual(gss.get_target_regions(charm_conf), ['RegionOne'])
+        self.assertIsNone(gss.get_bandwidth_scheduler(charm_conf))
+        self.assertIsNone(gss.get_local_streams_url(charm_conf))